@@ -1,12 +1,94 @@
-from flask import Flask, request
-from config import CHANNEL_ACCESS_TOKEN
-from handlers.webhook_handler import handle_webhook
+import threading
+
+from flask import Flask, Response, abort, jsonify, request
+from config import CHANNEL_ACCESS_TOKEN, WEBHOOK_CAPTURE_PATH, ADMIN_TOKEN, PROFILE_SAMPLE_INTERVAL_MS, LAZY_IMPORTS
+from handlers.webhook_handler import handle_webhook, event_kind, event_source, preload_handlers
+from handlers.metrics import request_span, render_metrics
+from handlers.llm_client import usage_scope
+from handlers.utils import is_admin_token
+from handlers.admission import admission_status
+from handlers.scheduler import ensure_scheduler, scheduler_status
+from handlers.diagnostics import trace_scope
+from handlers.profiler import (
+    start_profiling, stop_profiling, profiling_status, profile_request, dump_stacks,
+)
 
 app = Flask(__name__)
+_capture_lock = threading.Lock()
+
+if not LAZY_IMPORTS:
+    preload_handlers()
+
+def capture_webhook_body(body):
+    # リプレイ用に受信した本文を1行1件で追記する
+    with _capture_lock:
+        with open(WEBHOOK_CAPTURE_PATH, 'a', encoding='utf-8') as f:
+            f.write(body.replace('\n', ' ') + '\n')
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    return handle_webhook(request)
+    if WEBHOOK_CAPTURE_PATH:
+        capture_webhook_body(request.get_data(as_text=True))
+    ensure_scheduler()
+    data = request.get_json(silent=True)
+    kind = event_kind(data)
+    # 管理トークン付きのX-Diagnostics-Traceヘッダーがあれば、この1件は必ずトレースする（リプレイでの調査用）
+    force_trace = is_admin_token(request.headers.get('X-Diagnostics-Trace', ''))
+    with request_span(kind), usage_scope(*event_source(data)), trace_scope(kind, force_trace), profile_request(kind):
+        return handle_webhook(request)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+def require_admin():
+    # ADMIN_TOKEN未設定なら管理用エンドポイント自体を出さない
+    if not ADMIN_TOKEN:
+        abort(404)
+    if not is_admin_token(request.headers.get('Authorization', '').removeprefix('Bearer ')):
+        abort(401)
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def admin_profile():
+    """
+    GET    : 状態（?dump=1 なら全スレッドの今のスタック）
+    POST   : 開始（seconds=秒数 / events=件数、interval_ms、pstats=0でcProfileなし）
+    DELETE : 停止して書き出す
+    """
+    require_admin()
+    if request.method == 'GET':
+        if request.args.get('dump') == '1':
+            return Response(dump_stacks(), content_type='text/plain; charset=utf-8')
+        return jsonify(profiling_status())
+    if request.method == 'DELETE':
+        return jsonify(stop_profiling() or {'running': False})
+
+    params = request.get_json(silent=True) or request.values
+    try:
+        info = start_profiling(
+            seconds=float(params.get('seconds') or 0) or None,
+            events=int(params.get('events') or 0) or None,
+            interval_ms=float(params.get('interval_ms') or PROFILE_SAMPLE_INTERVAL_MS),
+            with_pstats=str(params.get('pstats', '1')) != '0',
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)} | profiling_status()), 409
+    return jsonify(info)
+
+@app.route('/admin/admission', methods=['GET'])
+def admin_admission():
+    """処理枠ごとの処理中・待ちの数とスプールの件数"""
+    require_admin()
+    return jsonify(admission_status())
+
+@app.route('/admin/scheduler', methods=['GET'])
+def admin_scheduler():
+    """翌日分の準備の状態（準備済みの日・最後のエラー）"""
+    require_admin()
+    return jsonify(scheduler_status())
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=10000)
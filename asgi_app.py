@@ -0,0 +1,108 @@
+# asgi_app.py
+"""
+ASGI版のWebhookサーバー（app.pyのFlask版と同じ /webhook と /metrics を持つ）
+
+LINE・OpenAIはasyncクライアントで待ち、Drive・xlsx処理はスレッド（ASGI_THREAD_WORKERS）で動かすので、
+1ワーカーでI/O待ちの注文を数十件同時に抱えられる（gunicornのワーカーを増やすよりメモリが少ない）
+
+  uvicorn asgi_app:app --host 0.0.0.0 --port 10000 --workers 1
+
+/admin/profile（スレッド単位のサンプリング）はFlask版のみ
+"""
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import WEBHOOK_CAPTURE_PATH, ASGI_THREAD_WORKERS, LAZY_IMPORTS
+from handlers.webhook_handler import event_kind, event_source, preload_handlers
+from handlers.async_webhook_handler import handle_webhook_async
+from handlers.async_clients import close_clients
+from handlers.metrics import request_span, render_metrics
+from handlers.llm_client import usage_scope
+from handlers.diagnostics import trace_scope
+from handlers.utils import is_admin_token
+from handlers.admission import defer, deadline_seconds
+from handlers.resilience import Unavailable, deadline_scope
+from handlers.scheduler import ensure_scheduler
+
+_capture_lock = threading.Lock()
+
+if not LAZY_IMPORTS:
+    preload_handlers()
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def respond(send, status, body, content_type='text/plain; charset=utf-8'):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', content_type.encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+def capture_webhook_body(body):
+    # リプレイ用に受信した本文を1行1件で追記する（app.pyと同じ形式）
+    with _capture_lock:
+        with open(WEBHOOK_CAPTURE_PATH, 'a', encoding='utf-8') as f:
+            f.write(body.decode('utf-8').replace('\n', ' ') + '\n')
+
+async def webhook(scope, receive, send):
+    body = await read_body(receive)
+    if WEBHOOK_CAPTURE_PATH:
+        await asyncio.to_thread(capture_webhook_body, body)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        await respond(send, 400, 'Bad Request')
+        return
+    headers = dict(scope['headers'])
+    # 管理トークン付きのX-Diagnostics-Traceヘッダーがあれば、この1件は必ずトレースする
+    force_trace = is_admin_token(headers.get(b'x-diagnostics-trace', b'').decode())
+    kind = event_kind(data)
+    try:
+        with request_span(kind), usage_scope(*event_source(data)), trace_scope(kind, force_trace), \
+                deadline_scope(deadline_seconds(kind)):
+            text, status = await handle_webhook_async(data)
+    except Unavailable as e:
+        # 外部サービスの遮断中・締め切り切れはスプールに積んで後で処理する（Flask版のadmitと同じ）
+        text, status = await asyncio.to_thread(defer, data, kind, e)
+    except Exception as e:
+        print(f"Webhook処理エラー: {e}")
+        await respond(send, 500, 'Internal Server Error')
+        return
+    await respond(send, status, text)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # asyncio.to_thread の行き先（Drive・xlsx処理の同時実行数）
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=ASGI_THREAD_WORKERS, thread_name_prefix='asgi-io')
+            )
+            ensure_scheduler()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    path, method = scope['path'], scope['method']
+    if path == '/webhook' and method == 'POST':
+        await webhook(scope, receive, send)
+    elif path == '/metrics' and method == 'GET':
+        body, content_type = render_metrics()
+        await respond(send, 200, body, content_type)
+    else:
+        await respond(send, 404, 'Not Found')
@@ -0,0 +1,352 @@
+# benchmarks/bench_csv_handler.py
+"""
+csv_handlerの主要処理が行数・SKU数・シート数でどう伸びるかのマイクロベンチマーク
+
+  append      : append_to_xlsx（1メッセージ分の注文を既存の集計結果xlsxへ追記しアップロード）
+  update      : xlsx_with_summary_update（生データ全体を正規化し直してサマリを作り直す）
+  order_list  : create_order_list_sheet（集計結果サマリ＋タグ付け表→注文リスト、保存まで）
+  remains     : create_remains_sheets（受注残・注文残の作成と当日の締め、保存まで）
+  autofit     : autofit_columns（書き込んだDataFrameからの列幅計算）
+
+注文は実データに近い分布で合成する（商品の出現頻度はZipf、ひらがな表記の揺れ、kg・ケース・個などの単位）
+OpenAIはスタブ（呼び出し回数を数え、--llm-latency-msだけ待つ）、保存先はLocalStorage（handlers/storage.py）
+計測は処理・サイズごとに別プロセスで行い、時間・ピークRSS・LLM呼び出し回数を記録する
+結果は benchmarks/results/<コミット>.json に保存し、--compare で別コミットの結果と比べられる
+
+使い方:
+  python benchmarks/bench_csv_handler.py
+  python benchmarks/bench_csv_handler.py --cases append,update --sizes 1000,10000,50000 --skus 50,500 --sheets 0,5
+  python benchmarks/bench_csv_handler.py --compare benchmarks/results/1a2b3c4.json
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+RESULTS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'results')
+CASES = ['append', 'update', 'order_list', 'remains', 'autofit']
+
+# (商品名, ひらがな表記 or None, 主な単位)
+PRODUCTS = [
+    ('トマト', 'とまと', 'kg'), ('ミニトマト', None, 'パック'), ('キャベツ', 'きゃべつ', '玉'),
+    ('玉ねぎ', 'たまねぎ', 'kg'), ('じゃがいも', None, 'kg'), ('にんじん', None, 'kg'),
+    ('大根', 'だいこん', '本'), ('白菜', 'はくさい', '玉'), ('ほうれん草', 'ほうれんそう', '束'),
+    ('小松菜', 'こまつな', '束'), ('きゅうり', None, '本'), ('なす', None, '本'), ('ピーマン', 'ぴーまん', '袋'),
+    ('レタス', 'れたす', '玉'), ('ブロッコリー', 'ぶろっこりー', '個'), ('長ねぎ', 'ながねぎ', '本'),
+    ('青ネギ', 'あおねぎ', '束'), ('しいたけ', None, 'パック'), ('えのき', None, '袋'), ('ごぼう', None, '本'),
+    ('かぼちゃ', None, '個'), ('さつまいも', None, 'kg'), ('水菜', 'みずな', '束'), ('春菊', 'しゅんぎく', '束'),
+    ('オクラ', 'おくら', 'パック'), ('アスパラ', 'あすぱら', '束'), ('生姜', 'しょうが', 'kg'),
+    ('にんにく', None, 'kg'), ('りんご', None, 'ケース'), ('みかん', None, 'ケース'), ('バナナ', 'ばなな', 'ケース'),
+    ('いちご', None, 'パック'), ('レモン', 'れもん', '個'), ('大葉', 'おおば', '束'), ('パセリ', 'ぱせり', '束'),
+]
+ORIGINS = ['', '北海道産', '熊本産', '千葉産', '有機', '長野産', '茨城産', '高知産']
+SIZES = ['', '', '', 'S', 'M', 'L', '2L', '3L']
+# 主な単位以外で使われる単位と比率
+OTHER_UNITS = [('kg', 30), ('ケース', 20), ('個', 15), ('g', 10), ('箱', 10), ('袋', 8), ('パック', 7)]
+CUSTOMERS = ['レストラン山田', '居酒屋はな', 'ホテル青葉', '弁当さくら', '食堂みどり', 'カフェ森', '給食センター東', '割烹いずみ']
+ORDERERS = ['山田', '佐藤', '鈴木', '高橋', '田中', '伊藤', '渡辺']
+SUPPLIERS = ['青果丸一', '中央青果', '産直ファーム', '果実の森', '菜園ネット']
+NOTES = ['', '', '', '', '小さめ', '午前着', '傷なし', '大きめ']
+
+def _peak_rss_mb():
+    # Linuxのru_maxrssはKB単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def sku_catalog(skus, seed=0):
+    """商品名（産地付き）×サイズでSKUを作る。[(商品名, ひらがな表記, サイズ, 主な単位)]"""
+    rnd = random.Random(seed)
+    combos = [(o, p, s) for o in ORIGINS for p in PRODUCTS for s in sorted(set(SIZES))]
+    rnd.shuffle(combos)
+    # 産地なし・サイズなしの定番を先頭（よく出る側）に寄せる
+    combos.sort(key=lambda c: (c[0] != '', c[2] != ''))
+    catalog = []
+    for origin, (name, hira, unit), size in combos[:skus]:
+        catalog.append((origin + name, origin + hira if hira else None, size, unit))
+    return catalog
+
+def generate_orders(rows, skus, today, seed=0):
+    """注文の生データ（集計結果の列）を合成する。商品はZipf分布、3割はひらがな表記"""
+    import pandas as pd
+    rnd = random.Random(seed)
+    catalog = sku_catalog(skus, seed)
+    weights = [1 / (i + 1) for i in range(len(catalog))]
+    picks = rnd.choices(catalog, weights=weights, k=rows)
+    day = datetime.strptime(today, '%Y%m%d')
+    deliveries = [(day + timedelta(days=d)).strftime('%Y%m%d') for d in (0, 1, 1, 1, 2, 3)]
+    other_units, unit_weights = zip(*OTHER_UNITS)
+    data = []
+    for i, (name, hira, size, unit) in enumerate(picks):
+        if rnd.random() < 0.2:
+            unit = rnd.choices(other_units, weights=unit_weights)[0]
+        quantity = rnd.choice([500, 800, 1500]) if unit == 'g' else rnd.choice([1, 1, 2, 2, 3, 5, 10, 20])
+        data.append({
+            '顧客': rnd.choice(CUSTOMERS), '発注者': rnd.choice(ORDERERS),
+            '商品名': hira if hira and rnd.random() < 0.3 else name, 'サイズ': size,
+            '数量': quantity, '単位': unit, '納品希望日': rnd.choice(deliveries),
+            '納品場所': '本店', '時間': f'{today}{rnd.randint(6, 18):02d}',
+            '社内担当者': 'ベンチ', '備考': rnd.choice(NOTES),
+        })
+    return pd.DataFrame(data)
+
+def generate_tag_table(path, skus, seed=0):
+    """タグ付け表.xlsx（商品名・サイズ→発注先・税率など）"""
+    import pandas as pd
+    rnd = random.Random(seed)
+    rows = []
+    for name, _, size, _ in sku_catalog(skus, seed):
+        rows.append({'商品名': name, 'サイズ': size, '発注先': rnd.choice(SUPPLIERS),
+                     '税率': '8%', '郵便番号': '100-0001', '住所': '東京都千代田区'})
+    pd.DataFrame(rows).to_excel(path, index=False)
+
+class StubOpenAI:
+    """
+    chat.completions.createだけを持つOpenAIクライアントのスタブ
+    商品名の正規化はひらがな→カタカナ、単位の正規化は渡された単位をそのまま返す
+    """
+
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model=None, messages=None, **kwargs):
+        import jaconv
+        user = next((m['content'] for m in messages if m['role'] == 'user'), '')
+        if isinstance(user, str) and user.startswith('商品名:'):
+            kind = 'unit'
+            content = next((line[len('単位:'):].strip() for line in user.splitlines() if line.startswith('単位:')), '')
+        else:
+            kind = 'product_name'
+            content = jaconv.hira2kata(str(user))
+        with self._lock:
+            self.calls[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+def seed_workbook(path, df_raw, raw_sheet_name, extra_sheets, tag_df=None):
+    """正規化済みの生データ・サマリ・集計キャッシュ（＋注文リスト・無関係なシート）を持つ集計結果xlsxを作る"""
+    from openpyxl import Workbook
+    from handlers.csv_handler import (
+        SUMMARY_SHEET_NAME, SUMMARY_CACHE_SHEET, build_summary_aggregate, summary_df_from_aggregate,
+        summary_cache_rows, build_order_list, frame_digest,
+    )
+    from handlers.workbook_session import frame_rows
+    aggregate = build_summary_aggregate(df_raw)
+    summary = summary_df_from_aggregate(aggregate)
+    sheets = [(raw_sheet_name, frame_rows(df_raw)), (SUMMARY_SHEET_NAME, frame_rows(summary))]
+    if tag_df is not None:
+        sheets.append(('注文リスト', frame_rows(build_order_list(summary, tag_df))))
+    for i in range(extra_sheets):
+        sheets.append((f'参考{i + 1}', frame_rows(df_raw)))
+    sheets.append((SUMMARY_CACHE_SHEET, summary_cache_rows(aggregate, len(df_raw), frame_digest(df_raw))))
+    wb = Workbook(write_only=True)
+    for name, rows in sheets:
+        ws = wb.create_sheet(name)
+        if name == SUMMARY_CACHE_SHEET:
+            ws.sheet_state = 'hidden'
+        for row in rows:
+            ws.append(row)
+    wb.save(path)
+
+def normalized(df):
+    """シードするブック用に、スタブと同じ正規化（カタカナ化・g→kg）を先に掛けておく"""
+    import jaconv
+    import pandas as pd
+    df = df.copy()
+    df['商品名'] = df['商品名'].map(jaconv.hira2kata)
+    grams = df['単位'] == 'g'
+    df['数量'] = pd.to_numeric(df['数量']).astype(float)
+    df.loc[grams, '数量'] = df.loc[grams, '数量'] / 1000
+    df.loc[grams, '単位'] = 'kg'
+    return df
+
+def prepare(case, tmp, rows, skus, sheets, batch):
+    """計測対象の呼び出しを返す（ブックや保存先の準備は計測に含めない）"""
+    import pandas as pd
+    import pytz
+    from handlers.storage import LocalStorage, set_storage
+    from handlers.file_handler import get_or_create_folder
+    from handlers.workbook_session import WorkbookSession
+
+    storage = LocalStorage(os.path.join(tmp, 'drive'))
+    set_storage(storage)
+    today = datetime.now(pytz.timezone('Asia/Tokyo')).strftime('%Y%m%d')
+    tomorrow = (datetime.strptime(today, '%Y%m%d') + timedelta(days=1)).strftime('%Y%m%d')
+    file_name = f'集計結果_{today}.xlsx'
+    raw_sheet_name = f'集計結果_{today}'
+    df = generate_orders(rows, skus, today)
+    tag_path = os.path.join(tmp, 'タグ付け表.xlsx')
+    generate_tag_table(tag_path, skus)
+    tag_df = pd.read_excel(tag_path, dtype=str).fillna("")
+    csv_folder_id = get_or_create_folder('集計結果', parent_id=get_or_create_folder(today, parent_id=get_or_create_folder('受注集計')))
+
+    if case == 'append':
+        from handlers.csv_handler import append_to_xlsx
+        seed_path = os.path.join(tmp, file_name)
+        seed_workbook(seed_path, normalized(df), raw_sheet_name, sheets)
+        with open(seed_path, 'rb') as f:
+            storage.upload(f.read(), file_name, csv_folder_id)
+        new_rows = generate_orders(batch, skus, today, seed=1)
+        text = '\n'.join(','.join(str(v) for v in row) for row in new_rows.itertuples(index=False, name=None))
+        return lambda client: append_to_xlsx(text, csv_folder_id, client)
+
+    if case == 'update':
+        from handlers.csv_handler import xlsx_with_summary_update
+        xlsx_path = os.path.join(tmp, file_name)
+        seed_workbook(xlsx_path, normalized(df), raw_sheet_name, sheets)
+        return lambda client: xlsx_with_summary_update(df, xlsx_path, client)
+
+    if case in ('order_list', 'remains'):
+        from handlers.csv_handler import create_order_list_sheet, create_remains_sheets
+        seed_path = os.path.join(tmp, file_name)
+        seed_workbook(seed_path, normalized(df), raw_sheet_name, sheets, tag_df if case == 'remains' else None)
+        with open(seed_path, 'rb') as f:
+            storage.upload(f.read(), file_name, csv_folder_id)
+
+        def run(client):
+            session = WorkbookSession.open(file_name, csv_folder_id)
+            if case == 'order_list':
+                create_order_list_sheet(session, tag_path)
+            else:
+                create_remains_sheets(session, raw_sheet_name, today, tomorrow)
+            session.save()
+        return run
+
+    if case == 'autofit':
+        from openpyxl import Workbook
+        from handlers.workbook_session import autofit_columns, frame_rows
+        wb = Workbook()
+        ws = wb.active
+        for row in frame_rows(df):
+            ws.append(row)
+        return lambda client: autofit_columns(ws, df)
+
+    raise ValueError(f"未知の処理です: {case}")
+
+def worker(case, rows, skus, sheets, batch, llm_latency_ms):
+    """子プロセス側: 1回分を計測してJSONで返す（繰り越しストアも毎回空から）"""
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['ORDER_LEDGER_PATH'] = os.path.join(tmp, 'ledger.sqlite3')
+        import pandas  # noqa: F401  インポート分のRSSを基準値に含める
+        import openpyxl  # noqa: F401
+        import handlers.csv_handler  # noqa: F401
+        run = prepare(case, tmp, rows, skus, sheets, batch)
+        client = StubOpenAI(llm_latency_ms)
+        base_rss = _peak_rss_mb()
+        started = time.perf_counter()
+        run(client)
+        elapsed = time.perf_counter() - started
+        # LLM使用量の書き込みは一時ディレクトリの台帳があるうちに済ませる
+        from handlers.llm_client import flush
+        flush()
+    print(json.dumps({
+        'case': case, 'rows': rows, 'skus': skus, 'sheets': sheets,
+        'seconds': round(elapsed, 3), 'peak_rss_mb': round(_peak_rss_mb(), 1), 'base_rss_mb': round(base_rss, 1),
+        'llm_calls': sum(client.calls.values()), 'llm_calls_by_kind': dict(client.calls),
+    }, ensure_ascii=False))
+
+def git_revision():
+    """結果ファイル名に使うコミット（未コミットの変更があれば -dirty を付ける）"""
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return rev + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def result_key(r):
+    return (r['case'], r['rows'], r['skus'], r['sheets'])
+
+def print_results(results, baseline=None):
+    base = {result_key(r): r for r in (baseline or {}).get('results', []) if 'error' not in r}
+    print(f"{'case':<11} {'rows':>7} {'skus':>5} {'sheets':>6} {'seconds':>9} {'peak RSS MB':>12} {'LLM calls':>10}"
+          + ("  vs base" if baseline else ""))
+    for r in results:
+        if 'error' in r:
+            print(f"{r['case']:<11} {r['rows']:>7} {r['skus']:>5} {r['sheets']:>6} {'error':>9}")
+            continue
+        line = (f"{r['case']:<11} {r['rows']:>7} {r['skus']:>5} {r['sheets']:>6} {r['seconds']:>9.2f}"
+                f" {r['peak_rss_mb']:>12.1f} {r['llm_calls']:>10}")
+        b = base.get(result_key(r))
+        if b:
+            line += (f"  時間x{r['seconds'] / b['seconds'] if b['seconds'] else 0:.2f}"
+                     f" RSS{r['peak_rss_mb'] - b['peak_rss_mb']:+.0f}MB LLM{r['llm_calls'] - b['llm_calls']:+d}")
+        print(line)
+
+def _int_list(text):
+    return [int(s) for s in text.split(',') if s.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', default=','.join(CASES), help='計測する処理（カンマ区切り）')
+    parser.add_argument('--sizes', default='1000,10000', help='生データの行数（カンマ区切り）')
+    parser.add_argument('--skus', default='200', help='SKU数（カンマ区切り）')
+    parser.add_argument('--sheets', default='0', help='既存ブックに足す無関係なシート数（各シートは生データと同じ行数）')
+    parser.add_argument('--batch', type=int, default=10, help='appendで1回に追記する行数')
+    parser.add_argument('--llm-latency-ms', type=float, default=0, help='スタブのOpenAIが1呼び出しごとに待つ時間')
+    parser.add_argument('--output', help=f'結果JSONの保存先（既定: {os.path.relpath(RESULTS_DIR, ROOT_DIR)}/<コミット>.json）')
+    parser.add_argument('--compare', help='比較する過去の結果JSON')
+    parser.add_argument('--worker', nargs=6, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        case, *numbers = args.worker
+        worker(case, *[int(n) for n in numbers[:4]], float(numbers[4]))
+        return
+
+    results = []
+    grid = itertools.product(
+        [c.strip() for c in args.cases.split(',') if c.strip()],
+        _int_list(args.sizes), _int_list(args.skus), _int_list(args.sheets),
+    )
+    for case, rows, skus, sheets in grid:
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', case, str(rows), str(skus), str(sheets),
+             str(args.batch), str(args.llm_latency_ms)],
+            capture_output=True, text=True, cwd=ROOT_DIR,
+        )
+        if proc.returncode != 0:
+            print(f"{case} {rows}行: 失敗\n{proc.stderr}", file=sys.stderr)
+            results.append({'case': case, 'rows': rows, 'skus': skus, 'sheets': sheets,
+                            'error': proc.stderr.strip().splitlines()[-1:]})
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{case} {rows}行 SKU{skus} シート+{sheets}: {result['seconds']}秒 ピークRSS {result['peak_rss_mb']}MB"
+              f" LLM {result['llm_calls']}回", file=sys.stderr)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{git_revision()}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'revision': git_revision(), 'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0], 'batch': args.batch, 'llm_latency_ms': args.llm_latency_ms,
+            'results': results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# benchmarks/bench_gunicorn_memory.py
+"""
+gunicorn（gunicorn.conf.py）のワーカーごとのメモリの比較（Linuxの /proc/PID/smaps_rollup を読む）
+
+  no_preload       : 各ワーカーがfork後にアプリと重いモジュールを読み込む（preloadなしの従来の動かし方）
+  preload_nofreeze : 親プロセスで読み込んでからfork（gc.freezeなし）
+  preload          : 親プロセスで読み込み、gc.freeze()してからfork（gunicorn.conf.pyの既定）
+
+ワーカーごとに RSS / PSS（共有ページを按分した値）/ USS（そのワーカーだけのページ）を出す。
+ワーカーを1つ増やした時に増えるメモリはUSS、全体の実メモリは全プロセスのPSSの合計で見る。
+--requests を指定すると、スタブ（tools/stub_services.py）に向けて合成イベントを送ってから計る
+（処理で参照カウントが書き換わり、共有ページがどれだけ各ワーカーにコピーされるかを見る）
+
+使い方:
+  python benchmarks/bench_gunicorn_memory.py
+  python benchmarks/bench_gunicorn_memory.py --workers 4 --requests 40 --json result.json
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tools.stub_services import start_stub_server, stub_environment, parse_service_values  # noqa: E402
+from tools.replay_webhook import synthesize_events, replay  # noqa: E402
+
+MODES = {
+    'no_preload': {'GUNICORN_PRELOAD': '0', 'LAZY_IMPORTS': '0'},
+    'preload_nofreeze': {'GUNICORN_PRELOAD': '1', 'GUNICORN_GC_FREEZE': '0'},
+    'preload': {'GUNICORN_PRELOAD': '1', 'GUNICORN_GC_FREEZE': '1'},
+}
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def memory_kb(pid):
+    """{'rss', 'pss', 'uss'}（KB）"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(':'):
+                values[parts[0][:-1]] = int(parts[1])
+    return {
+        'rss': values.get('Rss', 0),
+        'pss': values.get('Pss', 0),
+        'uss': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0),
+    }
+
+def children(pid):
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # comm（2番目）に空白や括弧が入ることがあるので、最後の')'の後から読む
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(name))
+    return sorted(pids)
+
+def wait_settled(master_pid, workers, timeout=60):
+    """ワーカーがそろい、全体のRSSが落ち着くまで待つ（preloadなしでは各ワーカーの読み込みを待つ）"""
+    deadline = time.time() + timeout
+    previous = None
+    while time.time() < deadline:
+        pids = children(master_pid)
+        if len(pids) >= workers:
+            total = sum(memory_kb(pid)['rss'] for pid in pids)
+            if previous and abs(total - previous) <= previous * 0.005:
+                return pids
+            previous = total
+        time.sleep(0.5)
+    raise RuntimeError("ワーカーの起動待ちがタイムアウトしました")
+
+def measure(mode, workers, threads, stub_port, requests_count):
+    port = _free_port()
+    env = dict(
+        os.environ, **stub_environment(stub_port), **MODES[mode],
+        GUNICORN_BIND=f'127.0.0.1:{port}', GUNICORN_WORKERS=str(workers), GUNICORN_THREADS=str(threads),
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app'], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        started = time.perf_counter()
+        pids = wait_settled(process.pid, workers)
+        boot_seconds = time.perf_counter() - started
+        if requests_count:
+            bodies = synthesize_events(requests_count, 0)
+            replay(bodies, f'http://127.0.0.1:{port}/webhook', concurrency=workers * 2)
+            pids = wait_settled(process.pid, workers)
+        master = memory_kb(process.pid)
+        per_worker = [memory_kb(pid) for pid in pids]
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    avg = {k: sum(w[k] for w in per_worker) / len(per_worker) / 1024 for k in ('rss', 'pss', 'uss')}
+    return {
+        'mode': mode,
+        'workers': workers,
+        'boot_seconds': round(boot_seconds, 2),
+        'master_rss_mb': round(master['rss'] / 1024, 1),
+        'worker_rss_mb': round(avg['rss'], 1),
+        'worker_pss_mb': round(avg['pss'], 1),
+        'worker_uss_mb': round(avg['uss'], 1),
+        'total_pss_mb': round((master['pss'] + sum(w['pss'] for w in per_worker)) / 1024, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--modes', default=','.join(MODES), help='計るモード（カンマ区切り）')
+    parser.add_argument('--requests', type=int, default=0, help='計測前に送る合成イベントの件数')
+    parser.add_argument('--latency', default='', help="スタブの遅延ミリ秒（例: openai=200,drive=20）")
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    args = parser.parse_args()
+
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        sys.exit("/proc/PID/smaps_rollup が読めません（Linux 4.14以降が必要です）")
+
+    server, _ = start_stub_server(0, parse_service_values(args.latency), {}, 0)
+    results = []
+    try:
+        for mode in [m.strip() for m in args.modes.split(',') if m.strip()]:
+            result = measure(mode, args.workers, args.threads, server.server_address[1], args.requests)
+            results.append(result)
+            print(f"{mode}: ワーカーUSS {result['worker_uss_mb']}MB / 全体PSS {result['total_pss_mb']}MB", file=sys.stderr)
+    finally:
+        server.shutdown()
+
+    print(f"gunicorn {args.workers}ワーカー × {args.threads}スレッド" + (f"（{args.requests}件処理後）" if args.requests else ""))
+    print(f"{'mode':<17} {'boot s':>7} {'master RSS':>11} {'worker RSS':>11} {'worker PSS':>11} {'worker USS':>11} {'total PSS':>10}")
+    for r in results:
+        print(
+            f"{r['mode']:<17} {r['boot_seconds']:>7.2f} {r['master_rss_mb']:>11.1f} {r['worker_rss_mb']:>11.1f} "
+            f"{r['worker_pss_mb']:>11.1f} {r['worker_uss_mb']:>11.1f} {r['total_pss_mb']:>10.1f}"
+        )
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
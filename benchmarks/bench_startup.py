@@ -0,0 +1,137 @@
+# benchmarks/bench_startup.py
+"""
+起動時間（import app）の計測と、上限（STARTUP_IMPORT_BUDGET_MS）の確認
+
+毎回新しいプロセスで次を計る（モジュールのキャッシュが効かないように）
+  import_ms      : import app（Flask版）/ import asgi_app の所要時間
+  first_load_ms  : 遅延読み込みにした重いハンドラ（preload_handlers）の読み込み時間。最初の注文・コマンドで払う分
+  drive_build_ms : Driveのserviceの作成（1スレッド目 / 2スレッド目）。ディスカバリ文書は同梱のものを1回だけ解析する
+上位のモジュールは python -X importtime の累積時間から出す
+
+LAZY_IMPORTS=1（既定）のimport_msの中央値が上限を超えたら終了コード1で終わる（CIで起動時間の後戻りを検知する用）
+
+使い方:
+  python benchmarks/bench_startup.py
+  python benchmarks/bench_startup.py --runs 10 --target asgi_app --budget-ms 300 --json result.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def worker(target):
+    import threading
+    import time
+    started = time.perf_counter()
+    __import__(target)
+    import_ms = (time.perf_counter() - started) * 1000
+
+    from handlers.webhook_handler import preload_handlers
+    started = time.perf_counter()
+    preload_handlers()
+    first_load_ms = (time.perf_counter() - started) * 1000
+
+    from handlers.storage import DriveStorage
+    storage = DriveStorage()
+    build_ms = []
+
+    def build():
+        started = time.perf_counter()
+        storage.service
+        build_ms.append((time.perf_counter() - started) * 1000)
+
+    for _ in range(2):
+        thread = threading.Thread(target=build)
+        thread.start()
+        thread.join()
+    print(json.dumps({
+        'import_ms': round(import_ms, 1),
+        'first_load_ms': round(first_load_ms, 1),
+        'drive_build_ms': [round(ms, 1) for ms in build_ms],
+    }))
+
+def child_env(lazy):
+    env = dict(os.environ)
+    env['LAZY_IMPORTS'] = '1' if lazy else '0'
+    # serviceの作成だけを計るので、認証情報の読み込みが要らないスタブのエンドポイントにする（通信はしない）
+    env.setdefault('DRIVE_API_ENDPOINT', 'http://127.0.0.1:1')
+    return env
+
+def measure(target, lazy):
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', target],
+        capture_output=True, text=True, cwd=ROOT, env=child_env(lazy),
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1:])
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def top_imports(target, lazy, top):
+    """-X importtime の累積時間（ミリ秒）が大きいモジュール"""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {target}'],
+        capture_output=True, text=True, cwd=ROOT, env=child_env(lazy),
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', default='app', help='app（Flask版） / asgi_app')
+    parser.add_argument('--runs', type=int, default=5, help='計測するプロセス数（モードごと）')
+    parser.add_argument('--budget-ms', type=float, help='import_msの中央値の上限（既定はSTARTUP_IMPORT_BUDGET_MS）')
+    parser.add_argument('--top', type=int, default=10, help='表示する上位モジュール数')
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker)
+        return
+
+    from config import STARTUP_IMPORT_BUDGET_MS
+    budget = args.budget_ms if args.budget_ms is not None else STARTUP_IMPORT_BUDGET_MS
+
+    results = {}
+    for lazy in (True, False):
+        mode = 'lazy' if lazy else 'preload'
+        runs = [measure(args.target, lazy) for _ in range(args.runs)]
+        results[mode] = {
+            'import_ms': statistics.median(r['import_ms'] for r in runs),
+            'first_load_ms': statistics.median(r['first_load_ms'] for r in runs),
+            'drive_build_ms': [statistics.median(r['drive_build_ms'][i] for r in runs) for i in range(2)],
+            'top_imports': top_imports(args.target, lazy, args.top),
+        }
+
+    print(f"import {args.target}（{args.runs}プロセスの中央値）")
+    print(f"{'mode':<8} {'import ms':>10} {'first load ms':>14} {'drive build ms (1st/2nd)':>26}")
+    for mode, r in results.items():
+        build = '{:.1f} / {:.1f}'.format(*r['drive_build_ms'])
+        print(f"{mode:<8} {r['import_ms']:>10.1f} {r['first_load_ms']:>14.1f} {build:>26}")
+    for mode, r in results.items():
+        print(f"\n{mode}: 累積時間の大きいモジュール")
+        for ms, name in r['top_imports']:
+            print(f"  {ms:>8.1f}ms  {name}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'budget_ms': budget, **results}, f, ensure_ascii=False, indent=2)
+
+    import_ms = results['lazy']['import_ms']
+    if import_ms > budget:
+        print(f"\n起動時間が上限を超えています: {import_ms:.1f}ms > {budget:.0f}ms", file=sys.stderr)
+        sys.exit(1)
+    print(f"\n起動時間は上限内です: {import_ms:.1f}ms <= {budget:.0f}ms")
+
+if __name__ == '__main__':
+    main()
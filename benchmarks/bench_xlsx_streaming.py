@@ -0,0 +1,145 @@
+# benchmarks/bench_xlsx_streaming.py
+"""
+集計結果xlsxの大きな生データシートを読み書きする時の、ピークRSSと処理時間の比較
+
+  object   : 従来どおり通常モードで全体を読み込み、ws.valuesで読んでシートを追加・保存
+  streaming: read-onlyで流し読みし、write-onlyで書き出す（WorkbookSessionの大きいブック用の経路）
+
+処理内容はピッキングリスト作成と同じ（生データを読み、納品希望日で絞ってシートを追加して保存）
+計測はサイズ・モードごとに別プロセスで行う（ru_maxrssはプロセス内の最大値のため）
+
+使い方:
+  python benchmarks/bench_xlsx_streaming.py
+  python benchmarks/bench_xlsx_streaming.py --sizes 10000,100000 --modes streaming --json result.json
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RAW_COLUMNS = ['顧客', '発注者', '商品名', 'サイズ', '数量', '単位', '納品希望日', '納品場所', '時間', '社内担当者', '備考']
+PRODUCTS = ['トマト', 'キャベツ', '玉ねぎ', 'じゃがいも', 'にんじん', '大根', 'ほうれん草', '小松菜', 'きゅうり', 'なす']
+CUSTOMERS = ['レストラン山田', '居酒屋はな', 'ホテル青葉', '弁当さくら', '食堂みどり']
+DAY = '20261019'
+NEXT_DAY = '20261020'
+
+def _peak_rss_mb():
+    # Linuxのru_maxrssはKB単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def generate_workbook(path, rows, seed=0):
+    """生データシート（rows行）と小さなサマリシートを持つ集計結果xlsxを作る"""
+    from openpyxl import Workbook
+    rnd = random.Random(seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(f'集計結果_{DAY}')
+    ws.append(RAW_COLUMNS)
+    for i in range(rows):
+        ws.append([
+            rnd.choice(CUSTOMERS), f'担当{i % 30}', rnd.choice(PRODUCTS), rnd.choice(['S', 'M', 'L', '']),
+            rnd.randint(1, 20), rnd.choice(['kg', 'ケース', '個']), int(rnd.choice([DAY, NEXT_DAY])),
+            '本店', f'{DAY}{rnd.randint(6, 18):02d}', '', '' if i % 4 else '午前着',
+        ])
+    ws = wb.create_sheet('集計結果サマリ')
+    ws.append(RAW_COLUMNS)
+    wb.save(path)
+
+def run_object(src, dst):
+    import io
+    from openpyxl import load_workbook
+    from handlers.workbook_session import frame_from_rows, autofit_columns, to_sheet_values
+    with open(src, 'rb') as f:
+        wb = load_workbook(io.BytesIO(f.read()))
+    df = frame_from_rows(wb[f'集計結果_{DAY}'].values)
+    picking = df[df['納品希望日'] == DAY]
+    ws = wb.create_sheet('ピッキングリスト')
+    ws.append(list(picking.columns))
+    for row in to_sheet_values(picking).itertuples(index=False, name=None):
+        ws.append(row)
+    autofit_columns(ws, picking)
+    wb.save(dst)
+    return len(df), len(picking)
+
+def run_streaming(src, dst):
+    import io
+    from openpyxl import load_workbook
+    from handlers.workbook_session import frame_from_rows, frame_rows, column_widths, write_workbook_streaming
+    with open(src, 'rb') as f:
+        data = f.read()
+    wb = load_workbook(io.BytesIO(data), read_only=True)
+    df = frame_from_rows(wb[f'集計結果_{DAY}'].iter_rows(values_only=True))
+    wb.close()
+    picking = df[df['納品希望日'] == DAY]
+    write_workbook_streaming(dst, data, {
+        'ピッキングリスト': {'rows': frame_rows(picking), 'widths': column_widths(picking)},
+    })
+    return len(df), len(picking)
+
+def worker(mode, src):
+    """子プロセス側: 1回分を計測してJSONで返す"""
+    import openpyxl  # noqa: F401  インポート分のRSSを基準値に含める（pandasはworkbook_sessionが読み込む）
+    import handlers.workbook_session  # noqa: F401
+    base_rss = _peak_rss_mb()
+    dst = src + f'.{mode}.out.xlsx'
+    started = time.perf_counter()
+    rows, picked = (run_streaming if mode == 'streaming' else run_object)(src, dst)
+    elapsed = time.perf_counter() - started
+    out_size = os.path.getsize(dst)
+    os.remove(dst)
+    print(json.dumps({
+        'mode': mode, 'rows': rows, 'picked': picked, 'seconds': round(elapsed, 3),
+        'peak_rss_mb': round(_peak_rss_mb(), 1), 'base_rss_mb': round(base_rss, 1),
+        'output_mb': round(out_size / 1024 / 1024, 2),
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,500000', help='生データの行数（カンマ区切り）')
+    parser.add_argument('--modes', default='object,streaming', help='object / streaming（カンマ区切り）')
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    parser.add_argument('--worker', nargs=2, metavar=('MODE', 'SRC'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(*args.worker)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in [int(s) for s in args.sizes.split(',') if s.strip()]:
+            src = os.path.join(tmp, f'集計結果_{size}.xlsx')
+            started = time.perf_counter()
+            generate_workbook(src, size)
+            print(f"{size}行のブックを生成（{time.perf_counter() - started:.1f}秒, {os.path.getsize(src) / 1024 / 1024:.1f}MB）", file=sys.stderr)
+            for mode in [m.strip() for m in args.modes.split(',') if m.strip()]:
+                proc = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--worker', mode, src],
+                    capture_output=True, text=True
+                )
+                if proc.returncode != 0:
+                    print(f"{mode} {size}行: 失敗\n{proc.stderr}", file=sys.stderr)
+                    results.append({'mode': mode, 'rows': size, 'error': proc.stderr.strip().splitlines()[-1:]})
+                    continue
+                result = json.loads(proc.stdout.strip().splitlines()[-1])
+                results.append(result)
+                print(f"{mode} {size}行: {result['seconds']}秒 ピークRSS {result['peak_rss_mb']}MB", file=sys.stderr)
+
+    print(f"{'mode':<10} {'rows':>8} {'seconds':>9} {'peak RSS MB':>12} {'(import後) MB':>14}")
+    for r in results:
+        if 'error' in r:
+            print(f"{r['mode']:<10} {r['rows']:>8} {'error':>9}")
+            continue
+        print(f"{r['mode']:<10} {r['rows']:>8} {r['seconds']:>9.2f} {r['peak_rss_mb']:>12.1f} {r['base_rss_mb']:>14.1f}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
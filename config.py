@@ -6,4 +6,152 @@ SERVICE_ACCOUNT_FILE = '/etc/secrets/credentials.json'
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 CSV_FORMAT_PATH = '集計フォーマット.csv'
 SHARED_DRIVE_ID = os.environ.get('GOOGLE_SHARED_DRIVE_ID', '0AGgACoeUF81eUk9PVA')
-ORDER_SUMMARY_FOLDER_ID = '15tyS6xLu203jttUZlxllyuhQbtKHrXjN'
\ No newline at end of file
+ORDER_SUMMARY_FOLDER_ID = '15tyS6xLu203jttUZlxllyuhQbtKHrXjN'
+
+# 注文書作成の並列数（0以下ならCPU数から自動決定）
+ORDER_SHEET_RENDER_WORKERS = int(os.environ.get('ORDER_SHEET_RENDER_WORKERS', '0'))
+ORDER_SHEET_UPLOAD_WORKERS = int(os.environ.get('ORDER_SHEET_UPLOAD_WORKERS', '8'))
+
+# 注文書のレンダリング方式: 'fast'（XML差し替え） / 'openpyxl'
+ORDER_SHEET_RENDER_MODE = os.environ.get('ORDER_SHEET_RENDER_MODE', 'fast')
+
+# 受注台帳（SQLite）。有効時は注文を台帳に書き込み、集計結果xlsxは台帳から描き出す
+# 台帳モードでは台帳が正本になるので、ORDER_LEDGER_PATHに永続ディスク上のパスの指定が必須
+# （既定の/tmpは台帳モード以外の繰り越しストア・LLM使用量用。消えても前日の集計結果xlsxから取り込み直す）
+ORDER_LEDGER_ENABLED = os.environ.get('ORDER_LEDGER_ENABLED', '0') == '1'
+ORDER_LEDGER_PATH = os.environ.get('ORDER_LEDGER_PATH', '/tmp/order_ledger.sqlite3')
+
+# 集計結果xlsxでこのサイズ（シートXMLの非圧縮バイト数）以上のシートがあれば、read-only/write-onlyで流し読み・流し書きする
+XLSX_STREAMING_THRESHOLD_BYTES = int(os.environ.get('XLSX_STREAMING_THRESHOLD_BYTES', str(8 * 1024 * 1024)))
+
+# 月次集計で日別の集計結果xlsxを並列DLする数
+MONTHLY_DOWNLOAD_WORKERS = int(os.environ.get('MONTHLY_DOWNLOAD_WORKERS', '8'))
+
+# LINE APIの接続先（リプレイ・負荷試験ではtools/stub_services.pyのスタブに向ける）
+LINE_API_BASE = os.environ.get('LINE_API_BASE', 'https://api.line.me')
+LINE_DATA_API_BASE = os.environ.get('LINE_DATA_API_BASE', 'https://api-data.line.me')
+# Google Drive APIのルートURL（指定時は認証なしでここへ接続する。スタブ用: http://127.0.0.1:18080/）
+DRIVE_API_ENDPOINT = os.environ.get('DRIVE_API_ENDPOINT')
+# 受信したWebhookの本文をJSONLに記録する（tools/replay_webhook.pyで再生する用。未設定なら記録しない）
+WEBHOOK_CAPTURE_PATH = os.environ.get('WEBHOOK_CAPTURE_PATH')
+
+# ファイルの保存先: 'drive'（Google Drive） / 'local'（LOCAL_STORAGE_DIR。オフラインでのベンチマーク・プロファイル用）
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'drive')
+LOCAL_STORAGE_DIR = os.environ.get('LOCAL_STORAGE_DIR', '/tmp/local_drive')
+# ローカル保存先で1呼び出しごとに入れる遅延（ミリ秒。Driveの往復時間の模擬）
+LOCAL_STORAGE_LATENCY_MS = float(os.environ.get('LOCAL_STORAGE_LATENCY_MS', '0'))
+
+# LLM呼び出しの使用量（トークン数・所要時間・試行回数・呼び出し元）の記録。既定は受注台帳と同じDBのllm_usageテーブル
+LLM_USAGE_ENABLED = os.environ.get('LLM_USAGE_ENABLED', '1') == '1'
+LLM_USAGE_PATH = os.environ.get('LLM_USAGE_PATH', ORDER_LEDGER_PATH)
+
+# 管理用エンドポイント（/admin/...）の認証トークン。未設定なら管理用エンドポイントは無効（404）
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+# オンデマンドプロファイル（/admin/profile）の出力先・スタック採取間隔（ミリ秒）・最長時間（秒）
+PROFILE_OUTPUT_DIR = os.environ.get('PROFILE_OUTPUT_DIR', '/tmp/profiles')
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '10'))
+PROFILE_MAX_SECONDS = int(os.environ.get('PROFILE_MAX_SECONDS', '600'))
+
+# ログのレベルと形式（'text': key=value / 'json': 1行1JSON）
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+# 診断用の確認処理（Drive全体の同名ファイル検索など）と診断ログ。1なら常に行う
+DIAGNOSTICS_ENABLED = os.environ.get('DIAGNOSTICS_ENABLED', '0') == '1'
+# Webhookをこの確率でトレース対象にし、その1件だけ診断を行う（0なら行わない）
+DIAGNOSTICS_SAMPLE_RATE = float(os.environ.get('DIAGNOSTICS_SAMPLE_RATE', '0'))
+
+# Webhook内の独立した処理（LINE・Drive・OpenAI）を並列に動かすスレッドプールの大きさ（プロセスで共有）
+TASK_GRAPH_WORKERS = int(os.environ.get('TASK_GRAPH_WORKERS', '16'))
+
+# ASGI版（asgi_app.py）: Drive・xlsx処理などブロッキングな処理を回すスレッド数と、LINE APIのタイムアウト（秒）
+ASGI_THREAD_WORKERS = int(os.environ.get('ASGI_THREAD_WORKERS', '32'))
+LINE_HTTP_TIMEOUT = float(os.environ.get('LINE_HTTP_TIMEOUT', '30'))
+
+# 起動時の読み込み。1（既定）ならpandas・openpyxl・OpenAI・pdf2image等は最初に使うコマンド・メッセージで読み込む
+# 0なら起動時にまとめて読み込む（gunicornのpreloadで親プロセスに読み込んでおく場合など）
+LAZY_IMPORTS = os.environ.get('LAZY_IMPORTS', '1') == '1'
+# benchmarks/bench_startup.py で守る「import app」の所要時間の上限（ミリ秒）
+STARTUP_IMPORT_BUDGET_MS = float(os.environ.get('STARTUP_IMPORT_BUDGET_MS', '400'))
+
+# gunicorn（gunicorn.conf.py）: 待ち受け・ワーカー数・ワーカーごとのスレッド数・タイムアウト（秒）
+GUNICORN_BIND = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '10000')}")
+GUNICORN_WORKERS = int(os.environ.get('GUNICORN_WORKERS', '2'))
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', '8'))
+GUNICORN_TIMEOUT = int(os.environ.get('GUNICORN_TIMEOUT', '180'))
+# 1なら親プロセスでアプリと重いモジュールを読み込んでからforkし、ワーカー間でメモリを共有する
+GUNICORN_PRELOAD = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+# preload時、fork前にgc.freeze()で読み込み済みのオブジェクトをGCの対象から外す（GCの走査で共有ページを書き換えない）
+GUNICORN_GC_FREEZE = os.environ.get('GUNICORN_GC_FREEZE', '1') == '1'
+
+# 受付制御（handlers/admission.py）: 注文（テキスト・画像・PDF）と管理コマンドで別々の同時実行数・待ち行列・最長待ち時間（秒）
+# gunicornでは1ワーカーの（同時実行数＋待ち行列）の合計をGUNICORN_THREADS以下にする（待っている間もスレッドを使うため）
+# 既定では無効。有効にする時はADMISSION_ENABLED=1とSPOOL_PATH（またはORDER_LEDGER_PATH。永続ディスク上）を指定する
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '0') == '1'
+ADMISSION_ORDER_CONCURRENCY = int(os.environ.get('ADMISSION_ORDER_CONCURRENCY', '3'))
+ADMISSION_ORDER_MAX_QUEUE = int(os.environ.get('ADMISSION_ORDER_MAX_QUEUE', '2'))
+ADMISSION_ORDER_MAX_WAIT_SECONDS = float(os.environ.get('ADMISSION_ORDER_MAX_WAIT_SECONDS', '10'))
+ADMISSION_COMMAND_CONCURRENCY = int(os.environ.get('ADMISSION_COMMAND_CONCURRENCY', '2'))
+ADMISSION_COMMAND_MAX_QUEUE = int(os.environ.get('ADMISSION_COMMAND_MAX_QUEUE', '1'))
+ADMISSION_COMMAND_MAX_WAIT_SECONDS = float(os.environ.get('ADMISSION_COMMAND_MAX_WAIT_SECONDS', '30'))
+# 待ちきれないWebhookを積むスプール（SQLite）と、取り出して処理するスレッド数・再試行回数・処理中のまま止まったとみなす秒数
+# LINEへは200を返した後なので、スプールは再起動で消えない場所に置く
+SPOOL_PATH = os.environ.get('SPOOL_PATH', ORDER_LEDGER_PATH)
+SPOOL_DRAIN_WORKERS = int(os.environ.get('SPOOL_DRAIN_WORKERS', '1'))
+SPOOL_POLL_SECONDS = float(os.environ.get('SPOOL_POLL_SECONDS', '1'))
+SPOOL_MAX_ATTEMPTS = int(os.environ.get('SPOOL_MAX_ATTEMPTS', '5'))
+SPOOL_CLAIM_TIMEOUT_SECONDS = float(os.environ.get('SPOOL_CLAIM_TIMEOUT_SECONDS', '900'))
+
+# 注文の追記専用ジャーナル（handlers/journal.py）。有効にする時は再起動で消えない永続ディスク上のディレクトリを必ず指定する
+JOURNAL_ENABLED = os.environ.get('JOURNAL_ENABLED', '0') == '1'
+JOURNAL_DIR = os.environ.get('JOURNAL_DIR', '')
+# 1セグメントファイルの大きさの上限（バイト）と、1件ごとのfsync
+JOURNAL_SEGMENT_BYTES = int(os.environ.get('JOURNAL_SEGMENT_BYTES', str(8 * 1024 * 1024)))
+JOURNAL_FSYNC = os.environ.get('JOURNAL_FSYNC', '1') == '1'
+# 書き込み待ちの注文をまとめて書き込む間隔（秒。0なら自動では行わない）と、対象にする経過秒数（処理中の注文と二重にしない）
+JOURNAL_REPLAY_INTERVAL_SECONDS = float(os.environ.get('JOURNAL_REPLAY_INTERVAL_SECONDS', '300'))
+JOURNAL_REPLAY_MIN_AGE_SECONDS = float(os.environ.get('JOURNAL_REPLAY_MIN_AGE_SECONDS', '600'))
+
+# 外部サービス（handlers/resilience.py）: 連続でこの回数失敗したら遮断し、BREAKER_OPEN_SECONDS秒後に1件だけ試して戻す
+# 既定では無効。遮断中に届いた注文をスプールに積んで後で処理するには、受付制御（ADMISSION_ENABLED=1）と合わせて有効にする
+BREAKER_ENABLED = os.environ.get('BREAKER_ENABLED', '0') == '1'
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', '30'))
+# サービスごとの、失敗と数える遅い応答（秒。0なら数えない）と1回の呼び出しのタイムアウト（秒。LINEはLINE_HTTP_TIMEOUT）
+OPENAI_SLOW_SECONDS = float(os.environ.get('OPENAI_SLOW_SECONDS', '30'))
+OPENAI_TIMEOUT_SECONDS = float(os.environ.get('OPENAI_TIMEOUT_SECONDS', '60'))
+LINE_SLOW_SECONDS = float(os.environ.get('LINE_SLOW_SECONDS', '5'))
+DRIVE_SLOW_SECONDS = float(os.environ.get('DRIVE_SLOW_SECONDS', '20'))
+DRIVE_HTTP_TIMEOUT = float(os.environ.get('DRIVE_HTTP_TIMEOUT', '60'))
+# Webhook1件の締め切り（秒、到着から。0なら無し。受付制御が有効な時だけ使う）。管理コマンドは集計全体の正規化があるので既定では無し
+ORDER_DEADLINE_SECONDS = float(os.environ.get('ORDER_DEADLINE_SECONDS', '120'))
+COMMAND_DEADLINE_SECONDS = float(os.environ.get('COMMAND_DEADLINE_SECONDS', '0'))
+# 締め切りのうちGPT解析・正規化に使ってよい割合（残りは原本の保存・集計への書き込み用）
+GPT_EXTRACTION_BUDGET_SHARE = float(os.environ.get('GPT_EXTRACTION_BUDGET_SHARE', '0.6'))
+NORMALIZE_BUDGET_SHARE = float(os.environ.get('NORMALIZE_BUDGET_SHARE', '0.25'))
+
+# 翌日分の準備（handlers/scheduler.py）: 毎日PREWARM_TIME（日本時間 HH:MM）以降に、翌日のフォルダと空の集計結果xlsxを作っておく
+# 既定では無効。有効にする（SCHEDULER_ENABLED=1）にはSCHEDULER_STATE_DIRの指定が必須
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '0') == '1'
+PREWARM_TIME = os.environ.get('PREWARM_TIME', '23:45')
+SCHEDULER_POLL_SECONDS = float(os.environ.get('SCHEDULER_POLL_SECONDS', '60'))
+# 準備済みの記録とプロセス間のロックを置くディレクトリ（gunicornの各ワーカーのうち1つだけが準備する）
+SCHEDULER_STATE_DIR = os.environ.get('SCHEDULER_STATE_DIR', '')
+# Driveのフォルダ作成のプロセス間ロック（同時に届いた日付最初のメッセージで同名フォルダを二重に作らない）
+FOLDER_LOCK_PATH = os.environ.get('FOLDER_LOCK_PATH', '/tmp/drive_folders.lock')
+# 集計結果xlsxの新規作成のプロセス間ロック（日付最初の注文と翌日分の準備で同名ファイルを二重に作らない）
+WORKBOOK_LOCK_PATH = os.environ.get('WORKBOOK_LOCK_PATH', '/tmp/summary_workbook.lock')
+
+def require_durable_path(feature, *names):
+    # 再起動・再デプロイをまたいで残す必要があるデータは、既定の/tmpに置かず明示的な指定を必須にする（namesのどれか）
+    if not any(os.environ.get(name) for name in names):
+        raise RuntimeError(f"{feature}を有効にするには、永続ディスク上の{' / '.join(names)}を指定してください")
+
+if ORDER_LEDGER_ENABLED:
+    require_durable_path('ORDER_LEDGER_ENABLED', 'ORDER_LEDGER_PATH')
+if ADMISSION_ENABLED:
+    # SPOOL_PATHの既定はORDER_LEDGER_PATH
+    require_durable_path('ADMISSION_ENABLED', 'SPOOL_PATH', 'ORDER_LEDGER_PATH')
+if JOURNAL_ENABLED:
+    require_durable_path('JOURNAL_ENABLED', 'JOURNAL_DIR')
+if SCHEDULER_ENABLED:
+    require_durable_path('SCHEDULER_ENABLED', 'SCHEDULER_STATE_DIR')
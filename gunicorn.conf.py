@@ -0,0 +1,52 @@
+# gunicorn.conf.py
+"""
+Flask版（app.py）をgunicornで動かす時の設定（カレントディレクトリのこのファイルをgunicornが自動で読む）
+
+  gunicorn app:app
+
+GUNICORN_PRELOAD=1（既定）では親プロセスでアプリとpandas・openpyxl・OpenAI等をまとめて読み込み、
+gc.freeze()してからワーカーをforkする。読み込んだモジュールのメモリはワーカー間で共有（copy-on-write）され、
+ワーカーを増やしても1ワーカーあたりの増分は処理中のデータ分だけになる
+（ワーカーごとの実メモリは benchmarks/bench_gunicorn_memory.py で計る）
+
+スレッドプール・Driveのservice・SQLite・HTTPクライアントはfork後に各ワーカーで作り直す
+（各モジュールの os.register_at_fork を参照）
+"""
+import gc
+import os
+
+# preloadでは起動時にまとめて読み込む（config読み込み前に決める）
+os.environ.setdefault('LAZY_IMPORTS', '0' if os.environ.get('GUNICORN_PRELOAD', '1') == '1' else '1')
+
+from config import (  # noqa: E402
+    GUNICORN_BIND, GUNICORN_WORKERS, GUNICORN_THREADS, GUNICORN_TIMEOUT, GUNICORN_PRELOAD, GUNICORN_GC_FREEZE,
+)
+
+bind = GUNICORN_BIND
+workers = GUNICORN_WORKERS
+worker_class = 'gthread'
+threads = GUNICORN_THREADS
+timeout = GUNICORN_TIMEOUT
+preload_app = GUNICORN_PRELOAD
+
+if GUNICORN_PRELOAD and GUNICORN_GC_FREEZE:
+    # 親プロセスでは読み込み中のGCを止める（解放で空いた隙間への割り当てで共有ページが書き換わらないように）
+    gc.disable()
+
+def pre_fork(server, worker):
+    if GUNICORN_PRELOAD and GUNICORN_GC_FREEZE:
+        # ここまでに作られたオブジェクトをGCの対象から外す（子プロセスのGCが参照カウント以外で触らない）
+        gc.freeze()
+
+def post_fork(server, worker):
+    if GUNICORN_PRELOAD and GUNICORN_GC_FREEZE:
+        gc.enable()
+    # 翌日分の準備はWebhookを待たずに始める（準備そのものは1ワーカーだけが行う）
+    from handlers.scheduler import ensure_scheduler
+    ensure_scheduler()
+
+def child_exit(server, worker):
+    # 複数ワーカーのメトリクス（PROMETHEUS_MULTIPROC_DIR）から終了したワーカーのゲージを外す
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
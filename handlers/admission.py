@@ -0,0 +1,297 @@
+# handlers/admission.py
+"""
+Webhookの受付制御（handle_webhookの振り分けの手前で行う）
+
+注文（text / image / pdf）と管理コマンド（集計サマリ作成等・設定ファイルのアップロード）で別々の処理枠を持ち、
+写真が大量に届いてもコマンドは注文の後ろに並ばない
+
+  - 処理枠（同時実行数）が空いていればすぐ処理する
+  - 空いていなければ待ち行列に入り、締め切りの早い順に処理枠をもらう
+    締め切りはイベントの発生時刻（LINEのtimestamp）＋最長待ち時間。再送・遅れて届いたイベントほど先に処理する
+  - 待ち行列が満杯・締め切りまでに順番が来ない見込み・締め切り切れなら、スプール（handlers/spool.py）に積んで200を返す
+    （ワーカーを使い切ってLINEの再送をタイムアウトさせるより、後で確実に処理する）
+
+スプールはプロセスごとのスレッド（SPOOL_DRAIN_WORKERS、最初のWebhookで起動）が、
+処理枠に空きがあり誰も待っていない時だけ取り出して処理する（コマンドを先に取り出す）
+
+到着から締め切り（注文はORDER_DEADLINE_SECONDS・コマンドはCOMMAND_DEADLINE_SECONDS）までを handlers/resilience.py に渡す。
+処理中に外部サービスが遮断中・締め切り切れ（Unavailable）で先へ進めなければ、これもスプールに積んで後で処理する
+（遮断中ならブレーカーが試せるようになるまで取り出さない）
+
+既定では無効（ADMISSION_ENABLED=0。Webhookはそのまま処理する）。有効にするには
+ADMISSION_ENABLED=1 と、スプールを置く永続ディスク上のSPOOL_PATH（既定はORDER_LEDGER_PATH）を指定する（未指定なら起動時にエラー）
+"""
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from handlers.metrics import request_span, ADMISSION_WAIT_SECONDS, ADMISSION_SPOOLED_TOTAL, SPOOL_PROCESSED_TOTAL
+from handlers.llm_client import usage_scope
+from handlers.diagnostics import trace_scope, log
+from handlers.resilience import Unavailable, CircuitOpenError, deadline_scope, breaker_status
+from config import (
+    ADMISSION_ENABLED, ORDER_DEADLINE_SECONDS, COMMAND_DEADLINE_SECONDS,
+    ADMISSION_ORDER_CONCURRENCY, ADMISSION_ORDER_MAX_QUEUE, ADMISSION_ORDER_MAX_WAIT_SECONDS,
+    ADMISSION_COMMAND_CONCURRENCY, ADMISSION_COMMAND_MAX_QUEUE, ADMISSION_COMMAND_MAX_WAIT_SECONDS,
+    SPOOL_DRAIN_WORKERS, SPOOL_POLL_SECONDS,
+)
+
+ORDER_KINDS = {'text', 'image', 'pdf'}
+# スプールから取り出す順（コマンドを先に）
+DRAIN_ORDER = ('command', 'order')
+# 処理時間の指数移動平均の重み
+SERVICE_TIME_ALPHA = 0.2
+
+class WorkQueue:
+    """1種類の処理枠（同時実行数limit・待ち行列max_queue・最長待ちmax_wait秒）"""
+
+    def __init__(self, name, limit, max_queue, max_wait):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._running = 0
+        self._waiting = []  # (締め切り, 到着順) のヒープ
+        self._seq = itertools.count()
+        self._service_seconds = None
+
+    def _expected_wait(self, position):
+        # 待ち行列のposition番目（0始まり）が処理枠をもらうまでの見込み（処理中の分も1件分待つとみなす）
+        if self._service_seconds is None:
+            return 0.0
+        return (position // self.limit + 1) * self._service_seconds
+
+    def acquire(self, age=0.0):
+        """
+        処理枠を取る。取れたらNone、取れずにスプールへ回す時はその理由（'queue_full' / 'deadline'）
+        age: イベントの発生からの経過秒数（締め切り = 発生時刻＋max_wait）
+        """
+        deadline = time.monotonic() + self.max_wait - max(0.0, age)
+        with self._cond:
+            if self._running < self.limit and not self._waiting:
+                self._running += 1
+                return None
+            if len(self._waiting) >= self.max_queue:
+                return 'queue_full'
+            # 自分より締め切りの早い待ちの後ろに並ぶ
+            position = sum(1 for waiting_deadline, _ in self._waiting if waiting_deadline <= deadline)
+            if time.monotonic() + self._expected_wait(position) > deadline:
+                return 'deadline'
+            entry = (deadline, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            while not (self._waiting[0] == entry and self._running < self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                    return 'deadline'
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiting)
+            self._running += 1
+            # 枠が複数空いていれば次の待ちも起こす
+            self._cond.notify_all()
+            return None
+
+    def try_acquire_idle(self):
+        """空きがあり誰も待っていない時だけ処理枠を取る（スプールの処理用。Webhookの待ちを優先する）"""
+        with self._cond:
+            if self._running < self.limit and not self._waiting:
+                self._running += 1
+                return True
+            return False
+
+    def release(self, service_seconds=None):
+        with self._cond:
+            self._running -= 1
+            if service_seconds is not None:
+                if self._service_seconds is None:
+                    self._service_seconds = service_seconds
+                else:
+                    self._service_seconds += SERVICE_TIME_ALPHA * (service_seconds - self._service_seconds)
+            self._cond.notify_all()
+
+    def status(self):
+        with self._cond:
+            return {
+                'running': self._running,
+                'waiting': len(self._waiting),
+                'limit': self.limit,
+                'max_queue': self.max_queue,
+                'max_wait_seconds': self.max_wait,
+                'service_seconds': round(self._service_seconds, 3) if self._service_seconds is not None else None,
+            }
+
+def _build_queues():
+    return {
+        'order': WorkQueue(
+            'order', ADMISSION_ORDER_CONCURRENCY, ADMISSION_ORDER_MAX_QUEUE, ADMISSION_ORDER_MAX_WAIT_SECONDS,
+        ),
+        'command': WorkQueue(
+            'command', ADMISSION_COMMAND_CONCURRENCY, ADMISSION_COMMAND_MAX_QUEUE, ADMISSION_COMMAND_MAX_WAIT_SECONDS,
+        ),
+    }
+
+_queues = _build_queues()
+_drainer_started = False
+_drainer_lock = threading.Lock()
+
+def _reset_after_fork():
+    # 待ち・処理中の数とスプール処理スレッドはプロセスごと（gunicornのpreload）
+    global _queues, _drainer_started, _drainer_lock
+    _queues = _build_queues()
+    _drainer_started = False
+    _drainer_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def work_class(kind):
+    return 'order' if kind in ORDER_KINDS else 'command'
+
+def deadline_seconds(kind):
+    # 受付制御が無効なら締め切りなし（締め切り切れの注文を積むスプールを使わない）
+    if not ADMISSION_ENABLED:
+        return 0
+    return ORDER_DEADLINE_SECONDS if work_class(kind) == 'order' else COMMAND_DEADLINE_SECONDS
+
+def event_age(data):
+    """イベントの発生（LINEのtimestamp、ミリ秒）からの経過秒数（なければ0）"""
+    events = (data or {}).get('events') or [{}]
+    timestamp = events[0].get('timestamp')
+    if not isinstance(timestamp, (int, float)):
+        return 0.0
+    return max(0.0, time.time() - timestamp / 1000)
+
+def admit(kind, data, handler):
+    """
+    処理枠を取ってhandler(data)を実行する。取れない・外部サービスが使えなければスプールに積んで ('OK', 200) を返す
+    受付制御が無効ならそのまま実行し、外部サービスが使えなければ503を返す
+    """
+    if not ADMISSION_ENABLED or kind == 'empty':
+        try:
+            return handler(data)
+        except Unavailable as e:
+            return defer(data, kind, e)
+    _ensure_drainer()
+    name = work_class(kind)
+    queue = _queues[name]
+    with deadline_scope(deadline_seconds(kind)):
+        started = time.monotonic()
+        reason = queue.acquire(event_age(data))
+        ADMISSION_WAIT_SECONDS.labels(name).observe(time.monotonic() - started)
+        if reason is not None:
+            return _spool(data, kind, name, reason)
+        started = time.monotonic()
+        try:
+            return handler(data)
+        except Unavailable as e:
+            return defer(data, kind, e)
+        finally:
+            queue.release(time.monotonic() - started)
+
+def defer(data, kind, error):
+    """外部サービスが使えずに処理できなかったWebhookをスプールに積む（遮断中ならブレーカーが試せるようになってから）"""
+    if not ADMISSION_ENABLED:
+        # スプールを使わない設定では、LINEの再送に任せる
+        log(logging.WARNING, 'webhook_unavailable', kind=kind, reason=error.reason, error=str(error))
+        return 'Service Unavailable', 503
+    _ensure_drainer()
+    return _spool(data, kind, work_class(kind), error.reason, delay=error.retry_after)
+
+def _spool(data, kind, name, reason, delay=0):
+    from handlers import spool
+    from handlers.webhook_handler import event_source
+    event_id, _ = event_source(data)
+    try:
+        added = spool.enqueue(data, kind, name, reason, event_id, delay=delay)
+    except Exception as e:
+        # 積めなければ503を返してLINEの再送に任せる
+        log(logging.ERROR, 'admission_spool_error', kind=kind, work_class=name, event_id=event_id, error=str(e))
+        return 'Service Unavailable', 503
+    ADMISSION_SPOOLED_TOTAL.labels(name, reason).inc()
+    log(logging.WARNING, 'admission_spooled', kind=kind, work_class=name, reason=reason,
+        event_id=event_id, duplicate=not added)
+    return 'OK', 200
+
+def _ensure_drainer():
+    global _drainer_started
+    if _drainer_started:
+        return
+    with _drainer_lock:
+        if _drainer_started:
+            return
+        for i in range(SPOOL_DRAIN_WORKERS):
+            threading.Thread(target=_drain_loop, name=f'spool-drain-{i}', daemon=True).start()
+        _drainer_started = True
+
+def _drain_loop():
+    from handlers import spool
+    last_recovered = 0
+    while True:
+        try:
+            if time.monotonic() - last_recovered > 60:
+                last_recovered = time.monotonic()
+                recovered = spool.recover_stale()
+                if recovered:
+                    log(logging.WARNING, 'spool_recovered', count=recovered)
+            if not drain_once():
+                time.sleep(SPOOL_POLL_SECONDS)
+        except Exception as e:
+            log(logging.ERROR, 'spool_drain_error', error=str(e))
+            time.sleep(SPOOL_POLL_SECONDS)
+
+def drain_once():
+    """空いている処理枠でスプールから1件処理する（処理したらTrue）"""
+    from handlers import spool
+    for name in DRAIN_ORDER:
+        queue = _queues[name]
+        if not queue.try_acquire_idle():
+            continue
+        started = time.monotonic()
+        item = None
+        try:
+            item = spool.claim(name)
+            if item is not None:
+                _process_spooled(name, *item)
+        finally:
+            queue.release(time.monotonic() - started if item is not None else None)
+        if item is not None:
+            return True
+    return False
+
+def _process_spooled(name, spool_id, kind, data, attempt):
+    from handlers import spool
+    from handlers.webhook_handler import handle_webhook_data, event_source
+    event_id, user_id = event_source(data)
+    try:
+        with request_span(kind), usage_scope(event_id, user_id), trace_scope(kind), \
+                deadline_scope(deadline_seconds(kind)):
+            handle_webhook_data(data)
+    except CircuitOpenError as e:
+        # 遮断中は試行回数に数えず、ブレーカーが試せるようになってから取り出す
+        spool.defer(spool_id, e, e.retry_after)
+        SPOOL_PROCESSED_TOTAL.labels(name, 'deferred').inc()
+        log(logging.WARNING, 'spool_process_deferred', kind=kind, event_id=event_id, attempt=attempt, error=str(e))
+        return
+    except Exception as e:
+        spool.fail(spool_id, e)
+        SPOOL_PROCESSED_TOTAL.labels(name, 'error').inc()
+        log(logging.ERROR, 'spool_process_error', kind=kind, event_id=event_id, attempt=attempt, error=str(e))
+        return
+    spool.complete(spool_id)
+    SPOOL_PROCESSED_TOTAL.labels(name, 'ok').inc()
+    log(logging.INFO, 'spool_processed', kind=kind, event_id=event_id, attempt=attempt)
+
+def admission_status():
+    """処理枠ごとの処理中・待ちの数と、スプールの件数・外部サービスのブレーカーの状態"""
+    from handlers import spool
+    return {
+        'enabled': ADMISSION_ENABLED,
+        'queues': {name: queue.status() for name, queue in _queues.items()},
+        'spool': {f'{work_class}/{state}': count for (work_class, state), count in spool.depth().items()},
+        'breakers': breaker_status(),
+    }
@@ -0,0 +1,87 @@
+# handlers/async_clients.py
+"""
+ASGI版（asgi_app.py）で使うクライアント
+  LINE（プロフィール・添付の取得）: httpx.AsyncClient
+  OpenAI: AsyncOpenAI（GPT解析） / OpenAI（スレッドで動く集計時の正規化用）
+いずれもプロセスで1つを共有し、終了時にclose_clients()で閉じる
+"""
+import os
+
+import httpx
+
+from config import LINE_API_BASE, LINE_DATA_API_BASE, LINE_HTTP_TIMEOUT
+from handlers.metrics import stage, count_call
+from handlers.llm_client import set_operator
+from handlers.resilience import guard, Unavailable
+from handlers.utils import operator_name_cache
+
+_http = None
+_async_openai = None
+_openai = None
+
+def get_http_client():
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=LINE_HTTP_TIMEOUT, limits=httpx.Limits(max_connections=100))
+    return _http
+
+def get_async_openai():
+    global _async_openai
+    if _async_openai is None:
+        # openaiの読み込みは重いので、最初のGPT解析まで遅らせる
+        from openai import AsyncOpenAI
+        _async_openai = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    return _async_openai
+
+def get_openai():
+    global _openai
+    if _openai is None:
+        from openai import OpenAI
+        _openai = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    return _openai
+
+def _reset_after_fork():
+    # 接続プールはプロセスごとに持つ（forkした子プロセスでは親の接続を使わない）
+    global _http, _async_openai, _openai
+    _http = _async_openai = _openai = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+async def close_clients():
+    global _http, _async_openai, _openai
+    if _http is not None:
+        await _http.aclose()
+    if _async_openai is not None:
+        await _async_openai.close()
+    if _openai is not None:
+        _openai.close()
+    _http = _async_openai = _openai = None
+
+async def get_operator_name_async(user_id, headers):
+    """get_operator_nameのasync版"""
+    try:
+        with stage('operator_name'), guard('line') as timeout:
+            count_call('line')
+            profile_res = await get_http_client().get(
+                f'{LINE_API_BASE}/v2/bot/profile/{user_id}', headers=headers, timeout=timeout,
+            )
+            if profile_res.status_code >= 500:
+                profile_res.raise_for_status()
+        operator_name = profile_res.json().get('displayName', '不明')
+        operator_name_cache[user_id] = operator_name
+    except (Unavailable, httpx.HTTPError) as e:
+        operator_name = operator_name_cache.get(user_id, '不明')
+        print(f"LINEの表示名を取得できません（{operator_name}で続けます）: {e}")
+    set_operator(operator_name)
+    return operator_name
+
+async def get_message_content_async(message_id, headers):
+    """get_message_contentのasync版"""
+    with stage('line_content'), guard('line') as timeout:
+        count_call('line')
+        res = await get_http_client().get(
+            f'{LINE_DATA_API_BASE}/v2/bot/message/{message_id}/content', headers=headers, timeout=timeout,
+        )
+        if res.status_code >= 500:
+            res.raise_for_status()
+    return res.content
@@ -0,0 +1,90 @@
+# handlers/async_webhook_handler.py
+"""
+ASGI版のWebhook処理
+テキスト・画像・PDFの注文は、LINE・OpenAIの待ちをイベントループ上で行い、
+Drive・xlsx処理（同期API・CPU処理）はスレッドに逃がす。コマンド等はwebhook_handlerの処理をそのままスレッドで動かす
+"""
+import asyncio
+import os
+
+from handlers.webhook_handler import handle_webhook_data, event_kind
+from handlers.file_handler import get_order_folders, save_text_to_drive, save_image_to_drive, save_pdf_to_drive
+from handlers.utils import get_now
+from handlers.journal import order_scope
+from handlers.async_clients import (
+    get_async_openai, get_openai, get_operator_name_async, get_message_content_async,
+)
+
+async def process_order_async(event, archive_folder_name, file_ext, save_to_drive, analyze, content=None):
+    """
+    注文1件（テキスト・画像・PDF共通）
+    ユーザー名・保存先フォルダ・添付の取得を同時に始め、原本の保存とGPT解析を並行、集計への追記は両方を待つ
+    contentを渡した場合（テキスト）は添付を取得しない
+    """
+    with order_scope(event):
+        await _process_order(event, archive_folder_name, file_ext, save_to_drive, analyze, content)
+
+async def _process_order(event, archive_folder_name, file_ext, save_to_drive, analyze, content):
+    from handlers.csv_handler import prepare_order_rows, append_order_rows
+    user_id = event['source']['userId']
+    headers = {'Authorization': f'Bearer {os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")}'}
+    now, now_str, now_verbose = get_now()
+    file_name = now.strftime('%Y%m%d_%H%M') + file_ext
+
+    operator = asyncio.ensure_future(get_operator_name_async(user_id, headers))
+    folders = asyncio.ensure_future(asyncio.to_thread(get_order_folders, now.strftime('%Y%m%d'), archive_folder_name))
+    try:
+        if content is None:
+            content = await get_message_content_async(event['message']['id'], headers)
+
+        async def save_original():
+            archive_folder_id, _ = await folders
+            await asyncio.to_thread(save_to_drive, content, file_name, archive_folder_id)
+
+        async def extract():
+            # 解析した行はその場で注文のジャーナルに記録する（原本の保存が失敗しても残す）
+            structured_text = await analyze(content, await operator, now_str, now_verbose, get_async_openai())
+            return await asyncio.to_thread(prepare_order_rows, structured_text)
+
+        # 片方が失敗しても、もう片方（特に解析と記録）は最後まで待つ
+        results = await asyncio.gather(save_original(), extract(), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        _, csv_folder_id = await folders
+        await asyncio.to_thread(append_order_rows, results[1], csv_folder_id, get_openai())
+    finally:
+        # 途中で失敗した時に、取得中のものを放置しない
+        for future in (operator, folders):
+            if not future.done():
+                future.cancel()
+
+# 解析側（pandas・pdf2image等）は webhook_handler と同じく最初のメッセージで読み込む
+async def process_text_message_async(event):
+    from handlers.text_handler import analyze_text_with_gpt_async
+    await process_order_async(
+        event, 'Line画像保存', '.txt', save_text_to_drive, analyze_text_with_gpt_async, content=event['message']['text'],
+    )
+
+async def process_image_message_async(event):
+    from handlers.image_handler import analyze_image_with_gpt_async
+    await process_order_async(event, 'Line画像保存', '.jpg', save_image_to_drive, analyze_image_with_gpt_async)
+
+async def process_pdf_message_async(event):
+    from handlers.pdf_handler import analyze_pdf_with_gpt_async
+    await process_order_async(event, 'PDF保存', '.pdf', save_pdf_to_drive, analyze_pdf_with_gpt_async)
+
+ASYNC_PROCESSORS = {
+    'text': process_text_message_async,
+    'image': process_image_message_async,
+    'pdf': process_pdf_message_async,
+}
+
+async def handle_webhook_async(data):
+    """Webhook本文（dict）を処理して (本文, ステータス) を返す"""
+    processor = ASYNC_PROCESSORS.get(event_kind(data))
+    if processor is None:
+        # コマンド・設定ファイルのアップロード等は同期版の処理をスレッドで
+        return await asyncio.to_thread(handle_webhook_data, data)
+    await processor(data['events'][0])
+    return 'OK', 200
@@ -0,0 +1,144 @@
+# handlers/carryover_handler.py
+"""
+受注残・注文残の繰り越しストア（SQLite、受注台帳と同じDBファイル）
+日を締めるたびに、その日の注文・注文リストのうち納品希望日が翌日以降の行を受付日付きで積み、
+何日前の受付分でも前日以前のxlsxをDLせずに受注残・注文残へ繰り越せるようにする
+"""
+import pandas as pd
+
+from handlers.ledger_handler import get_connection, ensure_schema, to_text, LEDGER_ORDER_COLUMNS
+from config import ORDER_LEDGER_PATH
+
+CARRYOVER_ORDER_COLUMNS = LEDGER_ORDER_COLUMNS
+CARRYOVER_PURCHASE_COLUMNS = ["商品名", "サイズ", "数量", "単位", "納品希望日", "備考", "税率", "発注先", "郵便番号", "住所"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backlog_orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    受付日 TEXT NOT NULL,
+    顧客 TEXT,
+    発注者 TEXT,
+    商品名 TEXT,
+    サイズ TEXT,
+    数量 REAL,
+    単位 TEXT,
+    納品希望日 TEXT,
+    納品場所 TEXT,
+    時間 TEXT,
+    社内担当者 TEXT,
+    備考 TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_backlog_orders_delivery ON backlog_orders(納品希望日, 受付日);
+CREATE INDEX IF NOT EXISTS idx_backlog_orders_day ON backlog_orders(受付日);
+CREATE TABLE IF NOT EXISTS backlog_purchases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    受付日 TEXT NOT NULL,
+    商品名 TEXT,
+    サイズ TEXT,
+    数量 REAL,
+    単位 TEXT,
+    納品希望日 TEXT,
+    備考 TEXT,
+    税率 TEXT,
+    発注先 TEXT,
+    郵便番号 TEXT,
+    住所 TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_backlog_purchases_delivery ON backlog_purchases(納品希望日, 受付日);
+CREATE INDEX IF NOT EXISTS idx_backlog_purchases_day ON backlog_purchases(受付日);
+CREATE TABLE IF NOT EXISTS closed_days (
+    受付日 TEXT PRIMARY KEY,
+    受注残 INTEGER,
+    注文残 INTEGER
+);
+"""
+
+_TABLES = {
+    'orders': ('backlog_orders', CARRYOVER_ORDER_COLUMNS),
+    'purchases': ('backlog_purchases', CARRYOVER_PURCHASE_COLUMNS),
+}
+
+def _connection(conn=None):
+    if conn is not None:
+        # 呼び出し側が渡した接続（パスがわからないので毎回。IF NOT EXISTSなので何度流してもよい）
+        conn.executescript(_SCHEMA)
+        return conn
+    conn = get_connection()
+    ensure_schema(conn, ORDER_LEDGER_PATH, _SCHEMA)
+    return conn
+
+def _open_records(day, df, columns):
+    """dfのうち納品希望日がdayより後の行を、受付日付きのレコードにする"""
+    if df.empty:
+        return []
+    records = []
+    for row in df.to_dict('records'):
+        values = [to_text(row.get(c)) for c in columns]
+        if values[columns.index('納品希望日')] <= day:
+            continue
+        qty = pd.to_numeric(row.get('数量'), errors='coerce')
+        values[columns.index('数量')] = 0.0 if pd.isnull(qty) else float(qty)
+        records.append([day] + values)
+    return records
+
+def close_day(day, orders_df, purchases_df=None, conn=None):
+    """
+    dayを締める: その日の受付分（生データ・注文リスト）のうち未納品の行を繰り越しストアに積む
+    同じ日を締め直した場合は、その日の分を入れ替える（何度呼んでも結果は同じ）
+    Noneを渡した側（注文リスト未作成など）は、その日の既存の分をそのまま残す
+    納品希望日がdayより前の行はどの日の残にもならないので、ここで削除する
+    戻り値: (受注残の行数, 注文残の行数)
+    """
+    conn = _connection(conn)
+    counts = []
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for kind, df in (('orders', orders_df), ('purchases', purchases_df)):
+            table, columns = _TABLES[kind]
+            conn.execute(f"DELETE FROM {table} WHERE 納品希望日 < ?", (day,))
+            if df is None:
+                counts.append(conn.execute(f"SELECT COUNT(*) FROM {table} WHERE 受付日 = ?", (day,)).fetchone()[0])
+                continue
+            records = _open_records(day, df, columns)
+            conn.execute(f"DELETE FROM {table} WHERE 受付日 = ?", (day,))
+            placeholders = ", ".join(["?"] * (len(columns) + 1))
+            conn.executemany(
+                f"INSERT INTO {table} (受付日, {', '.join(columns)}) VALUES ({placeholders})",
+                records
+            )
+            counts.append(len(records))
+        conn.execute(
+            "INSERT OR REPLACE INTO closed_days (受付日, 受注残, 注文残) VALUES (?, ?, ?)",
+            (day, counts[0], counts[1])
+        )
+    return tuple(counts)
+
+def has_history(day, conn=None):
+    """dayより前に締めた日があるか（なければ繰り越しストアは空とみなす）"""
+    conn = _connection(conn)
+    return conn.execute("SELECT 1 FROM closed_days WHERE 受付日 < ? LIMIT 1", (day,)).fetchone() is not None
+
+def is_closed(day, conn=None):
+    """dayを締めたか（受注残と発注残の作成済み）"""
+    conn = _connection(conn)
+    return conn.execute("SELECT 1 FROM closed_days WHERE 受付日 = ?", (day,)).fetchone() is not None
+
+def carried(kind, day, delivery_from, delivery_to=None, conn=None):
+    """
+    day より前に受け付けた未納品分（kind: 'orders' = 受注残 / 'purchases' = 注文残）
+    納品希望日が delivery_from 以降（delivery_to を指定すればその日まで）の行を受付順に返す
+    """
+    conn = _connection(conn)
+    table, columns = _TABLES[kind]
+    where, params = "受付日 < ? AND 納品希望日 >= ?", [day, delivery_from]
+    if delivery_to is not None:
+        where += " AND 納品希望日 <= ?"
+        params.append(delivery_to)
+    cur = conn.execute(
+        f"SELECT {', '.join(columns)} FROM {table} WHERE {where} ORDER BY 受付日, id",
+        params
+    )
+    df = pd.DataFrame(cur.fetchall(), columns=columns)
+    # 整数の数量はシート上で「5.0」にならないよう整数に戻す
+    df['数量'] = df['数量'].map(lambda q: int(q) if float(q).is_integer() else q).astype(object)
+    return df
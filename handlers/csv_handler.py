@@ -1,10 +1,14 @@
 import pandas as pd
+import hashlib
 import io
-from handlers.file_handler import drive_service
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
-from config import CSV_FORMAT_PATH, SHARED_DRIVE_ID, ORDER_SUMMARY_FOLDER_ID
+from handlers.storage import get_storage
+from handlers.metrics import stage
+from handlers.llm_client import chat_completion
+from handlers.resilience import Unavailable, stage_budget
+from handlers.diagnostics import diag, diagnostics_enabled
+from config import CSV_FORMAT_PATH, ORDER_SUMMARY_FOLDER_ID, ORDER_LEDGER_ENABLED
 import pytz
-from datetime import datetime
+from datetime import datetime, timedelta
 import unicodedata
 import os
 from openpyxl import Workbook, load_workbook
@@ -12,17 +16,38 @@ import jaconv  # ひらがな→カタカナ正規化用
 from openai import OpenAI  # 新しいOpenAIクライアント
 from .prompt_templates import normalize_product_name_prompt
 import re
-import shutil
-from handlers.file_handler import get_or_create_folder
-from openpyxl.utils import get_column_letter
-from openpyxl.cell.cell import MergedCell
+import time
+from itertools import chain
+from handlers.file_handler import (
+    get_or_create_folder, find_file_id, download_file_bytes, upload_file_to_drive, upload_bytes_to_drive,
+    workbook_create_lock,
+)
+from handlers import ledger_handler, carryover_handler, journal
+from handlers.workbook_session import (
+    autofit_columns, column_widths, frame_rows, frame_from_rows,
+    is_large_workbook, write_workbook_streaming, WorkbookSession,
+)
+from handlers.order_sheet_handler import generate_order_sheets
 
 CSV_HEADERS = pd.read_csv(CSV_FORMAT_PATH, encoding='utf-8').columns.tolist()
 JST = pytz.timezone('Asia/Tokyo')
+SUMMARY_COLUMNS = ['顧客', '発注者', '商品名', 'サイズ', '数量', '単位', '納品希望日', '納品場所', '時間', '社内担当者', '備考']
+SUMMARY_SHEET_NAME = "集計結果サマリ"
+# 集計結果サマリの元になる集計値を保持する非表示シート
+SUMMARY_CACHE_SHEET = "集計キャッシュ"
+SUMMARY_CACHE_HEADERS = ['集計キー', '商品名', 'サイズ', '単位', '納品希望日', '備考', '数量', '補正']
+# 集計キーの各要素と、groupbyの'first'相当で保持する列
+SUMMARY_KEY_COLUMNS = ['商品名', 'サイズ', '単位', '納品希望日']
+SUMMARY_FIRST_COLUMNS = SUMMARY_KEY_COLUMNS + ['備考']
+# 集計キャッシュが生データと合っているかを確かめるダイジェストの対象列（集計に使う列）
+SUMMARY_DIGEST_COLUMNS = SUMMARY_FIRST_COLUMNS + ['数量']
+# 注文リスト（備考と発注先の間に税率）
+ORDER_LIST_HEADERS = ["商品名", "サイズ", "数量", "単位", "納品希望日", "備考", "税率", "発注先", "郵便番号", "住所"]
 
 def normalize_product_name_ai(product_name, openai_client):
-    # 生成AIでカタカナ統一
-    response = openai_client.chat.completions.create(
+    # 生成AIでカタカナ統一（OpenAIが遮断中・締め切り切れならUnavailableを上へ伝え、注文ごと後でやり直す）
+    response = chat_completion(
+        openai_client,
         model="gpt-4o",
         messages=[
             {"role": "system", "content": normalize_product_name_prompt},
@@ -65,7 +90,8 @@ def normalize_unit_ai(product_name, unit, quantity, openai_client):
     from .prompt_templates import normalize_unit_prompt
     content = f"商品名: {product_name}\n単位: {unit}\n数量: {quantity}"
     try:
-        response = openai_client.chat.completions.create(
+        response = chat_completion(
+            openai_client,
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": normalize_unit_prompt},
@@ -75,19 +101,22 @@ def normalize_unit_ai(product_name, unit, quantity, openai_client):
             temperature=0
         )
         result = response.choices[0].message.content.strip()
-        # --- 返答が空、問い合わせ文そのもの、異常系なら元のunitを返す ---
-        if (not result or 
-            result.startswith("商品名:") or 
-            result.startswith("単位:") or 
-            "単位" in result or 
-            "商品名" in result or 
-            len(result) > 10):  # "kg"や"玉"など一般的な単位は2～4文字程度
-            return normalize_unit_postprocess(unit)
-        # 返答も正規化
-        return normalize_unit_postprocess(result)
+    except Unavailable:
+        # OpenAIが遮断中・締め切り切れは商品名と同じく上へ伝える（元の単位で集計すると後の集計キーと合わない）
+        raise
     except Exception as e:
         print(f"[AI単位正規化エラー] {e} 元の単位({unit})を返却します")
         return normalize_unit_postprocess(unit)
+    # --- 返答が空、問い合わせ文そのもの、異常系なら元のunitを返す ---
+    if (not result or 
+        result.startswith("商品名:") or 
+        result.startswith("単位:") or 
+        "単位" in result or 
+        "商品名" in result or 
+        len(result) > 10):  # "kg"や"玉"など一般的な単位は2～4文字程度
+        return normalize_unit_postprocess(unit)
+    # 返答も正規化
+    return normalize_unit_postprocess(result)
 
 # 必要に応じてOpenAIクライアントをDI
 def normalize_row(row, openai_client):
@@ -129,17 +158,41 @@ def adjust_quantity_and_unit(quantity, unit):
 
 def append_to_xlsx(structured_text, parent_id, openai_client):
     """ 構造化テキストを.xlsxで保存・追記し、Driveに反映（備考コメントなしバージョン） """
+    append_order_rows(prepare_order_rows(structured_text), parent_id, openai_client)
+
+def prepare_order_rows(structured_text):
+    """
+    構造化テキストを注文行にし、注文のジャーナルに記録して (受付日, 注文行) を返す（読めなければNone）
+    抽出と同じタスクで呼ぶ（Driveのフォルダ取得が失敗しても、抽出した行はジャーナルに残る）
+    """
     if not structured_text.strip():
         with open("/tmp/failed_structured_text.txt", "w", encoding="utf-8") as f:
             f.write("No structured_text received!\n")
         print("No structured_text received! ログを保存しました。")
-        return
+        journal.record_failed('extract', 'empty structured text')
+        return None
 
     today = datetime.now(JST).strftime('%Y%m%d')
-    filename = f'集計結果_{today}.xlsx'
-    file_path = f'/tmp/{filename}'
+    new_data = parse_structured_text(structured_text, today, datetime.now(JST).strftime('%Y%m%d%H'))
+    if new_data is None:
+        journal.record_failed('parse', 'no valid rows', structured_text)
+        return None
+    journal.record_rows(today, new_data)
+    return today, new_data
+
+def append_order_rows(prepared, parent_id, openai_client):
+    """prepare_order_rowsの結果を集計に書き込み、ジャーナルに書き込み済みを記録する"""
+    if prepared is None:
+        return
+    today, new_data = prepared
+    append_orders(new_data, parent_id, openai_client, today)
+    journal.record_flushed([journal.current_order_id()])
 
-    # 構造化テキスト → DataFrame化
+def parse_structured_text(structured_text, today, now_str):
+    """
+    構造化テキストの有効行（列数が揃っている行）を注文DataFrameにする
+    時間列はnow_str（YYYYMMDDHH）で上書き。有効行がない・パースできない場合はログを残してNone
+    """
     lines = structured_text.strip().splitlines()
     valid_lines = []
     for line in lines:
@@ -174,90 +227,109 @@ def append_to_xlsx(structured_text, parent_id, openai_client):
             f.write(structured_text)
         return
 
-    now_str = datetime.now(JST).strftime('%Y%m%d%H')
     new_data['時間'] = now_str
+    return new_data
 
-    # Drive上の既存ファイル取得＆マージ
-    print("\n【デバッグ】Drive全体で見える同名ファイル一覧:")
-    all_results = drive_service.files().list(
-        q=f"name='{filename}' and trashed = false",
-        fields="files(id, name, parents, owners)",
-        pageSize=10,
-        driveId=SHARED_DRIVE_ID,
-        corpora='drive',
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True
-    ).execute()
-    all_files = all_results.get('files', [])
-    for f in all_files:
-        print(f"ファイル名: {f['name']}, ファイルID: {f['id']}, 親: {f.get('parents')}, オーナー: {f['owners'][0]['displayName'] if f.get('owners') else '-'}")
-
-    query = f"name = '{filename}' and '{parent_id}' in parents and trashed = false"
-    response = drive_service.files().list(
-        q=query,
-        fields='files(id, name, parents, owners)',
-        driveId=SHARED_DRIVE_ID,
-        corpora='drive',
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True
-    ).execute()
-    files = response.get('files', [])
-    print(f"【デバッグ】指定親フォルダ {parent_id} で見つかったファイル数: {len(files)}")
-    for f in files:
-        print(f"【デバッグ】指定親: ファイル名: {f['name']}, ファイルID: {f['id']}, 親: {f.get('parents')}, オーナー: {f['owners'][0]['displayName'] if f.get('owners') else '?'}")
-
-    main_sheet_name = f'集計結果_{today}'
-    if files:
-        file_id = files[0]['id']
-        request = drive_service.files().get_media(
-            fileId=file_id,
-            supportsAllDrives=True
-        )
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-        fh.seek(0)
-        # 全シート読み込み
-        xl = pd.read_excel(fh, sheet_name=None)
-        if main_sheet_name in xl:
-            existing = xl[main_sheet_name]
-            combined = pd.concat([existing, new_data], ignore_index=True)
-        else:
-            combined = new_data
-    else:
-        combined = new_data
+def append_orders(new_data, parent_id, openai_client, today):
+    """
+    パース済みの注文行を集計結果_{today}.xlsxへ追記してDriveに反映する（台帳モードでは台帳へ）
+    複数ファイル分をまとめて渡せば、DL・正規化・アップロードは1回で済む
+    """
+    filename = f'集計結果_{today}.xlsx'
+    file_path = f'/tmp/{filename}'
+
+    if ORDER_LEDGER_ENABLED:
+        # 台帳に書き込むだけ。xlsxは必要になった時に台帳から描き出す
+        ensure_ledger_day(today, parent_id)
+        df_norm = normalize_summary_rows(new_data, openai_client)
+        with stage('ledger_insert'):
+            count = ledger_handler.insert_orders(today, df_norm)
+        print(f"受注台帳に{count}行追加しました（{today}）")
+        return
 
-    # サマリも含めたxlsxで保存＆Drive反映
-    from .csv_handler import xlsx_with_summary_update  # 必要に応じて調整
-    xlsx_with_summary_update(combined, file_path, openai_client)
+    # Drive上の既存ファイル取得＆マージ
+    with stage('workbook_download'):
+        storage = get_storage()
+        if diagnostics_enabled():
+            # 別フォルダに同名の集計結果ができていないかの確認（Driveへの問い合わせが1回増えるので診断時だけ）
+            diag('summary_file_drive_wide', filename=filename,
+                 files=[{'id': f['id'], 'parents': f.get('parents')} for f in storage.list_files(name=filename)])
+
+        files = storage.list_files(parent_id, name=filename)
+        diag('summary_file_in_folder', filename=filename, parent_id=parent_id,
+             files=[{'id': f['id'], 'parents': f.get('parents')} for f in files])
+
+        file_id = files[0]['id'] if files else None
+        if file_id:
+            _download_workbook(file_id, file_path)
+    if file_id:
+        _append_and_upload(new_data, file_path, filename, parent_id, file_id, openai_client)
+        return
+    # 日付最初の注文: 翌日分の準備（seed_day_workbook）と作成を排他し、ロックを取ってから探し直す
+    with workbook_create_lock():
+        file_id = find_file_id(filename, parent_id)
+        if file_id:
+            with stage('workbook_download'):
+                _download_workbook(file_id, file_path)
+        elif os.path.exists(file_path):
+            # 前回処理の残骸を今日のファイルとして使わない
+            os.remove(file_path)
+        _append_and_upload(new_data, file_path, filename, parent_id, file_id, openai_client)
+
+def day_has_orders(day, parent_id):
+    """受付日dayの注文がすでに集計結果_{day}.xlsxの生データ（台帳モードでは台帳）にあるか"""
+    if ORDER_LEDGER_ENABLED:
+        ensure_ledger_day(day, parent_id)
+        return not ledger_handler.orders_for_day(day).empty
+    session = WorkbookSession.open(f'集計結果_{day}.xlsx', parent_id)
+    raw_sheet_name = f'集計結果_{day}'
+    return session is not None and session.has_sheet(raw_sheet_name) and not session.sheet(raw_sheet_name).empty
+
+def replace_orders(new_data, parent_id, openai_client, day):
+    """
+    受付日dayの注文行をnew_dataで置き換える（一括再抽出用。追記すると元の注文と二重になる）
+    集計結果xlsxでは生データシートを置き換えて集計結果サマリ・集計キャッシュを作り直し、台帳モードでは台帳の日を入れ替える
+    """
+    if ORDER_LEDGER_ENABLED:
+        ensure_ledger_day(day, parent_id)
+        df_norm = normalize_summary_rows(new_data, openai_client)
+        with stage('ledger_insert'):
+            count = ledger_handler.replace_day(day, df_norm, source='backfill')
+        print(f"受注台帳の{day}分を{count}行で置き換えました")
+        return
+    session = WorkbookSession.open(f'集計結果_{day}.xlsx', parent_id)
+    if session is None:
+        append_orders(new_data, parent_id, openai_client, day)
+        return
+    raw_sheet_name = f'集計結果_{day}'
+    session.set_sheet(raw_sheet_name, new_data)
+    update_summary_in_session(session, raw_sheet_name, openai_client)
+    session.save()
+    print(f"{session.file_name}の生データを{len(new_data)}行で置き換えました")
+
+def _download_workbook(file_id, file_path):
+    with open(file_path, 'wb') as f:
+        f.write(download_file_bytes(file_id))
+
+def _append_and_upload(new_data, file_path, filename, parent_id, file_id, openai_client):
+    # 新規行だけ正規化・集計してxlsxに追記＆Drive反映
+    xlsx_with_summary_append(new_data, file_path, openai_client)
     try:
-        media = MediaFileUpload(file_path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        if files:
-            drive_service.files().update(
-                fileId=file_id,
-                media_body=media,
-                supportsAllDrives=True
-            ).execute()
-        else:
-            file_metadata = {'name': filename, 'parents': [parent_id]}
-            drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                supportsAllDrives=True
-            ).execute()
+        with stage('workbook_upload'):
+            upload_file_to_drive(file_path, filename, parent_id, file_id=file_id)
         print(f"Excelファイル作成成功: {file_path}")
     except Exception as e:
+        # 呼び出し元（ジャーナル）で書き込み待ちのまま残すため、失敗は上へ伝える
         print("Excelファイル作成/アップロードエラー:", e)
+        raise
 
-def xlsx_with_summary_update(df, xlsx_path, openai_client):
+@stage('normalize')
+@stage_budget('normalize')
+def normalize_summary_rows(df, openai_client):
     """
-    1シート目: 生データ
-    2シート目: 商品名・サイズ・単位・納品希望日ごとの集計サマリ
-    ※顧客、発注者、納品場所、時間、社内担当者はサマリ側は空欄に
+    生データ1行ずつを正規化し、サマリ用の列構成のDataFrameにする（数量は数値型）
+    注文の締め切りのうち正規化の分を使い切ったらUnavailableを上へ伝える（ジャーナル・スプールから後でやり直す）
     """
-    # --- 正規化 ---
     normalized_rows = []
     for _, row in df.iterrows():
         # 正規化ロジック（各自のプロジェクトで実装。ここは例）
@@ -279,47 +351,171 @@ def xlsx_with_summary_update(df, xlsx_path, openai_client):
             "社内担当者": row.get("社内担当者", ""),
             "備考": row.get("備考", "")
         })
-    df_norm = pd.DataFrame(normalized_rows)
-
+    df_norm = pd.DataFrame(normalized_rows, columns=SUMMARY_COLUMNS)
     # --- 数量は必ず数値型で ---
     df_norm['数量'] = pd.to_numeric(df_norm['数量'], errors='coerce').fillna(0)
+    return df_norm
 
-    # --- 集計キー（納品希望日も追加） ---
-    df_norm['集計キー'] = (
-        df_norm['商品名'].astype(str) + "_" +
-        df_norm['サイズ'].astype(str) + "_" +
-        df_norm['単位'].astype(str) + "_" +
-        df_norm['納品希望日'].astype(str)
-    )
+def _key_part(value):
+    # 欠損は'nan'、Excel読み戻しでfloat化した整数（20250702.0）は整数表記に揃える
+    if value is None or (isinstance(value, float) and pd.isnull(value)):
+        return "nan"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
 
-    # --- サマリ生成 ---
-    summary = (
-        df_norm.groupby('集計キー', as_index=False)
-        .agg({
-            '顧客': lambda x: "",
-            '発注者': lambda x: "",
-            '商品名': 'first',
-            'サイズ': 'first',
-            '数量': 'sum',      # ← 数値として合計！
-            '単位': 'first',
-            '納品希望日': 'first',
-            '納品場所': lambda x: "",
-            '時間': lambda x: "",
-            '社内担当者': lambda x: "",
-            '備考': 'first'
+def summary_key(product_name, size, unit, delivery_date):
+    """集計キー（商品名_サイズ_単位_納品希望日）"""
+    return "_".join(_key_part(v) for v in (product_name, size, unit, delivery_date))
+
+def update_summary_aggregate(aggregate, df_norm):
+    """
+    正規化済みの行を集計に加算する（処理量は追加行数分のみ）
+    aggregate: {集計キー: {商品名, サイズ, 単位, 納品希望日, 備考, 数量, 補正}}
+    groupby(...).agg({'数量': 'sum', 他: 'first'}) と同じ結果になるように、
+    'first'は最初の非欠損値を残し、数量はpandasと同じKahan加算で足し込む
+    """
+    if df_norm.empty:
+        return aggregate
+    quantities = pd.to_numeric(df_norm['数量'], errors='coerce').fillna(0).astype(float)
+    columns = [df_norm[c] if c in df_norm.columns else pd.Series([None] * len(df_norm)) for c in SUMMARY_FIRST_COLUMNS]
+    for qty, *values in zip(quantities, *columns):
+        key = summary_key(*values[:len(SUMMARY_KEY_COLUMNS)])
+        entry = aggregate.get(key)
+        if entry is None:
+            entry = {c: None for c in SUMMARY_FIRST_COLUMNS}
+            entry['数量'] = 0.0
+            entry['補正'] = 0.0
+            aggregate[key] = entry
+        for col, value in zip(SUMMARY_FIRST_COLUMNS, values):
+            if pd.isnull(entry[col]) and not pd.isnull(value):
+                entry[col] = value
+        y = qty - entry['補正']
+        t = entry['数量'] + y
+        entry['補正'] = t - entry['数量'] - y
+        entry['数量'] = t
+    return aggregate
+
+def build_summary_aggregate(df_norm):
+    """生データ全体から集計を作り直す"""
+    return update_summary_aggregate({}, df_norm)
+
+def summary_df_from_aggregate(aggregate):
+    """集計から「集計結果サマリ」シートのDataFrameを作る（groupby→商品名ソートと同じ並び）"""
+    rows = []
+    for key in sorted(aggregate):
+        entry = aggregate[key]
+        rows.append({
+            '顧客': "",
+            '発注者': "",
+            '商品名': entry['商品名'],
+            'サイズ': entry['サイズ'],
+            '数量': entry['数量'],
+            '単位': entry['単位'],
+            '納品希望日': entry['納品希望日'],
+            '納品場所': "",
+            '時間': "",
+            '社内担当者': "",
+            '備考': entry['備考']
         })
-    )
-    summary = summary[['顧客', '発注者', '商品名', 'サイズ', '数量', '単位', '納品希望日', '納品場所', '時間', '社内担当者', '備考']]
-    summary = summary.sort_values('商品名')
+    summary = pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+    if not summary.empty and summary['数量'].map(float.is_integer).all():
+        summary['数量'] = summary['数量'].astype(int)
+    return summary.sort_values('商品名')
 
-    # --- xlsx出力 ---
+def _digest_part(value):
+    if value is None or value == '' or (isinstance(value, float) and pd.isnull(value)):
+        return ''
+    return _key_part(value)
+
+def raw_rows_digest(rows, header, hasher=None):
+    """
+    生データ行の集計に使う列（集計キー・備考・数量）のダイジェスト（hashlibのオブジェクト。追記分はhasherに続けて足す）
+    xlsxへの書き込み・読み戻しで型が変わっても（20250702.0 / '20250702'、空文字→空セル）同じ値になるよう揃える
+    """
+    hasher = hasher or hashlib.sha1()
+    header = list(header)
+    positions = [header.index(c) if c in header else None for c in SUMMARY_DIGEST_COLUMNS]
+    for row in rows:
+        parts = [_digest_part(row[i]) if i is not None and i < len(row) else '' for i in positions]
+        hasher.update(('\x1f'.join(parts) + '\x1e').encode('utf-8'))
+    return hasher
+
+def frame_digest(df):
+    return raw_rows_digest(df.itertuples(index=False, name=None), df.columns).hexdigest()
+
+def load_summary_aggregate(wb):
+    """
+    非表示の集計キャッシュシートを読み込む
+    戻り値: (aggregate, 集計済みの生データ行数, 生データのダイジェスト)。キャッシュがなければ (None, 0, None)
+    """
+    if SUMMARY_CACHE_SHEET not in wb.sheetnames:
+        return None, 0, None
+    rows = list(wb[SUMMARY_CACHE_SHEET].iter_rows(values_only=True))
+    if len(rows) < 2 or list(rows[1][:len(SUMMARY_CACHE_HEADERS)]) != SUMMARY_CACHE_HEADERS:
+        return None, 0, None
+    aggregated_rows = rows[0][1] or 0
+    # ダイジェストのない以前のキャッシュは、次の追記で作り直す
+    digest = rows[0][2] if len(rows[0]) > 2 else None
+    aggregate = {}
+    for r in rows[2:]:
+        if r[0] is None:
+            continue
+        entry = dict(zip(SUMMARY_CACHE_HEADERS[1:], r[1:]))
+        entry['数量'] = float(entry['数量'] or 0)
+        entry['補正'] = float(entry['補正'] or 0)
+        aggregate[str(r[0])] = entry
+    return aggregate, int(aggregated_rows), digest
+
+def summary_cache_rows(aggregate, aggregated_rows, digest):
+    """集計キャッシュシートの行（1行目: 集計済み行数と生データのダイジェスト、2行目: ヘッダ）"""
+    yield ['集計済み行数', aggregated_rows, digest]
+    yield SUMMARY_CACHE_HEADERS
+    for key, entry in aggregate.items():
+        yield [key] + [entry[c] for c in SUMMARY_CACHE_HEADERS[1:]]
+
+def save_summary_aggregate(wb, aggregate, aggregated_rows, digest):
+    if SUMMARY_CACHE_SHEET in wb.sheetnames:
+        del wb[SUMMARY_CACHE_SHEET]
+    ws = wb.create_sheet(SUMMARY_CACHE_SHEET)
+    ws.sheet_state = 'hidden'
+    for row in summary_cache_rows(aggregate, aggregated_rows, digest):
+        ws.append(row)
+
+def _write_summary_sheet(wb, summary):
+    if SUMMARY_SHEET_NAME in wb.sheetnames:
+        del wb[SUMMARY_SHEET_NAME]
+    ws_summary = wb.create_sheet(SUMMARY_SHEET_NAME)
+    ws_summary.append(list(summary.columns))
+    for row in summary.itertuples(index=False, name=None):
+        ws_summary.append(row)
+
+def _load_or_create_workbook(xlsx_path):
     # 既存ファイルがあれば読み込み、なければ新規
     try:
-        wb = load_workbook(xlsx_path)
+        return load_workbook(xlsx_path)
     except Exception:
         wb = Workbook()
         if 'Sheet' in wb.sheetnames:
             del wb['Sheet']
+        return wb
+
+def xlsx_with_summary_update(df, xlsx_path, openai_client):
+    """
+    1シート目: 生データ
+    2シート目: 商品名・サイズ・単位・納品希望日ごとの集計サマリ
+    ※顧客、発注者、納品場所、時間、社内担当者はサマリ側は空欄に
+    生データ全体を正規化し直して集計を作り直す（「集計サマリ作成」用）
+    """
+    # --- 正規化 ---
+    df_norm = normalize_summary_rows(df, openai_client)
+
+    # --- サマリ生成（商品名・サイズ・単位・納品希望日ごと） ---
+    aggregate = build_summary_aggregate(df_norm)
+    summary = summary_df_from_aggregate(aggregate)
+
+    # --- xlsx出力 ---
+    wb = _load_or_create_workbook(xlsx_path)
 
     # 元データシート名（例: ファイル名拡張子抜き）
     raw_sheet_name = os.path.splitext(os.path.basename(xlsx_path))[0]
@@ -327,46 +523,176 @@ def xlsx_with_summary_update(df, xlsx_path, openai_client):
         del wb[raw_sheet_name]
 
     ws_raw = wb.create_sheet(raw_sheet_name)
-    ws_raw.append(list(df_norm.columns.drop('集計キー')))
-    for row in df_norm.drop(columns=['集計キー']).itertuples(index=False, name=None):
+    ws_raw.append(list(df_norm.columns))
+    for row in df_norm.itertuples(index=False, name=None):
         ws_raw.append(row)
 
     # サマリシート
-    if "集計結果サマリ" in wb.sheetnames:
-        del wb["集計結果サマリ"]
-    ws_summary = wb.create_sheet("集計結果サマリ")
-    ws_summary.append(list(summary.columns))
-    for row in summary.itertuples(index=False, name=None):
-        ws_summary.append(row)
+    _write_summary_sheet(wb, summary)
+    save_summary_aggregate(wb, aggregate, len(df_norm), frame_digest(df_norm))
 
-    # 列幅自動調整（autofit_columnsがあれば）
-    for ws in wb.worksheets:
-        autofit_columns(ws)
+    # 列幅自動調整（書き換えたシートだけ、書き込んだDataFrameから計算）
+    autofit_columns(ws_raw, df_norm)
+    autofit_columns(wb[SUMMARY_SHEET_NAME], summary)
     wb.save(xlsx_path)
     print(f"集計結果サマリシート付きで {xlsx_path} を作成しました")
 
-def create_order_list_sheet(xlsx_path, tag_xlsx_path):
+def xlsx_with_summary_append(new_df, xlsx_path, openai_client):
     """
-    「集計結果サマリ」→「注文リスト」シートを作成
-    備考と発注先の間に税率（タグ付け表由来）を追加
+    新しく届いた注文行だけを正規化して生データシートに追記し、
+    集計キャッシュに加算して「集計結果サマリ」を描き直す
     """
-    # 必要なヘッダーに「税率」を追加
-    order_headers = ["商品名", "サイズ", "数量", "単位", "納品希望日", "備考", "税率", "発注先", "郵便番号", "住所"]
+    df_new_norm = normalize_summary_rows(new_df, openai_client)
+    with stage('workbook_rewrite'):
+        append_normalized_rows(df_new_norm, xlsx_path)
 
-    # サマリ読み込み
-    wb = load_workbook(xlsx_path)
-    if "集計結果サマリ" not in wb.sheetnames:
-        print("集計結果サマリシートがありません")
-        return False
+def align_to_raw_header(df_new_norm, header):
+    """
+    追記する行を生データシートの見出しの並びに揃える（手で並べ替え・追加された列があっても列名で合わせる）
+    戻り値: (見出し, 揃えたDataFrame)。見出しにない列は見出しの末尾に足す
+    """
+    header = list(header or [])
+    if all(h is None for h in header):
+        header = []
+    header += [c for c in df_new_norm.columns if c not in header]
+    return header, df_new_norm.reindex(columns=header).astype(object).where(lambda df: df.notna(), None)
+
+def append_normalized_rows(df_new_norm, xlsx_path):
+    """正規化済みの注文行を集計結果xlsxへ追記し、サマリと集計キャッシュを更新する"""
+    if os.path.exists(xlsx_path):
+        with open(xlsx_path, 'rb') as f:
+            data = f.read()
+        if is_large_workbook(data):
+            _append_streaming(data, df_new_norm, xlsx_path)
+            return
+
+    wb = _load_or_create_workbook(xlsx_path)
+    raw_sheet_name = os.path.splitext(os.path.basename(xlsx_path))[0]
+    if raw_sheet_name not in wb.sheetnames:
+        wb.create_sheet(raw_sheet_name).append(SUMMARY_COLUMNS)
+    ws_raw = wb[raw_sheet_name]
+    existing_rows = ws_raw.max_row - 1
+    raw_values = ws_raw.iter_rows(values_only=True)
+    header = next(raw_values, SUMMARY_COLUMNS)
+    hasher = raw_rows_digest(raw_values, header)
+    header, df_new_rows = align_to_raw_header(df_new_norm, header)
+    for col, name in enumerate(header, start=1):
+        if ws_raw.cell(row=1, column=col).value != name:
+            ws_raw.cell(row=1, column=col, value=name)
+
+    aggregate, aggregated_rows, digest = load_summary_aggregate(wb)
+    if aggregate is None or aggregated_rows != existing_rows or digest != hasher.hexdigest():
+        # キャッシュがない／生データが手で編集された（行数が同じでも数量・商品名の書き換え）場合は生データから作り直す
+        aggregate = {}
+        if existing_rows > 0:
+            print("集計キャッシュを生データから再構築します")
+            existing = pd.DataFrame(ws_raw.values)
+            existing.columns = existing.iloc[0]
+            existing = existing[1:]
+            aggregate = build_summary_aggregate(existing)
+
+    for row in df_new_rows.itertuples(index=False, name=None):
+        ws_raw.append(row)
+    update_summary_aggregate(aggregate, df_new_norm)
 
-    ws = wb["集計結果サマリ"]
-    summary_df = pd.DataFrame(ws.values)
-    summary_df.columns = summary_df.iloc[0]
-    summary_df = summary_df[1:]
+    summary = summary_df_from_aggregate(aggregate)
+    _write_summary_sheet(wb, summary)
+    raw_rows_digest(df_new_rows.itertuples(index=False, name=None), header, hasher)
+    save_summary_aggregate(wb, aggregate, existing_rows + len(df_new_norm), hasher.hexdigest())
 
-    # タグ付け表読み込み
-    tag_df = pd.read_excel(tag_xlsx_path, dtype=str).fillna("")
+    # 生データは追記分で広がる列だけ広げ、サマリは描き直した内容で合わせる
+    autofit_columns(ws_raw, df_new_rows, grow_only=True)
+    autofit_columns(wb[SUMMARY_SHEET_NAME], summary)
+    wb.save(xlsx_path)
+    print(f"{len(df_new_norm)}行を追記し集計結果サマリを更新しました: {xlsx_path}")
+
+class _CountingRows:
+    """流し読みの行を数えながら渡す"""
+
+    def __init__(self, rows):
+        self._rows = rows
+        self.count = 0
+
+    def __iter__(self):
+        for row in self._rows:
+            self.count += 1
+            yield row
 
+def _raw_data_rows(data, raw_sheet_name):
+    """生データシートの見出しより下の行を流し読みする"""
+    wb = load_workbook(io.BytesIO(data), read_only=True)
+    try:
+        yield from wb[raw_sheet_name].iter_rows(min_row=2, values_only=True)
+    finally:
+        wb.close()
+
+def _append_streaming(data, df_new_norm, xlsx_path):
+    """
+    大きな集計結果xlsxへの追記（月末など）
+    read-onlyで集計キャッシュと生データの行数だけを流し読みし、write-onlyで書き出し直す
+    """
+    raw_sheet_name = os.path.splitext(os.path.basename(xlsx_path))[0]
+    wb = load_workbook(io.BytesIO(data), read_only=True)
+    aggregate, aggregated_rows, digest = load_summary_aggregate(wb)
+    existing_rows = 0
+    hasher = hashlib.sha1()
+    header = None
+    if raw_sheet_name in wb.sheetnames:
+        raw_values = wb[raw_sheet_name].iter_rows(values_only=True)
+        header = next(raw_values, None)
+        if header is not None:
+            counted = _CountingRows(raw_values)
+            raw_rows_digest(counted, header, hasher)
+            existing_rows = counted.count
+    if aggregate is None or aggregated_rows != existing_rows or digest != hasher.hexdigest():
+        print("集計キャッシュを生データから再構築します")
+        aggregate = {}
+        if existing_rows > 0:
+            aggregate = build_summary_aggregate(frame_from_rows(wb[raw_sheet_name].iter_rows(values_only=True)))
+    wb.close()
+
+    update_summary_aggregate(aggregate, df_new_norm)
+    summary = summary_df_from_aggregate(aggregate)
+    new_header, df_new_rows = align_to_raw_header(df_new_norm, header)
+    raw_spec = {'append': df_new_rows.itertuples(index=False, name=None), 'widths': column_widths(df_new_rows)}
+    if existing_rows == 0:
+        raw_spec['rows'] = [new_header]
+    elif new_header != list(header):
+        # 見出しに足りない列があれば、見出しを足して既存の行ごと書き直す
+        raw_spec['rows'] = chain([new_header], _raw_data_rows(data, raw_sheet_name))
+    write_workbook_streaming(xlsx_path, data, {
+        raw_sheet_name: raw_spec,
+        SUMMARY_SHEET_NAME: {
+            'rows': chain([list(summary.columns)], summary.itertuples(index=False, name=None)),
+            'widths': column_widths(summary),
+        },
+        SUMMARY_CACHE_SHEET: {
+            'rows': summary_cache_rows(
+                aggregate, existing_rows + len(df_new_norm),
+                raw_rows_digest(df_new_rows.itertuples(index=False, name=None), new_header, hasher).hexdigest(),
+            ),
+            'hidden': True,
+        },
+    })
+    print(f"{len(df_new_norm)}行を追記し集計結果サマリを更新しました（ストリーミング）: {xlsx_path}")
+
+def format_tax_rate(raw_tax):
+    """タグ付け表の税率（0.08 / 8 / 8%）を「8%」表記にする"""
+    if raw_tax == "":
+        return ""
+    try:
+        tax_float = float(raw_tax)
+        if tax_float < 1.0:
+            return f"{int(round(tax_float * 100))}%"
+        return f"{int(round(tax_float))}%"
+    except Exception:
+        return str(raw_tax)
+
+def build_order_list(summary_df, tag_df):
+    """
+    サマリ（商品名・サイズごとの数量）とタグ付け表から「注文リスト」のDataFrameを作る
+    備考と発注先の間に税率（タグ付け表由来）を追加
+    """
     order_list = []
     for _, row in summary_df.iterrows():
         prod, size = row['商品名'], row['サイズ']
@@ -381,18 +707,7 @@ def create_order_list_sheet(xlsx_path, tag_xlsx_path):
             supplier = match.iloc[0].get('発注先', "")
             zipcode = match.iloc[0].get('郵便番号', "")
             address = match.iloc[0].get('住所', "")
-            raw_tax = match.iloc[0].get('税率', "")
-            if raw_tax != "":
-                try:
-                    tax_float = float(raw_tax)
-                    if tax_float < 1.0:
-                        tax_rate = f"{int(round(tax_float * 100))}%"
-                    else:
-                        tax_rate = f"{int(round(tax_float))}%"
-                except Exception:
-                    tax_rate = str(raw_tax)
-            else:
-                tax_rate = ""
+            tax_rate = format_tax_rate(match.iloc[0].get('税率', ""))
 
         order_list.append([
             prod,
@@ -406,321 +721,257 @@ def create_order_list_sheet(xlsx_path, tag_xlsx_path):
             zipcode,
             address
         ])
+    return pd.DataFrame(order_list, columns=ORDER_LIST_HEADERS)
 
-    # 既存シート削除
-    if "注文リスト" in wb.sheetnames:
-        del wb["注文リスト"]
-
-    ws_order = wb.create_sheet("注文リスト")
-    ws_order.append(order_headers)
-    for r in order_list:
-        ws_order.append(list(r))
+def ensure_ledger_day(day, csv_folder_id):
+    """
+    台帳にdayの分がなければ、Driveの集計結果xlsx（生データシート）から1回だけ取り込む
+    （インスタンス再作成直後などで台帳が空の場合の復元用）
+    """
+    if ledger_handler.has_day(day):
+        return
+    filename = f'集計結果_{day}.xlsx'
+    file_id = find_file_id(filename, csv_folder_id)
+    raw_df = None
+    if file_id:
+        wb = load_workbook(io.BytesIO(download_file_bytes(file_id)), read_only=True)
+        raw_sheet_name = f'集計結果_{day}'
+        if raw_sheet_name in wb.sheetnames:
+            raw_df = pd.DataFrame(wb[raw_sheet_name].values)
+            if not raw_df.empty:
+                raw_df.columns = raw_df.iloc[0]
+                raw_df = raw_df[1:]
+    count = ledger_handler.import_day(day, raw_df, source=filename if file_id else "")
+    if count:
+        print(f"{filename}から受注台帳へ{count}行取り込みました")
+
+def seed_day_workbook(day, csv_folder_id):
+    """
+    dayの集計結果xlsxがなければ、空の生データ・集計結果サマリ・集計キャッシュのシートで作っておく（翌日分の準備用）
+    前日を締め済みなら、前日以前の受付分の残を(前日データ)シートとして入れる（「受注残と発注残の前日データ移行」と同じ内容）
+    前日が未締めなら入れない（締める前の残は不完全なので、当日に移行コマンドで作る）
+    作成は日付最初の注文（append_orders）とロックで排他する（日付をまたいで準備が遅れても二重に作らない）
+    戻り値: {'created': 作成したか, 'carried': (前日データ)シートを入れたか}
+    """
+    with workbook_create_lock():
+        return _seed_day_workbook(day, csv_folder_id)
+
+def _seed_day_workbook(day, csv_folder_id):
+    filename = f'集計結果_{day}.xlsx'
+    if find_file_id(filename, csv_folder_id):
+        return {'created': False, 'carried': False}
+    prev_day = (datetime.strptime(day, "%Y%m%d") - timedelta(days=1)).strftime("%Y%m%d")
+    carry = carryover_handler.is_closed(prev_day)
+
+    wb = Workbook()
+    del wb['Sheet']
+    empty = pd.DataFrame(columns=SUMMARY_COLUMNS)
+    ws_raw = wb.create_sheet(f'集計結果_{day}')
+    ws_raw.append(SUMMARY_COLUMNS)
+    autofit_columns(ws_raw, empty)
+    _write_summary_sheet(wb, empty)
+    save_summary_aggregate(wb, {}, 0, frame_digest(empty))
+    if carry:
+        for kind, sheet_name in (('orders', "受注残(前日データ)"), ('purchases', "注文残(前日データ)")):
+            df = carryover_handler.carried(kind, day, day)
+            ws = wb.create_sheet(sheet_name)
+            for row in frame_rows(df):
+                ws.append(row)
+            autofit_columns(ws, df)
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    upload_bytes_to_drive(buffer.getvalue(), filename, csv_folder_id)
+    print(f"{filename}を準備しました" + ("（前日データ付き）" if carry else ""))
+    return {'created': True, 'carried': carry}
+
+def ledger_order_list(day):
+    """台帳から当日受付分の注文リスト（集計結果サマリ×タグ付け表）を作る"""
+    summary = summary_df_from_aggregate(build_summary_aggregate(ledger_handler.orders_for_day(day)))
+    return build_order_list(summary, ledger_handler.tag_table())
+
+def render_ledger_workbook(day, xlsx_path):
+    """
+    台帳から集計結果_YYYYMMDD.xlsxを描き出す
+    生データ・集計結果サマリ・ピッキングリスト・受注残、タグ付け表があれば注文リスト・注文残も作る
+    """
+    next_day = (datetime.strptime(day, '%Y%m%d') + timedelta(days=1)).strftime('%Y%m%d')
+    raw = ledger_handler.orders_for_day(day)
+    summary = summary_df_from_aggregate(build_summary_aggregate(raw))
+    remains = ledger_handler.order_remains(day, next_day)
+    sheets = {
+        f'集計結果_{day}': raw,
+        SUMMARY_SHEET_NAME: summary,
+        'ピッキングリスト': ledger_handler.picking_list(day),
+        '受注残': remains,
+    }
+    tag_df = ledger_handler.tag_table()
+    if not tag_df.empty:
+        sheets['注文リスト'] = build_order_list(summary, tag_df)
+        remains_summary = summary_df_from_aggregate(build_summary_aggregate(remains))
+        sheets['注文残'] = build_order_list(remains_summary, tag_df)
+
+    # 書式のないシートだけなのでwrite-onlyで流し書きする（列幅は書き込み前に決める）
+    wb = Workbook(write_only=True)
+    for name, df in sheets.items():
+        ws = wb.create_sheet(name)
+        for letter, width in column_widths(df).items():
+            ws.column_dimensions[letter].width = width
+        for row in frame_rows(df):
+            ws.append(row)
+    wb.save(xlsx_path)
+    return list(sheets)
 
-    # セル値を書き換えるときはMergedCellを絶対に触らない
-    for ws in wb.worksheets:
-        for row in ws.iter_rows():
-            for cell in row:
-                if isinstance(cell, MergedCell):
-                    continue  # 結合セルは触らない
+def export_ledger_workbook(day, csv_folder_id):
+    """台帳から集計結果xlsxを描き出してDriveへ反映する"""
+    ensure_ledger_day(day, csv_folder_id)
+    filename = f'集計結果_{day}.xlsx'
+    file_path = f'/tmp/{filename}'
+    with stage('workbook_rewrite'):
+        sheet_names = render_ledger_workbook(day, file_path)
+    with stage('workbook_upload'):
+        file_id = find_file_id(filename, csv_folder_id)
+        upload_file_to_drive(file_path, filename, csv_folder_id, file_id=file_id)
+    print(f"受注台帳から{filename}を出力しました: {', '.join(sheet_names)}")
+    return True
 
-    # 必要に応じて列幅自動調整（関数化している場合はそのまま）
-    for ws in wb.worksheets:
-        if 'autofit_columns' in globals():
-            autofit_columns(ws)
+@stage('build_sheets')
+def create_order_list_sheet(session, tag_xlsx_path):
+    """
+    「集計結果サマリ」→「注文リスト」シートを作成（WorkbookSession上で書き換え）
+    備考と発注先の間に税率（タグ付け表由来）を追加
+    """
+    if not session.has_sheet(SUMMARY_SHEET_NAME):
+        print("集計結果サマリシートがありません")
+        return False
+    summary_df = session.sheet(SUMMARY_SHEET_NAME)
 
-    wb.save(xlsx_path)
+    # タグ付け表読み込み
+    tag_df = pd.read_excel(tag_xlsx_path, dtype=str).fillna("")
+    session.set_sheet("注文リスト", build_order_list(summary_df, tag_df))
     return True
 
-def create_order_sheets(date_id, csv_folder_id, today_str, drive_service):
+@stage('build_sheets')
+def update_summary_in_session(session, raw_sheet_name, openai_client):
     """
-    「注文リスト」シートから、発注先ごとに「注文書フォーマット.xlsx」をコピー・編集し
+    生データシート全体を正規化し直し、生データ・集計結果サマリ・集計キャッシュを書き換える（「集計サマリ作成」用）
+    """
+    df_norm = normalize_summary_rows(session.sheet(raw_sheet_name), openai_client)
+    aggregate = build_summary_aggregate(df_norm)
+    session.set_sheet(raw_sheet_name, df_norm)
+    session.set_sheet(SUMMARY_SHEET_NAME, summary_df_from_aggregate(aggregate))
+    session.set_rows(SUMMARY_CACHE_SHEET, summary_cache_rows(aggregate, len(df_norm), frame_digest(df_norm)), hidden=True)
+
+def create_order_sheets(date_id, csv_folder_id, today_str):
+    """
+    「注文リスト」シートから、発注先ごとに「注文書フォーマット.xlsx」へ記載し
     「注文書_YYYYMMDD_連番.xlsx」ファイルをGoogle Drive「注文書」フォルダへアップロードする
+    フォーマットは1回だけDLし、生成はプロセスプール、アップロードはスレッドプールで並列化
     """
+    started = time.perf_counter()
+
     # 1. 注文書フォーマット.xlsx取得
-    fmt_query = f"name = '注文書フォーマット.xlsx' and trashed = false"
-    fmt_resp = drive_service.files().list(
-        q=fmt_query,
-        fields='files(id)',
-        driveId=SHARED_DRIVE_ID,
-        corpora='drive',
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True
-    ).execute()
-    fmt_files = fmt_resp.get('files', [])
+    fmt_files = get_storage().list_files(name='注文書フォーマット.xlsx')
     if not fmt_files:
         print("注文書フォーマット.xlsxが見つかりません")
         return False
-    fmt_file_id = fmt_files[0]['id']
-
-    # 2. 注文リストシートのDL
-    filename = f'集計結果_{today_str}.xlsx'
-    file_path = f"/tmp/{filename}"
-    query = f"name = '{filename}' and '{csv_folder_id}' in parents and trashed = false"
-    response = drive_service.files().list(
-        q=query,
-        fields='files(id)',
-        driveId=SHARED_DRIVE_ID,
-        corpora='drive',
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True
-    ).execute()
-    files = response.get('files', [])
-    if not files:
-        print("集計ファイルが見つかりません")
-        print("csv_folder_id:", csv_folder_id)
-        return False
-    excel_file_id = files[0]['id']
-    excel_tmp_path = f"/tmp/{filename}"
-    request_dl = drive_service.files().get_media(
-        fileId=excel_file_id,
-        supportsAllDrives=True
-    )
-    with open(excel_tmp_path, 'wb') as fh:
-        downloader = MediaIoBaseDownload(fh, request_dl)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-
-    wb = load_workbook(excel_tmp_path)
-    if "注文リスト" not in wb.sheetnames:
-        print("注文リストシートがありません")
-        return False
-    df = pd.DataFrame(wb["注文リスト"].values)
-    df.columns = df.iloc[0]
-    df = df[1:]
-
-    # 3. 注文書フォルダの作成
-    from handlers.file_handler import get_or_create_folder
-    order_folder_id = get_or_create_folder("注文書", parent_id=date_id)
-
-    # 4. 発注先ごとにグループ
-    grouped = df.groupby("発注先")
-    count = 1
-    for supplier, g in grouped:
-        if not supplier or str(supplier).strip() == "":
-            continue
-
-        # フォーマットファイルをDL＆コピー
-        fmt_tmp_path = f"/tmp/注文書フォーマット.xlsx"
-        fmt_dl = drive_service.files().get_media(fileId=fmt_file_id)
-        with open(fmt_tmp_path, 'wb') as ffmt:
-            downloader = MediaIoBaseDownload(ffmt, fmt_dl)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-
-        dest_name = f"注文書_{today_str}_{count:03d}.xlsx"
-        dest_path = f"/tmp/{dest_name}"
-        shutil.copy(fmt_tmp_path, dest_path)
-
-        # 注文書記載
-        wbo = load_workbook(dest_path)
-        ws = wbo.active
-
-        # B6, B7, B8, P4, B15（B15: 備考など）に書き込む場合はMergedCell判定
-        def safe_set(ws, cell_addr, value):
-            cell = ws[cell_addr]
-            if not isinstance(cell, MergedCell):
-                cell.value = value
-
-        safe_set(ws, "B6", g.iloc[0]["発注先"])
-        safe_set(ws, "B7", g.iloc[0]["郵便番号"])
-        safe_set(ws, "B8", g.iloc[0]["住所"])
-        safe_set(ws, "P4", pd.Timestamp.today().strftime("%Y/%m/%d"))
-
-        # 商品行ループ
-        for i, (_, row) in enumerate(g.iterrows()):
-            row_idx = 20 + i  # 20~34
-            def set_safe(col, value):
-                addr = f"{col}{row_idx}"
-                cell = ws[addr]
-                if not isinstance(cell, MergedCell):
-                    cell.value = value
-
-            set_safe("B", row["商品名"])
-            if "消費税" in g.columns:
-                set_safe("K", "※" if str(row.get("消費税", "")).strip() == "10%" else "")
-            set_safe("L", row["数量"])
-            set_safe("M", row["単位"])
-            set_safe("F", row["サイズ"])
-            orig = row["納品希望日"]
-            if isinstance(orig, str) and len(orig) == 8 and orig.isdigit():
-                dt = datetime.strptime(orig, "%Y%m%d")
-                set_safe("H", dt.strftime("%Y/%m/%d"))
-            else:
-                set_safe("H", orig)
-            if row_idx >= 34:
-                break
-
-        wbo.save(dest_path)
-
-        # Driveへアップロード
-        file_metadata = {'name': dest_name, 'parents': [order_folder_id]}
-        media = MediaFileUpload(dest_path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            supportsAllDrives=True
-        ).execute()
-        count += 1
-
-    return True
+    template_bytes = download_file_bytes(fmt_files[0]['id'])
 
-def create_order_remains_sheet_from_wb(wb):
-    try:
+    # 2. 注文リスト取得（台帳モードでは台帳から、それ以外は集計結果xlsxの注文リストシートから）
+    if ORDER_LEDGER_ENABLED:
+        ensure_ledger_day(today_str, csv_folder_id)
+        df = ledger_order_list(today_str)
+    else:
+        filename = f'集計結果_{today_str}.xlsx'
+        excel_file_id = find_file_id(filename, csv_folder_id)
+        if not excel_file_id:
+            print("集計ファイルが見つかりません")
+            print("csv_folder_id:", csv_folder_id)
+            return False
+        wb = load_workbook(io.BytesIO(download_file_bytes(excel_file_id)), read_only=True)
         if "注文リスト" not in wb.sheetnames:
             print("注文リストシートがありません")
             return False
-        ws_order = wb["注文リスト"]
-        import pandas as pd
-        df = pd.DataFrame(ws_order.values)
+        df = pd.DataFrame(wb["注文リスト"].values)
         df.columns = df.iloc[0]
         df = df[1:]
 
-        # 翌日以降のもの
-        from datetime import datetime, timedelta
-        JST = pytz.timezone('Asia/Tokyo')
-        tomorrow = (datetime.now(JST) + timedelta(days=1)).strftime('%Y%m%d')
-        order_remains = df[df['納品希望日'].apply(lambda x: str(x).isdigit() and str(x) >= tomorrow)]
-
-        # シート上書き
-        if "注文残" in wb.sheetnames:
-            del wb["注文残"]
-        ws_remains = wb.create_sheet("注文残")
-        ws_remains.append(list(df.columns))
-        for row in order_remains.itertuples(index=False, name=None):
-            ws_remains.append(row)
-        print(f"注文残シートを作成: {wb.properties.title or ''}")
-        return True
-    except Exception as e:
-        print(f"注文残シート作成エラー: {e}")
-        return False
+    # 3. 注文書フォルダの作成
+    order_folder_id = get_or_create_folder("注文書", parent_id=date_id)
+
+    # 4. 発注先ごとに生成＆アップロード
+    generate_order_sheets(df, template_bytes, order_folder_id, today_str)
+    print(f"注文書作成 総処理時間: {time.perf_counter() - started:.2f}秒")
+    return True
 
-def migrate_prev_day_sheets_to_today(csv_folder_id, today_str, drive_service):
+def merge_remains(df, prev_df, tomorrow):
     """
-    前日の「受注残」「注文残」シートを今日の集計エクセルに(前日データ)シートとして移行
+    当日分（納品希望日が翌日以降のもの）に前日データの残を足す
+    前日データは当日分の列に揃えてから結合し、重複行を除く
     """
-    # 日付文字列
-    from datetime import datetime, timedelta
-    JST = pytz.timezone('Asia/Tokyo')
-    today = datetime.now(JST)
-    yesterday = today - timedelta(days=1)
-    yesterday_str = yesterday.strftime('%Y%m%d')
-    prev_dt = datetime.strptime(today_str, "%Y%m%d") - timedelta(days=1)
-    prev_str = prev_dt.strftime("%Y%m%d")
-
-    # ファイル名定義
-    today_xlsx = f"集計結果_{today_str}.xlsx"
-    prev_xlsx  = f"集計結果_{prev_str}.xlsx"
-
-    # --- 前日ファイルDL
+    remains = df[df['納品希望日'] >= tomorrow]
+    if prev_df is not None:
+        prev_df = prev_df.reindex(columns=df.columns, fill_value="")
+        prev_add_df = prev_df[prev_df['納品希望日'] >= tomorrow]
+        remains = pd.concat([remains, prev_add_df], ignore_index=True).drop_duplicates()
+    return remains
+
+def seed_carryover(today):
+    """
+    繰り越しストアにtodayより前の締めがなければ、前日の集計結果xlsxの受注残・注文残を1回だけ取り込む
+    （導入直後やインスタンス再作成でストアが空の場合の復元用。以降は前日以前のxlsxをDLしない）
+    """
+    if carryover_handler.has_history(today):
+        return
+    prev_str = (datetime.strptime(today, "%Y%m%d") - timedelta(days=1)).strftime("%Y%m%d")
+    prev_xlsx = f"集計結果_{prev_str}.xlsx"
     root_id = get_or_create_folder('受注集計')
-    yesterday_folder_id = get_or_create_folder(yesterday_str, parent_id=root_id)
-    csv_folder_id_yesterday = get_or_create_folder('集計結果', parent_id=yesterday_folder_id)
-    prev_query = f"name = '{prev_xlsx}' and '{csv_folder_id_yesterday}' in parents and trashed = false"
-    prev_response = drive_service.files().list(
-        q=prev_query,
-        fields='files(id)',
-        driveId=SHARED_DRIVE_ID,
-        corpora='drive',
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True
-    ).execute()
-    prev_files = prev_response.get('files', [])
-    if not prev_files:
+    prev_folder_id = get_or_create_folder(prev_str, parent_id=root_id)
+    prev_csv_folder_id = get_or_create_folder('集計結果', parent_id=prev_folder_id)
+    file_id = find_file_id(prev_xlsx, prev_csv_folder_id)
+    sheets = {}
+    if file_id:
+        wb = load_workbook(io.BytesIO(download_file_bytes(file_id)), read_only=True)
+        for name in ("受注残", "注文残"):
+            if name in wb.sheetnames:
+                sheets[name] = frame_from_rows(wb[name].iter_rows(values_only=True))
+        wb.close()
+    else:
         print("前日分の集計結果ファイルがありません")
+    counts = carryover_handler.close_day(prev_str, sheets.get("受注残"), sheets.get("注文残"))
+    print(f"{prev_xlsx}から繰り越しストアへ取り込みました: 受注残{counts[0]}行 / 注文残{counts[1]}行")
+
+def carried_picking(today):
+    """前日以前に受け付けた、納品希望日が当日の注文（ピッキングリストに足す分）"""
+    seed_carryover(today)
+    return carryover_handler.carried('orders', today, today, today)
+
+@stage('build_sheets')
+def create_remains_sheets(session, main_sheet_name, today, tomorrow):
+    """
+    受注残（生データ＋前日以前の受付分の残）と注文残（注文リスト＋前日以前の残）を作成
+    前日以前の分は繰り越しストアから読み、当日分で当日を締めてストアを更新する
+    WorkbookSession上で書き換え、注文残を作れたかどうかを返す
+    """
+    seed_carryover(today)
+    main_df = session.sheet(main_sheet_name)
+    session.set_sheet('受注残', merge_remains(main_df, carryover_handler.carried('orders', today, tomorrow), tomorrow))
+
+    order_list = session.sheet("注文リスト") if session.has_sheet("注文リスト") else None
+    counts = carryover_handler.close_day(today, main_df, order_list)
+    print(f"{today}を締めました: 繰り越し 受注残{counts[0]}行 / 注文残{counts[1]}行")
+    if order_list is None:
+        print("注文リストシートがありません")
         return False
-    prev_file_id = prev_files[0]['id']
-    prev_tmp_path = f"/tmp/{prev_xlsx}"
-    request_dl = drive_service.files().get_media(
-        fileId=prev_file_id,
-        supportsAllDrives=True
-    )
-    with open(prev_tmp_path, 'wb') as fh:
-        downloader = MediaIoBaseDownload(fh, request_dl)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-    prev_wb = load_workbook(prev_tmp_path)
-
-    # --- 当日ファイルDL or 新規作成
-    today_query = f"name = '{today_xlsx}' and '{csv_folder_id}' in parents and trashed = false"
-    today_response = drive_service.files().list(
-        q=today_query,
-        fields='files(id)',
-        driveId=SHARED_DRIVE_ID,
-        corpora='drive',
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True
-    ).execute()
-    today_files = today_response.get('files', [])
-    today_tmp_path = f"/tmp/{today_xlsx}"
-
-    if today_files:
-        today_file_id = today_files[0]['id']
-        request_dl = drive_service.files().get_media(
-            fileId=prev_file_id,
-            supportsAllDrives=True
-        )
-        with open(today_tmp_path, 'wb') as fh:
-            downloader = MediaIoBaseDownload(fh, request_dl)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-        today_wb = load_workbook(today_tmp_path)
-    else:
-        # 新規作成
-        today_wb = load_workbook(prev_tmp_path)  # 前日ファイルをコピーして新ファイルにしてもOK
-        # あるいは空ブックでも良いが、必要なシート名・ヘッダ構成に注意
-
-    # --- コピー対象シート
-    for src_name, dst_name in [("受注残", "受注残(前日データ)"), ("注文残", "注文残(前日データ)")]:
-        if src_name in prev_wb.sheetnames:
-            # 既存で当日側にあれば削除
-            if dst_name in today_wb.sheetnames:
-                std = today_wb[dst_name]
-                today_wb.remove(std)
-            ws_prev = prev_wb[src_name]
-            # データをリスト化
-            data = list(ws_prev.values)
-            # 新規シート作成
-            ws_today = today_wb.create_sheet(dst_name)
-            for row in data:
-                ws_today.append(row)
-        else:
-            print(f"前日ファイルに{src_name}シートがありません")
-
-    # --- 保存・再アップロード
-    for ws in today_wb.worksheets:
-        autofit_columns(ws)
-    today_wb.save(today_tmp_path)
-    media = MediaFileUpload(today_tmp_path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    if today_files:
-        drive_service.files().update(
-            fileId=today_file_id,
-            media_body=media,
-            supportsAllDrives=True
-        ).execute()
-    else:
-        file_metadata = {'name': today_xlsx, 'parents': [csv_folder_id]}
-        drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            supportsAllDrives=True
-        ).execute()
-    print("前日データ移行シートを作成・アップロード完了")
+    session.set_sheet('注文残', merge_remains(order_list, carryover_handler.carried('purchases', today, tomorrow), tomorrow))
     return True
 
-def autofit_columns(ws):
-    for column in ws.columns:
-        max_length = 0
-        column = list(column)
-        for cell in column:
-            try:
-                cell_length = len(str(cell.value)) if cell.value is not None else 0
-                if cell_length > max_length:
-                    max_length = cell_length
-            except:
-                pass
-        adjusted_width = ( max_length + 2 ) * 2  # 余白も考慮
-        ws.column_dimensions[get_column_letter(column[0].column)].width = adjusted_width
\ No newline at end of file
+@stage('build_sheets')
+def migrate_prev_day_sheets_to_today(session, today):
+    """
+    前日以前に受け付けた受注残・注文残（何日前の分でも）を当日の集計エクセルに(前日データ)シートとして書き出す
+    繰り越しストアから読むので前日以前のxlsxはDLしない
+    """
+    seed_carryover(today)
+    for kind, dst_name in (('orders', "受注残(前日データ)"), ('purchases', "注文残(前日データ)")):
+        session.set_sheet(dst_name, carryover_handler.carried(kind, today, today))
+    return True
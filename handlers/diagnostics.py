@@ -0,0 +1,106 @@
+# handlers/diagnostics.py
+"""
+構造化ログ（レベル付き）と、診断用の重い確認処理のゲート
+
+  log(level, event, **fields) : 'line_webhook'ロガーへ出す。LOG_LEVEL / LOG_FORMAT（text: key=value / json: 1行1JSON）
+  trace_scope(kind, force)    : Webhook1件分。DIAGNOSTICS_SAMPLE_RATEの確率（forceならこの1件は必ず）でトレース対象にする
+  diagnostics_enabled()       : DIAGNOSTICS_ENABLED=1 か、実行中のWebhookがトレース対象ならTrue
+  diag(event, **fields)       : 診断ログ。diagnostics_enabled()の時だけ出す
+
+Driveへの追加の問い合わせのように診断のためだけに行う処理は、diagnostics_enabled()がTrueの時だけ行う
+"""
+import json
+import logging
+import random
+import sys
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+from config import LOG_LEVEL, LOG_FORMAT, DIAGNOSTICS_ENABLED, DIAGNOSTICS_SAMPLE_RATE
+from handlers.task_graph import register_context
+
+logger = logging.getLogger('line_webhook')
+
+class StructuredFormatter(logging.Formatter):
+    """extra={'fields': {...}} を key=value（text）または1行のJSON（json）で出す"""
+
+    def __init__(self, fmt='text'):
+        super().__init__()
+        self.fmt = fmt
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        ts = datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds')
+        if self.fmt == 'json':
+            return json.dumps(
+                {'ts': ts, 'level': record.levelname, 'event': record.getMessage(), **fields},
+                ensure_ascii=False, default=str,
+            )
+        pairs = ' '.join(f'{k}={_text(v)}' for k, v in fields.items())
+        return f'{ts} {record.levelname} {record.getMessage()} {pairs}'.rstrip()
+
+def _text(value):
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    text = str(value)
+    return json.dumps(text, ensure_ascii=False) if (' ' in text or not text) else text
+
+def _configure():
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(StructuredFormatter(LOG_FORMAT))
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL.upper())
+    # gunicornのルートロガー設定と二重に出さない
+    logger.propagate = False
+
+_configure()
+
+# 実行中のWebhookのトレースID（トレース対象でなければNone）
+_trace_id = ContextVar('diagnostics_trace_id', default=None)
+
+@contextmanager
+def trace_scope(kind, force=False):
+    """Webhook1件分。トレース対象にするかをここで決める"""
+    traced = force or (DIAGNOSTICS_SAMPLE_RATE > 0 and random.random() < DIAGNOSTICS_SAMPLE_RATE)
+    token = _trace_id.set(uuid.uuid4().hex[:12] if traced else None)
+    if traced:
+        log(logging.INFO, 'trace_start', kind=kind)
+    try:
+        yield
+    finally:
+        if traced:
+            log(logging.INFO, 'trace_end', kind=kind)
+        _trace_id.reset(token)
+
+def current_trace_id():
+    return _trace_id.get()
+
+register_context(_trace_id.get, _trace_id.set)
+
+def diagnostics_enabled():
+    """診断用の確認処理を行うか（フラグ、または実行中のWebhookがトレース対象）"""
+    return DIAGNOSTICS_ENABLED or current_trace_id() is not None
+
+def log(level, event, **fields):
+    """構造化ログ（トレース中ならtrace_idを付ける）"""
+    if not logger.isEnabledFor(level):
+        return
+    trace_id = current_trace_id()
+    if trace_id:
+        fields = {'trace_id': trace_id, **fields}
+    logger.log(level, event, extra={'fields': fields})
+
+def diag(event, **fields):
+    """診断ログ。diagnostics_enabled()の時だけ、LOG_LEVELに関係なく出す"""
+    if not diagnostics_enabled():
+        return
+    trace_id = current_trace_id()
+    if trace_id:
+        fields = {'trace_id': trace_id, **fields}
+    logger.handle(logger.makeRecord(
+        logger.name, logging.DEBUG, '(diag)', 0, event, None, None, extra={'fields': fields},
+    ))
@@ -1,100 +1,136 @@
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from config import SERVICE_ACCOUNT_FILE, SCOPES, SHARED_DRIVE_ID, ORDER_SUMMARY_FOLDER_ID
-from google.oauth2 import service_account
+from config import ORDER_SUMMARY_FOLDER_ID, FOLDER_LOCK_PATH, WORKBOOK_LOCK_PATH
+from handlers.storage import get_storage
+from handlers.metrics import stage
+from contextlib import contextmanager
+import fcntl
 import os
+import threading
+import unicodedata
 
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE, scopes=SCOPES
-)
-drive_service = build('drive', 'v3', credentials=credentials)
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# 保存先（Drive / ローカル）はhandlers/storage.pyのget_storage()で切り替える。
+# Driveの実装はスレッドごとにserviceを持つので、以下の関数は並列に呼んでよい
+
+# (親フォルダID, フォルダ名) → フォルダID。受注集計・日付・保存先のフォルダは一度できれば変わらないので、プロセス内で覚えておく
+_folder_ids = {}
+_folder_create_lock = threading.Lock()
+_workbook_create_lock = threading.Lock()
 
 def get_or_create_folder(folder_name, parent_id=ORDER_SUMMARY_FOLDER_ID):
-    # クエリは共有ドライブ直下またはサブフォルダを対象
-    if parent_id:
-        query = f"name = '{folder_name}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false and '{parent_id}' in parents"
-    else:
-        # 共有ドライブ直下を指定する場合（rootではなく、ドライブIDとcorporaをdriveで指定）
-        query = f"name = '{folder_name}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false and 'root' in parents"
-
-    response = drive_service.files().list(
-        q=query,
-        fields='files(id, name)',
-        driveId=SHARED_DRIVE_ID,
-        corpora='drive',
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True
-    ).execute()
-    files = response.get('files', [])
-    if files:
-        return files[0]['id']
-
-    file_metadata = {
-        'name': folder_name,
-        'mimeType': 'application/vnd.google-apps.folder'
-    }
-    if parent_id:
-        file_metadata['parents'] = [parent_id]
-
-    folder = drive_service.files().create(
-        body=file_metadata,
-        fields='id',
-        supportsAllDrives=True
-    ).execute()
-    return folder['id']
+    # 親フォルダ直下（parent_idが空なら共有ドライブ直下）の同名フォルダ。なければ作成
+    key = (parent_id, folder_name)
+    folder_id = _folder_ids.get(key)
+    if folder_id:
+        return folder_id
+    storage = get_storage()
+    folder_id = storage.find_folder(folder_name, parent_id)
+    if not folder_id:
+        # 日付が変わって最初のメッセージが同時に届いても二重に作らないよう、
+        # 作成はスレッド間・プロセス間（gunicornの各ワーカー、FOLDER_LOCK_PATH）で排他し、ロックを取ってから探し直す
+        with _folder_create_lock, open(FOLDER_LOCK_PATH, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            folder_id = storage.find_folder(folder_name, parent_id) or storage.create_folder(folder_name, parent_id)
+    _folder_ids[key] = folder_id
+    return folder_id
+
+@contextmanager
+def workbook_create_lock():
+    """
+    集計結果xlsxの新規作成を、スレッド間・プロセス間（WORKBOOK_LOCK_PATH）で排他する
+    日付最初の注文（csv_handler.append_orders）と翌日分の準備（seed_day_workbook）が使い、ロックを取ってから探し直す
+    """
+    with _workbook_create_lock, open(WORKBOOK_LOCK_PATH, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+@stage('drive_folders')
+def get_order_folders(day, archive_folder_name):
+    """受注集計＞{day}＞{archive_folder_name}（原本の保存先）と 受注集計＞{day}＞集計結果 のIDを返す"""
+    root_id = get_or_create_folder('受注集計')
+    date_id = get_or_create_folder(day, parent_id=root_id)
+    archive_folder_id = get_or_create_folder(archive_folder_name, parent_id=date_id)
+    csv_folder_id = get_or_create_folder('集計結果', parent_id=date_id)
+    return archive_folder_id, csv_folder_id
 
+def get_summary_folder(day):
+    """受注集計＞{day}＞集計結果 のID（ジャーナルの再書き込み用。原本の保存先は作らない）"""
+    root_id = get_or_create_folder('受注集計')
+    date_id = get_or_create_folder(day, parent_id=root_id)
+    return get_or_create_folder('集計結果', parent_id=date_id)
+
+@stage('unique_filename')
 def get_unique_filename(file_name, folder_id):
     """必ず_3桁連番（_001, _002...）でファイル名を返す"""
     base, ext = os.path.splitext(file_name)
+    existing = {f['name'] for f in get_storage().list_files(folder_id)}
     for i in range(1, 1000):
         new_name = f"{base}_{i:03d}{ext}"
-        query = f"name = '{new_name}' and '{folder_id}' in parents and trashed = false"
-        res = drive_service.files().list(
-            q=query,
-            fields='files(id)',
-            driveId=SHARED_DRIVE_ID,
-            corpora='drive',
-            includeItemsFromAllDrives=True,
-            supportsAllDrives=True
-        ).execute()
-        if not res.get('files'):
+        if new_name not in existing:
             return new_name
     raise Exception("Unique filename could not be determined (too many duplicates).")
 
 def save_image_to_drive(image_data, file_name, folder_id):
     unique_name = get_unique_filename(file_name, folder_id)
-    file_path = f"/tmp/{unique_name}"
-    with open(file_path, 'wb') as f:
-        f.write(image_data)
-    file_metadata = {'name': unique_name, 'parents': [folder_id]}
-    media = MediaFileUpload(file_path, mimetype='image/jpeg')
-    drive_service.files().create(
-        body=file_metadata,
-        media_body=media,
-        supportsAllDrives=True
-    ).execute()
-    os.remove(file_path)
+    with stage('save_original'):
+        get_storage().upload(image_data, unique_name, folder_id, 'image/jpeg')
 
 def save_text_to_drive(text, file_name, folder_id):
     unique_name = get_unique_filename(file_name, folder_id)
-    file_path = f"/tmp/{unique_name}"
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(text)
-    file_metadata = {'name': unique_name, 'parents': [folder_id]}
-    media = MediaFileUpload(file_path, mimetype='text/plain')
-    drive_service.files().create(
-        body=file_metadata, media_body=media, supportsAllDrives=True
-    ).execute()
-    os.remove(file_path)
+    with stage('save_original'):
+        get_storage().upload(text.encode('utf-8'), unique_name, folder_id, 'text/plain')
 
 def save_pdf_to_drive(pdf_data, file_name, folder_id):
     unique_name = get_unique_filename(file_name, folder_id)
-    file_path = f"/tmp/{unique_name}"
-    with open(file_path, 'wb') as f:
-        f.write(pdf_data)
-    file_metadata = {'name': unique_name, 'parents': [folder_id]}
-    media = MediaFileUpload(file_path, mimetype='application/pdf')
-    drive_service.files().create(
-        body=file_metadata, media_body=media, supportsAllDrives=True
-    ).execute()
-    os.remove(file_path)
+    with stage('save_original'):
+        get_storage().upload(pdf_data, unique_name, folder_id, 'application/pdf')
+
+def find_file_id(file_name, folder_id):
+    """フォルダ直下の同名ファイルIDを返す（なければNone）"""
+    files = get_storage().list_files(folder_id, name=file_name)
+    return files[0]['id'] if files else None
+
+def find_folder_id(folder_name, parent_id):
+    """親フォルダ直下の同名フォルダIDを返す（なければNone、作成はしない）"""
+    return get_storage().find_folder(folder_name, parent_id)
+
+def list_child_folders(parent_id):
+    """親フォルダ直下のフォルダを {フォルダ名: ID} で返す（ページングして全件）"""
+    return get_storage().list_folders(parent_id)
+
+def list_folder_files(folder_id):
+    """フォルダ直下のファイル（フォルダ以外）を [{'id', 'name'}] で返す（ページングして全件）"""
+    return get_storage().list_files(folder_id)
+
+def download_file_bytes(file_id):
+    """ファイルをメモリにDLしてbytesで返す"""
+    return get_storage().download(file_id)
+
+def upload_bytes_to_drive(data, file_name, folder_id, mimetype=XLSX_MIMETYPE, file_id=None):
+    """bytesを一時ファイルを介さず反映（file_idがあれば上書き、なければ新規作成）し、ファイルIDを返す"""
+    if file_id:
+        return get_storage().update(file_id, data, mimetype)
+    return get_storage().upload(data, file_name, folder_id, mimetype)
+
+def upload_file_to_drive(file_path, file_name, folder_id, file_id=None, mimetype=XLSX_MIMETYPE):
+    """ローカルファイルを反映（file_idがあれば上書き、なければ新規作成）し、ファイルIDを返す"""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    return upload_bytes_to_drive(data, file_name, folder_id, mimetype, file_id=file_id)
+
+def download_tag_table(root_id, tag_xlsx_path):
+    """受注集計直下のタグ付け表.xlsxをDLする（見つからなければFalse）"""
+    # 「親フォルダ直下の全ファイル」一括取得し、Python側で正規化比較
+    target_name = unicodedata.normalize('NFC', 'タグ付け表.xlsx')
+    tag_file_id = None
+    for f in get_storage().list_files(root_id):
+        f_name = unicodedata.normalize('NFC', f['name'])
+        if f_name == target_name:
+            tag_file_id = f['id']
+            break
+    if not tag_file_id:
+        return False
+
+    with open(tag_xlsx_path, 'wb') as ftag:
+        ftag.write(download_file_bytes(tag_file_id))
+    return True
@@ -1,75 +1,100 @@
 # handlers/image_handler.py
 import os
 import base64
-import requests
 from openai import OpenAI
 from .prompt_templates import IMAGE_ORDER_PROMPT
-from handlers.file_handler import get_or_create_folder, save_image_to_drive
-from handlers.csv_handler import append_to_xlsx
-from handlers.utils import get_now, get_operator_name
+from handlers.file_handler import get_order_folders, save_image_to_drive
+from handlers.csv_handler import prepare_order_rows, append_order_rows
+from handlers.utils import get_now, get_operator_name, get_message_content, clean_order_content
+from handlers.metrics import stage
+from handlers.llm_client import chat_completion, achat_completion
+from handlers.resilience import stage_budget
+from handlers.task_graph import TaskGraph
 
-def analyze_image_with_gpt(image_path, operator_name, now_str, now_verbose, openai_client, max_retries=3):
-    with open(image_path, "rb") as image_file:
-        image_base64 = base64.b64encode(image_file.read()).decode("utf-8")
+def image_order_messages(image_base64, operator_name, now_str, now_verbose):
+    """注文画像（JPEGのbase64）をEXCEL形式に変換させるメッセージ（PDFのページ画像も同じ）"""
     prompt = IMAGE_ORDER_PROMPT.format(
         now_verbose=now_verbose,
         operator_name=operator_name,
         now_str=now_str
     )
+    return [
+        {"role": "system", "content": "あなたは画像の内容をEXCEL形式に変換するアシスタントです。"},
+        {"role": "user", "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
+        ]}
+    ]
+
+@stage('gpt_extraction')
+@stage_budget('gpt_extraction')
+def analyze_image_with_gpt(image_path, operator_name, now_str, now_verbose, openai_client, max_retries=3):
+    with open(image_path, "rb") as image_file:
+        image_base64 = base64.b64encode(image_file.read()).decode("utf-8")
+    messages = image_order_messages(image_base64, operator_name, now_str, now_verbose)
     for attempt in range(max_retries):
-        response = openai_client.chat.completions.create(
+        response = chat_completion(
+            openai_client,
+            attempt=attempt + 1,
             model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたは画像の内容をEXCEL形式に変換するアシスタントです。"},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
-                ]}
-            ],
+            messages=messages,
             max_tokens=1000,
             temperature=0.2
         )
-        content = response.choices[0].message.content.strip()
-        if "申し訳ありません" in content or "直接抽出することはできません" in content:
-            continue
-        lines = content.splitlines()
-        cleaned_lines = [line for line in lines if not line.strip().startswith("この情報") and line.strip() not in ["...", "…"]]
-        return "\n".join(cleaned_lines)
+        structured_text = clean_order_content(response.choices[0].message.content)
+        if structured_text is not None:
+            return structured_text
+    print("構造化テキストが空です。GPT応答なしまたはすべて謝罪文")
+    return ""
+
+async def analyze_image_with_gpt_async(image_data, operator_name, now_str, now_verbose, openai_client, max_retries=3):
+    """analyze_image_with_gptのasync版（画像はbytes、クライアントはAsyncOpenAI）"""
+    messages = image_order_messages(base64.b64encode(image_data).decode("utf-8"), operator_name, now_str, now_verbose)
+    with stage('gpt_extraction'), stage_budget('gpt_extraction'):
+        for attempt in range(max_retries):
+            response = await achat_completion(
+                openai_client,
+                attempt=attempt + 1,
+                model="gpt-4o",
+                messages=messages,
+                max_tokens=1000,
+                temperature=0.2
+            )
+            structured_text = clean_order_content(response.choices[0].message.content)
+            if structured_text is not None:
+                return structured_text
     print("構造化テキストが空です。GPT応答なしまたはすべて謝罪文")
     return ""
 
+def extract_image_order(image_data, operator_name, message_id, now_str, now_verbose, openai_client):
+    """画像→テキスト（GPT解析）。並列で呼ばれても衝突しないよう一時ファイル名はメッセージIDで分ける"""
+    image_path = f'/tmp/{message_id}.jpg'
+    with open(image_path, 'wb') as f:
+        f.write(image_data)
+    try:
+        return analyze_image_with_gpt(image_path, operator_name, now_str, now_verbose, openai_client)
+    finally:
+        os.remove(image_path)
+
 def process_image_message(event):
-    # 1. ユーザー名
     user_id = event['source']['userId']
     headers = {'Authorization': f'Bearer {os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")}'}
-    operator_name = get_operator_name(user_id, headers)
     now, now_str, now_verbose = get_now()
-
-    # 2. 画像取得
     message_id = event['message']['id']
-    image_url = f'https://api-data.line.me/v2/bot/message/{message_id}/content'
-    image_data = requests.get(image_url, headers=headers).content
     file_name = now.strftime('%Y%m%d_%H%M') + '.jpg'
-
-    # 3. Google Drive保存先取得
-    root_id = get_or_create_folder('受注集計')
-    date_id = get_or_create_folder(now.strftime('%Y%m%d'), parent_id=root_id)
-    image_folder_id = get_or_create_folder('Line画像保存', parent_id=date_id)
-    csv_folder_id = get_or_create_folder('集計結果', parent_id=date_id)
-
-    # 4. 画像保存
-    save_image_to_drive(image_data, file_name, image_folder_id)
-
-    # 5. 画像→テキスト（GPT解析）
     openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    image_path = f'/tmp/{file_name}'
-    with open(image_path, 'wb') as f:
-        f.write(image_data)
-    structured_text = analyze_image_with_gpt(
-        image_path, operator_name, now_str, now_verbose, openai_client
-    )
-    os.remove(image_path)
 
-    # 6. CSV追記
-    openai_client = OpenAI()
-    append_to_xlsx(structured_text, csv_folder_id, openai_client)
+    # ユーザー名・画像取得・Drive保存先は同時に始める。
+    # 画像保存（画像と保存先待ち）とGPT解析（画像とユーザー名待ち）は並行、集計への追記は解析と保存先を待つ（解析した行はその場で注文のジャーナルに記録する）
+    graph = TaskGraph()
+    graph.add('operator', get_operator_name, user_id, headers)
+    graph.add('image', get_message_content, message_id, headers)
+    graph.add('folders', get_order_folders, now.strftime('%Y%m%d'), 'Line画像保存')
+    graph.add('save_original', lambda image_data, folders: save_image_to_drive(image_data, file_name, folders[0]),
+              after=['image', 'folders'])
+    graph.add('extract', lambda image_data, operator_name: prepare_order_rows(extract_image_order(
+        image_data, operator_name, message_id, now_str, now_verbose, openai_client
+    )), after=['image', 'operator'])
+    graph.add('append', lambda prepared, folders: append_order_rows(prepared, folders[1], openai_client),
+              after=['extract', 'folders'])
+    graph.run()
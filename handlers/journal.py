@@ -0,0 +1,300 @@
+# handlers/journal.py
+"""
+注文の追記専用ジャーナル（ローカルのJSONLセグメントファイル、1件ごとにfsync）
+
+注文1件（テキスト・画像・PDF）ごとに、受信したイベント・抽出した注文行・集計への書き込み済みを記録する
+Drive・OpenAIの障害で集計への書き込みが失敗しても注文行はジャーナルに残り、後でまとめて書き込む（replay_pending）
+
+  order_scope(event)        : 注文1件分（Webhookの処理をこの中で行う）。'event'を記録する
+                              抽出した行を記録済みなら、この後の失敗は握りつぶしてLINEへは200を返す（再送で二重にしない）
+                              抽出前の失敗は'failed'（stage='receive'）を記録して上へ伝える（再処理はLINEの再送・スプールに任せる）
+  record_rows(day, df)      : 抽出した注文行（'rows'）。記録済みの行は書き込みに失敗しても消えない
+  record_flushed(ids)       : 集計（xlsx・台帳）への書き込み済み（'flushed'）
+  record_failed(stage, ...) : 抽出結果が注文として読めなかった（'failed'。確認用に本文を残す）
+  replay_pending()          : 書き込み待ちの行を受付日ごとにまとめて1回で書き込む（JOURNAL_REPLAY_INTERVAL_SECONDSごとにも自動で行う）
+  compact()                 : 古い順に、全件が済んだセグメントを消す
+
+状態: received（抽出前）→ extracted（書き込み待ち）→ flushed / failed
+同じイベントを受け直した（LINEの再送・スプールからの再処理）ら、failedの注文もreceivedに戻る
+JOURNAL_ENABLED=1では、再起動・再デプロイで消えないディスク上のJOURNAL_DIRの指定が必須（configで確認する）
+書き込みと'flushed'の記録の間で落ちた場合は、再書き込みで同じ行が二重になりうる（少なくとも1回）
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from handlers.diagnostics import log
+from handlers.task_graph import register_context
+from config import (
+    JOURNAL_ENABLED, JOURNAL_DIR, JOURNAL_SEGMENT_BYTES, JOURNAL_FSYNC,
+    JOURNAL_REPLAY_INTERVAL_SECONDS, JOURNAL_REPLAY_MIN_AGE_SECONDS,
+)
+
+SEGMENT_PREFIX = 'journal-'
+SEGMENT_SUFFIX = '.jsonl'
+
+# 実行中の注文の {'id', 'rows'}（rows: 抽出した行を記録済みか）。タスクグラフのスレッド・asyncio.to_threadとも共有する
+_current = ContextVar('journal_order', default=None)
+register_context(_current.get, _current.set)
+
+_write_lock = threading.Lock()
+# このプロセスで行を記録し、まだ書き込み中の注文（自動の再書き込みで二重にしない）
+_in_flight = set()
+_replayer_started = False
+_replayer_lock = threading.Lock()
+
+def _reset_after_fork():
+    global _write_lock, _replayer_started, _replayer_lock
+    _write_lock = threading.Lock()
+    _in_flight.clear()
+    _replayer_started = False
+    _replayer_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _segments():
+    if not os.path.isdir(JOURNAL_DIR):
+        return []
+    names = [n for n in os.listdir(JOURNAL_DIR) if n.startswith(SEGMENT_PREFIX) and n.endswith(SEGMENT_SUFFIX)]
+    return [os.path.join(JOURNAL_DIR, n) for n in sorted(names)]
+
+def _segment_path(number):
+    return os.path.join(JOURNAL_DIR, f'{SEGMENT_PREFIX}{number:08d}{SEGMENT_SUFFIX}')
+
+def _segment_number(path):
+    return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+@contextmanager
+def _file_lock(name, blocking=True):
+    """プロセス間（gunicornの各ワーカー）の排他。blocking=Falseで取れなければFalseをyield"""
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    with open(os.path.join(JOURNAL_DIR, name), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _fsync_dir():
+    fd = os.open(JOURNAL_DIR, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _append(record):
+    """1レコードを今のセグメントに追記する（大きさを超えていれば次のセグメントへ）"""
+    line = (json.dumps(record, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+    with _write_lock, _file_lock('journal.lock'):
+        segments = _segments()
+        path = segments[-1] if segments else _segment_path(1)
+        if segments and os.path.getsize(path) + len(line) > JOURNAL_SEGMENT_BYTES:
+            path = _segment_path(_segment_number(path) + 1)
+        created = not os.path.exists(path)
+        with open(path, 'ab') as f:
+            f.write(line)
+            f.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(f.fileno())
+        if created and JOURNAL_FSYNC:
+            _fsync_dir()
+
+def _event_id(event):
+    return event.get('webhookEventId') or event.get('message', {}).get('id')
+
+@contextmanager
+def order_scope(event):
+    """注文1件分。受信したイベントを記録し、この中で抽出した行をこの注文に紐づける"""
+    if not JOURNAL_ENABLED:
+        yield
+        return
+    entry_id = _event_id(event)
+    state = {'id': entry_id, 'rows': False}
+    _append({
+        'type': 'event', 'id': entry_id, 'ts': time.time(),
+        'kind': event.get('message', {}).get('type'), 'event': event,
+    })
+    _ensure_replayer()
+    token = _current.set(state)
+    try:
+        yield
+    except Exception as e:
+        if not state['rows']:
+            # 抽出前に失敗した注文は処理中のまま残さない（compactが先へ進めなくなる）
+            record_failed('receive', e)
+            raise
+        # 注文行はジャーナルにあるので、集計への書き込みは後でまとめて行う
+        log(logging.WARNING, 'journal_deferred', id=entry_id, error=str(e))
+        print(f"集計への書き込みを保留しました（ジャーナルに記録済み）: {e}")
+    finally:
+        _current.reset(token)
+        _in_flight.discard(entry_id)
+
+def record_rows(day, df):
+    """実行中の注文の抽出行を記録して注文のIDを返す（order_scopeの外・無効時はNone）"""
+    state = _current.get()
+    if state is None:
+        return None
+    rows = json.loads(df.to_json(orient='records', force_ascii=False))
+    _in_flight.add(state['id'])
+    _append({'type': 'rows', 'id': state['id'], 'ts': time.time(), 'day': day, 'rows': rows})
+    state['rows'] = True
+    return state['id']
+
+def current_order_id():
+    state = _current.get()
+    return state['id'] if state else None
+
+def record_flushed(ids):
+    ids = [i for i in ids if i is not None]
+    if not ids:
+        return
+    _append({'type': 'flushed', 'ids': ids, 'ts': time.time()})
+    for entry_id in ids:
+        _in_flight.discard(entry_id)
+
+def record_failed(stage, error, text=None):
+    state = _current.get()
+    if state is None:
+        return
+    _append({'type': 'failed', 'id': state['id'], 'ts': time.time(), 'stage': stage, 'error': str(error), 'text': text})
+
+def discard(ids, reason):
+    """注文を処理しないことにする（'failed'。受け取ったが抽出できないままのもの等を手で閉じる）"""
+    for entry_id in ids:
+        _append({'type': 'failed', 'id': entry_id, 'ts': time.time(), 'stage': 'discard', 'error': reason})
+
+def load_entries():
+    """
+    全セグメントを読んで {注文ID: 状態} を返す（書きかけの最終行は読み飛ばす）
+    状態: {'state', 'kind', 'event', 'received_at', 'day', 'rows', 'rows_at', 'error', 'segment'}
+    """
+    entries = {}
+    for path in _segments():
+        number = _segment_number(path)
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                kind = record.get('type')
+                if kind == 'flushed':
+                    for entry_id in record['ids']:
+                        if entry_id in entries:
+                            entries[entry_id]['state'] = 'flushed'
+                    continue
+                entry = entries.setdefault(record['id'], {
+                    'state': 'received', 'kind': None, 'event': None, 'received_at': record['ts'],
+                    'day': None, 'rows': None, 'rows_at': None, 'error': None,
+                    'segment': number,
+                })
+                if kind == 'event':
+                    entry.update(kind=record.get('kind'), event=record.get('event'))
+                    if entry['state'] == 'failed':
+                        entry.update(state='received', error=None)
+                elif kind == 'rows':
+                    entry.update(state='extracted', day=record['day'], rows=record['rows'], rows_at=record['ts'])
+                elif kind == 'failed':
+                    entry.update(state='failed', error=f"{record.get('stage')}: {record.get('error')}")
+    return entries
+
+def status():
+    """状態ごとの件数と、書き込み待ちの受付日ごとの件数"""
+    entries = load_entries()
+    counts = {}
+    pending_days = {}
+    for entry in entries.values():
+        counts[entry['state']] = counts.get(entry['state'], 0) + 1
+        if entry['state'] == 'extracted':
+            pending_days[entry['day']] = pending_days.get(entry['day'], 0) + 1
+    return {'states': counts, 'pending_days': pending_days, 'segments': len(_segments())}
+
+def replay_pending(openai_client=None, min_age=0, days=None):
+    """
+    書き込み待ち（extracted）の行を受付日ごとにまとめ、append_ordersで1日1回だけ書き込む
+    min_age秒より新しいもの・このプロセスで書き込み中のものは対象外（処理中の注文と二重にしない）
+    他のプロセスが再書き込み中ならNone。戻り値は {受付日: 書き込んだ注文数 / 'error: ...'}
+    """
+    with _file_lock('replay.lock', blocking=False) as locked:
+        if not locked:
+            return None
+        import pandas as pd
+        from handlers.csv_handler import CSV_HEADERS, append_orders
+        from handlers.file_handler import get_summary_folder
+
+        now = time.time()
+        groups = {}
+        for entry_id, entry in load_entries().items():
+            if entry['state'] != 'extracted' or entry_id in _in_flight or now - entry['rows_at'] < min_age:
+                continue
+            if days and entry['day'] not in days:
+                continue
+            groups.setdefault(entry['day'], []).append((entry_id, entry))
+
+        if groups and openai_client is None:
+            from openai import OpenAI
+            openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        results = {}
+        for day, items in sorted(groups.items()):
+            rows = [row for _, entry in items for row in entry['rows']]
+            df = pd.DataFrame(rows, columns=CSV_HEADERS)
+            try:
+                append_orders(df, get_summary_folder(day), openai_client, day)
+            except Exception as e:
+                results[day] = f'error: {e}'
+                log(logging.ERROR, 'journal_replay_error', day=day, orders=len(items), error=str(e))
+                continue
+            record_flushed([entry_id for entry_id, _ in items])
+            results[day] = len(items)
+            log(logging.INFO, 'journal_replayed', day=day, orders=len(items), rows=len(rows))
+        return results
+
+def compact():
+    """
+    古いセグメントから順に、中の注文がすべて済んだ（flushed / failed）ものを消す（最新のセグメントは残す）
+    途中に未処理の注文を含むセグメントがあればそこで止める。消したセグメント数を返す
+    """
+    with _write_lock, _file_lock('journal.lock'):
+        segments = _segments()
+        entries = load_entries()
+        open_segments = {e['segment'] for e in entries.values() if e['state'] in ('received', 'extracted')}
+        removed = 0
+        for path in segments[:-1]:
+            if _segment_number(path) in open_segments:
+                break
+            os.remove(path)
+            removed += 1
+        if removed and JOURNAL_FSYNC:
+            _fsync_dir()
+        return removed
+
+def _ensure_replayer():
+    global _replayer_started
+    if _replayer_started or JOURNAL_REPLAY_INTERVAL_SECONDS <= 0:
+        return
+    with _replayer_lock:
+        if _replayer_started:
+            return
+        threading.Thread(target=_replay_loop, name='journal-replay', daemon=True).start()
+        _replayer_started = True
+
+def _replay_loop():
+    while True:
+        time.sleep(JOURNAL_REPLAY_INTERVAL_SECONDS)
+        try:
+            results = replay_pending(min_age=JOURNAL_REPLAY_MIN_AGE_SECONDS)
+            if results:
+                print(f"ジャーナルの保留分を書き込みました: {results}")
+            compact()
+        except Exception as e:
+            log(logging.ERROR, 'journal_replay_loop_error', error=str(e))
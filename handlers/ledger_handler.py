@@ -0,0 +1,204 @@
+# handlers/ledger_handler.py
+"""
+受注台帳（SQLite）
+取り込んだ注文をローカルの台帳に書き込み、各コマンドは台帳へのインデックス付きクエリで処理する
+集計結果_YYYYMMDD.xlsx は台帳から必要な時だけ描き出す
+"""
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+from config import ORDER_LEDGER_PATH
+
+LEDGER_ORDER_COLUMNS = ['顧客', '発注者', '商品名', 'サイズ', '数量', '単位', '納品希望日', '納品場所', '時間', '社内担当者', '備考']
+LEDGER_TAG_COLUMNS = ['商品名', 'サイズ', '発注先', '郵便番号', '住所', '税率']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    受付日 TEXT NOT NULL,
+    顧客 TEXT,
+    発注者 TEXT,
+    商品名 TEXT,
+    サイズ TEXT,
+    数量 REAL,
+    単位 TEXT,
+    納品希望日 TEXT,
+    納品場所 TEXT,
+    時間 TEXT,
+    社内担当者 TEXT,
+    備考 TEXT,
+    発注先 TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_orders_day ON orders(受付日);
+CREATE INDEX IF NOT EXISTS idx_orders_delivery ON orders(納品希望日);
+CREATE INDEX IF NOT EXISTS idx_orders_product ON orders(商品名, サイズ);
+CREATE INDEX IF NOT EXISTS idx_orders_supplier ON orders(発注先);
+CREATE TABLE IF NOT EXISTS tags (
+    商品名 TEXT NOT NULL,
+    サイズ TEXT NOT NULL,
+    発注先 TEXT,
+    郵便番号 TEXT,
+    住所 TEXT,
+    税率 TEXT,
+    PRIMARY KEY (商品名, サイズ)
+);
+CREATE TABLE IF NOT EXISTS ledger_days (
+    受付日 TEXT PRIMARY KEY,
+    取込元 TEXT
+);
+"""
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized_schemas = set()
+
+def _reset_after_fork():
+    # SQLiteの接続はforkをまたいで使えないので、子プロセスでは作り直す
+    global _local
+    _local = threading.local()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def get_connection(path=None):
+    """スレッドごとの接続を返す（初回にスキーマを作成）"""
+    path = path or ORDER_LEDGER_PATH
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        ensure_schema(conn, path, _SCHEMA)
+        conns[path] = conn
+    return conn
+
+def ensure_schema(conn, path, schema):
+    """
+    schema（CREATE TABLE IF NOT EXISTS ...）をDBファイルごとに1回だけ流す（繰り越しストア・スプール・LLM使用量も使う）
+    接続のid()はGCの後に使い回されるので、DBファイルのパスで覚える
+    """
+    key = (path, schema)
+    if key in _initialized_schemas:
+        return
+    with _init_lock:
+        if key not in _initialized_schemas:
+            conn.executescript(schema)
+            _initialized_schemas.add(key)
+
+def to_text(value):
+    """台帳に入れる文字列表現（欠損は''、Excel由来の20250702.0は'20250702'）"""
+    if value is None or (isinstance(value, float) and pd.isnull(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+def _lookup_supplier(conn, product_name, size):
+    row = conn.execute(
+        "SELECT 発注先 FROM tags WHERE 商品名 = ? AND サイズ IN (?, '') ORDER BY サイズ = '' LIMIT 1",
+        (product_name, size)
+    ).fetchone()
+    return row[0] if row else ""
+
+def _insert_records(conn, day, df_norm):
+    records = []
+    for row in df_norm.to_dict('records'):
+        values = [to_text(row.get(c)) for c in LEDGER_ORDER_COLUMNS]
+        qty = pd.to_numeric(row.get('数量'), errors='coerce')
+        values[LEDGER_ORDER_COLUMNS.index('数量')] = 0.0 if pd.isnull(qty) else float(qty)
+        supplier = _lookup_supplier(conn, values[2], values[3])
+        records.append([day] + values + [supplier])
+    placeholders = ", ".join(["?"] * (len(LEDGER_ORDER_COLUMNS) + 2))
+    conn.executemany(
+        f"INSERT INTO orders (受付日, {', '.join(LEDGER_ORDER_COLUMNS)}, 発注先) VALUES ({placeholders})",
+        records
+    )
+    return len(records)
+
+def insert_orders(day, df_norm, conn=None):
+    """正規化済みの注文行を受付日dayとして台帳に追加する"""
+    conn = conn or get_connection()
+    with conn:
+        return _insert_records(conn, day, df_norm)
+
+def has_day(day, conn=None):
+    conn = conn or get_connection()
+    return conn.execute("SELECT 1 FROM ledger_days WHERE 受付日 = ?", (day,)).fetchone() is not None
+
+def import_day(day, raw_df, source, conn=None):
+    """
+    既存の集計結果xlsx（生データシート）から1日分を台帳に取り込む
+    すでに取り込み済みの日は何もしない（複数ワーカーが同時に呼んでも1回だけ取り込む）
+    """
+    conn = conn or get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("SELECT 1 FROM ledger_days WHERE 受付日 = ?", (day,)).fetchone():
+            return 0
+        count = _insert_records(conn, day, raw_df) if raw_df is not None and not raw_df.empty else 0
+        conn.execute("INSERT INTO ledger_days (受付日, 取込元) VALUES (?, ?)", (day, source))
+    return count
+
+def replace_day(day, df_norm, source, conn=None):
+    """受付日dayの注文をdf_normで置き換える（一括再抽出用）。取り込み済みとして記録し、xlsxからは取り込み直さない"""
+    conn = conn or get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM orders WHERE 受付日 = ?", (day,))
+        count = _insert_records(conn, day, df_norm)
+        conn.execute("INSERT OR IGNORE INTO ledger_days (受付日, 取込元) VALUES (?, ?)", (day, source))
+    return count
+
+def _query_orders(where, params, conn=None):
+    conn = conn or get_connection()
+    cur = conn.execute(
+        f"SELECT {', '.join(LEDGER_ORDER_COLUMNS)} FROM orders WHERE {where} ORDER BY id",
+        params
+    )
+    return pd.DataFrame(cur.fetchall(), columns=LEDGER_ORDER_COLUMNS)
+
+def orders_for_day(day, conn=None):
+    """受付日dayの注文（集計結果_YYYYMMDDの生データシート相当）"""
+    return _query_orders("受付日 = ?", (day,), conn)
+
+def picking_list(day, conn=None):
+    """納品希望日がdayの注文（前日以前に受け付けた分も含む）"""
+    return _query_orders("納品希望日 = ? AND 受付日 <= ?", (day, day), conn)
+
+def order_remains(day, next_day, conn=None):
+    """day時点で受付済み、納品希望日がnext_day以降の注文（受注残）"""
+    return _query_orders("納品希望日 >= ? AND 受付日 <= ?", (next_day, day), conn)
+
+def load_tags(tag_df, conn=None):
+    """タグ付け表で台帳のタグを置き換え、注文の発注先を付け直す（同じ商品名・サイズは先頭行を採用）"""
+    conn = conn or get_connection()
+    rows = []
+    for row in tag_df.fillna("").to_dict('records'):
+        rows.append([to_text(row.get(c, "")) for c in LEDGER_TAG_COLUMNS])
+    with conn:
+        conn.execute("DELETE FROM tags")
+        conn.executemany(
+            f"INSERT OR IGNORE INTO tags ({', '.join(LEDGER_TAG_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        conn.execute(
+            """
+            UPDATE orders SET 発注先 = COALESCE((
+                SELECT t.発注先 FROM tags t
+                WHERE t.商品名 = orders.商品名 AND t.サイズ IN (orders.サイズ, '')
+                ORDER BY t.サイズ = '' LIMIT 1
+            ), '')
+            """
+        )
+    return len(rows)
+
+def tag_table(conn=None):
+    """タグ付け表（create_order_list_sheetで読むのと同じ列構成のDataFrame）"""
+    conn = conn or get_connection()
+    cur = conn.execute(f"SELECT {', '.join(LEDGER_TAG_COLUMNS)} FROM tags")
+    return pd.DataFrame(cur.fetchall(), columns=LEDGER_TAG_COLUMNS)
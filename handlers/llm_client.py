@@ -0,0 +1,274 @@
+# handlers/llm_client.py
+"""
+LLM呼び出しの窓口（chat.completions.createは必ずchat_completionを通す）
+
+1回ごとに モデル・入出力トークン・所要時間・試行回数・呼び出し元の関数 を記録し、
+受注台帳と同じSQLite（llm_usageテーブル）に積む。Webhook1件・担当者・日付ごとに集計できる
+
+  usage_scope(event_id, user_id) : Webhook1件分。この間の呼び出しにイベントID・LINEユーザIDを付ける
+  set_operator(name)             : 担当者名（get_operator_nameの表示名）を付ける
+  chat_completion(client, attempt=1, **kwargs) : chat.completions.createの代わりに呼ぶ
+                                                 （OpenAIのブレーカーとWebhookの締め切りを通す。handlers/resilience.py）
+  achat_completion(client, attempt=1, **kwargs): AsyncOpenAI用（asgi_app.py）
+  usage_summary(by, since, until) : 集計（tools/llm_usage.pyから使う）
+
+書き込みは呼び出しごとではなく、Webhook1件の終わり・一定件数ごと・プロセス終了時にまとめて行う
+"""
+import atexit
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+import pytz
+
+from handlers.metrics import count_call, current_kind
+from handlers.resilience import guard, remaining
+from handlers.task_graph import register_context
+from config import LLM_USAGE_ENABLED, LLM_USAGE_PATH
+
+JST = pytz.timezone('Asia/Tokyo')
+HANDLERS_DIR = os.path.dirname(os.path.abspath(__file__))
+TASK_GRAPH_FILE = os.path.join(HANDLERS_DIR, 'task_graph.py')
+
+# 100万トークンあたりの料金（USD、入力・出力）。集計時に掛けるので、改定時はここを直せば過去分も再計算される
+MODEL_PRICES = {
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+}
+
+# この件数たまったらWebhookの途中でも書き込む（集計サマリ作成のように1件で数千回呼ぶ場合）
+FLUSH_ROWS = 200
+
+USAGE_COLUMNS = [
+    'ts', 'day', 'event_id', 'kind', 'user_id', 'operator', 'caller', 'call_path',
+    'model', 'prompt_tokens', 'completion_tokens', 'latency_ms', 'attempt', 'error',
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts TEXT NOT NULL,
+    day TEXT NOT NULL,
+    event_id TEXT,
+    kind TEXT,
+    user_id TEXT,
+    operator TEXT,
+    caller TEXT,
+    call_path TEXT,
+    model TEXT,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    latency_ms REAL,
+    attempt INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_llm_usage_day ON llm_usage(day);
+CREATE INDEX IF NOT EXISTS idx_llm_usage_event ON llm_usage(event_id);
+"""
+
+# 実行中のWebhookの {'event_id', 'user_id', 'operator'}。タスクグラフのスレッド・asyncタスクとは同じdictを共有する
+_scope = ContextVar('llm_usage_scope', default=None)
+_pending = []
+_pending_lock = threading.Lock()
+
+def _reset_after_fork():
+    # 親プロセスで溜まっていた分を子プロセスでも書き込むと二重になる
+    del _pending[:]
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _connection():
+    # 受注台帳（pandas）はWebhookの起動時に読み込まないよう、最初の書き込みで読み込む
+    from handlers.ledger_handler import get_connection, ensure_schema
+    conn = get_connection(LLM_USAGE_PATH)
+    ensure_schema(conn, LLM_USAGE_PATH, _SCHEMA)
+    return conn
+
+@contextmanager
+def usage_scope(event_id, user_id=None):
+    """Webhook1件分（このスレッドのLLM呼び出しにevent_id・user_idを付け、終わりに書き込む）"""
+    # どのスレッド・タスクでset_operatorしても、このWebhookの呼び出し全体に効く
+    token = _scope.set({'event_id': event_id, 'user_id': user_id, 'operator': None})
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+        flush()
+
+register_context(_scope.get, _scope.set)
+
+def set_operator(name):
+    """実行中のWebhookの担当者名を記録する"""
+    scope = _scope.get()
+    if scope is None:
+        scope = {'event_id': None, 'user_id': None, 'operator': None}
+        _scope.set(scope)
+    scope['operator'] = name
+
+def _call_path(depth=3):
+    """handlers内の呼び出し元の関数名を外側から順に（例: normalize_summary_rows>normalize_unit_ai）"""
+    caller = sys._getframe(2)
+    names = [caller.f_code.co_name]
+    # デコレータ（stage）などhandlers外のフレームと、タスクグラフの実行部分は飛ばす
+    frame = caller.f_back
+    while frame is not None and len(names) < depth:
+        path = os.path.abspath(frame.f_code.co_filename)
+        if os.path.dirname(path) == HANDLERS_DIR and path != TASK_GRAPH_FILE:
+            names.append(frame.f_code.co_name)
+        frame = frame.f_back
+    return names[0], '>'.join(reversed(names))
+
+def _within_deadline(openai_client):
+    # 締め切りのあるWebhookでは、SDKの自動リトライ（既定2回）で締め切りを越えない（やり直しはスプール・ジャーナルで）
+    if remaining() is None or not hasattr(openai_client, 'with_options'):
+        return openai_client
+    return openai_client.with_options(max_retries=0)
+
+def chat_completion(openai_client, attempt=1, **kwargs):
+    """
+    chat.completions.createを呼び、使用量を記録して応答を返す
+    attemptはリトライループ内の試行回数（1始まり）。例外は記録してそのまま投げる
+    """
+    with guard('openai') as timeout:
+        openai_client = _within_deadline(openai_client)
+        count_call('openai')
+        if not LLM_USAGE_ENABLED:
+            return openai_client.chat.completions.create(timeout=timeout, **kwargs)
+
+        caller, call_path = _call_path()
+        started = time.perf_counter()
+        response = None
+        error = None
+        try:
+            response = openai_client.chat.completions.create(timeout=timeout, **kwargs)
+            return response
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'[:200]
+            raise
+        finally:
+            _record_call(caller, call_path, started, response, error, attempt, kwargs)
+
+async def achat_completion(openai_client, attempt=1, **kwargs):
+    """chat_completionのasync版（AsyncOpenAIのクライアントを渡す）"""
+    with guard('openai') as timeout:
+        openai_client = _within_deadline(openai_client)
+        count_call('openai')
+        if not LLM_USAGE_ENABLED:
+            return await openai_client.chat.completions.create(timeout=timeout, **kwargs)
+
+        caller, call_path = _call_path()
+        started = time.perf_counter()
+        response = None
+        error = None
+        try:
+            response = await openai_client.chat.completions.create(timeout=timeout, **kwargs)
+            return response
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'[:200]
+            raise
+        finally:
+            _record_call(caller, call_path, started, response, error, attempt, kwargs)
+
+def _record_call(caller, call_path, started, response, error, attempt, kwargs):
+    latency_ms = (time.perf_counter() - started) * 1000
+    # スタブ・古いSDKでusageがない場合はトークン数を空にする
+    usage = getattr(response, 'usage', None)
+    now = datetime.now(JST)
+    scope = _scope.get() or {}
+    _record({
+        'ts': now.isoformat(timespec='seconds'),
+        'day': now.strftime('%Y%m%d'),
+        'event_id': scope.get('event_id'),
+        'kind': current_kind(),
+        'user_id': scope.get('user_id'),
+        'operator': scope.get('operator'),
+        'caller': caller,
+        'call_path': call_path,
+        'model': getattr(response, 'model', None) or kwargs.get('model'),
+        'prompt_tokens': getattr(usage, 'prompt_tokens', None),
+        'completion_tokens': getattr(usage, 'completion_tokens', None),
+        'latency_ms': round(latency_ms, 1),
+        'attempt': attempt,
+        'error': error,
+    })
+
+def _record(row):
+    with _pending_lock:
+        _pending.append(row)
+        full = len(_pending) >= FLUSH_ROWS
+    if full:
+        flush()
+
+def flush():
+    """たまった使用量をSQLiteに書き込む（失敗しても本処理は止めない）"""
+    with _pending_lock:
+        rows = _pending[:]
+        _pending.clear()
+    if not rows:
+        return
+    try:
+        conn = _connection()
+        with conn:
+            conn.executemany(
+                f"INSERT INTO llm_usage ({', '.join(USAGE_COLUMNS)}) VALUES ({', '.join('?' * len(USAGE_COLUMNS))})",
+                [[row[c] for c in USAGE_COLUMNS] for row in rows],
+            )
+    except Exception as e:
+        print(f"[LLM使用量] 書き込みエラー（{len(rows)}件を破棄）: {e}")
+
+atexit.register(flush)
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """トークン数からの概算料金（USD。料金表にないモデルは0）"""
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model and model.startswith(name):
+            input_price, output_price = MODEL_PRICES[name]
+            return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+    return 0.0
+
+def load_usage(since=None, until=None, conn=None):
+    """使用量の明細（sinceからuntilまでの日付YYYYMMDD、両端含む）"""
+    import pandas as pd
+    flush()
+    conn = conn or _connection()
+    clauses, params = [], []
+    if since:
+        clauses.append('day >= ?')
+        params.append(since)
+    if until:
+        clauses.append('day <= ?')
+        params.append(until)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+    df = pd.read_sql_query(f"SELECT {', '.join(USAGE_COLUMNS)} FROM llm_usage{where} ORDER BY id", conn, params=params)
+    df[['prompt_tokens', 'completion_tokens']] = df[['prompt_tokens', 'completion_tokens']].fillna(0).astype(int)
+    df['cost_usd'] = [
+        estimate_cost(m, p, c) for m, p, c in zip(df['model'], df['prompt_tokens'], df['completion_tokens'])
+    ]
+    return df
+
+def usage_summary(by='day', since=None, until=None, conn=None):
+    """
+    使用量の集計（by: day / event_id / operator / caller / call_path / kind / model、カンマ区切りで複数可）
+    呼び出し回数・リトライ（attempt>1）・エラー・トークン数・概算料金・所要時間を返す（料金の多い順）
+    """
+    df = load_usage(since, until, conn)
+    keys = [k.strip() for k in by.split(',')]
+    df[keys] = df[keys].fillna('-')
+    df['retry'] = df['attempt'] > 1
+    df['failed'] = df['error'].notna()
+    summary = df.groupby(keys).agg(
+        calls=('model', 'size'),
+        retries=('retry', 'sum'),
+        errors=('failed', 'sum'),
+        prompt_tokens=('prompt_tokens', 'sum'),
+        completion_tokens=('completion_tokens', 'sum'),
+        cost_usd=('cost_usd', 'sum'),
+        latency_total_s=('latency_ms', lambda s: s.sum() / 1000),
+        latency_p50_ms=('latency_ms', 'median'),
+        latency_p95_ms=('latency_ms', lambda s: s.quantile(0.95)),
+    ).reset_index()
+    return summary.sort_values('cost_usd', ascending=False, kind='stable').reset_index(drop=True)
@@ -0,0 +1,103 @@
+# handlers/metrics.py
+"""
+処理段階ごとの所要時間と外部呼び出し回数の計測（Prometheus形式で /metrics に出す）
+
+  request_span(kind) : Webhook1件分。処理時間と、その間の外部呼び出し回数（サービス別）を記録する
+  stage(name)        : 処理段階（with文でもデコレータでも使える）。段階は入れ子にしてよく、外側の時間は内側を含む
+  count_call(service): 外部呼び出し1回（line / openai / drive / local）
+
+段階・外部呼び出しは実行中リクエストに紐づける（リクエスト外ではkind='-'）
+リクエストの状態はcontextvarsで持つので、スレッドごと（Flask）にもasyncタスクごと（asgi_app.py）にも分かれる
+gunicornの複数ワーカーではPROMETHEUS_MULTIPROC_DIRを設定すると全ワーカー分をまとめて出す
+"""
+import os
+import threading
+import time
+from collections import Counter as CallCounter
+from contextlib import ContextDecorator, contextmanager
+from contextvars import ContextVar
+
+from handlers.task_graph import register_context
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest,
+)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+CALL_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+SERVICES = ('line', 'openai', 'drive', 'local')
+
+REQUEST_SECONDS = Histogram(
+    'webhook_request_seconds', 'Webhook1件の処理時間', ['kind'], buckets=SECONDS_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    'webhook_stage_seconds', '処理段階ごとの所要時間', ['kind', 'stage'], buckets=SECONDS_BUCKETS,
+)
+REQUEST_OUTBOUND_CALLS = Histogram(
+    'webhook_outbound_calls', 'Webhook1件あたりの外部呼び出し回数', ['kind', 'service'], buckets=CALL_BUCKETS,
+)
+OUTBOUND_CALLS_TOTAL = Counter('outbound_calls_total', '外部呼び出しの累計', ['service'])
+ADMISSION_WAIT_SECONDS = Histogram(
+    'admission_wait_seconds', '処理枠の空き待ち時間', ['work_class'], buckets=SECONDS_BUCKETS,
+)
+ADMISSION_SPOOLED_TOTAL = Counter('admission_spooled_total', '混雑でスプールに積んだWebhook', ['work_class', 'reason'])
+SPOOL_PROCESSED_TOTAL = Counter('spool_processed_total', 'スプールから処理したWebhook', ['work_class', 'result'])
+BREAKER_TRANSITIONS_TOTAL = Counter('breaker_transitions_total', 'サーキットブレーカーの状態の変化', ['service', 'state'])
+OUTBOUND_REJECTED_TOTAL = Counter(
+    'outbound_rejected_total', '遮断中・締め切り切れで呼ばなかった外部呼び出し', ['service', 'reason'],
+)
+
+# (kind, サービス別の外部呼び出し回数)
+_request = ContextVar('webhook_request', default=('-', None))
+_calls_lock = threading.Lock()
+
+def current_kind():
+    return _request.get()[0]
+
+# タスクグラフのスレッドでの段階・外部呼び出しも、呼び出し元のリクエストに付ける
+register_context(_request.get, _request.set)
+
+@contextmanager
+def request_span(kind):
+    """Webhook1件分の計測（この間の段階・外部呼び出しをkindに紐づける）"""
+    calls = CallCounter()
+    token = _request.set((kind, calls))
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REQUEST_SECONDS.labels(kind).observe(time.perf_counter() - started)
+        for service in SERVICES:
+            REQUEST_OUTBOUND_CALLS.labels(kind, service).observe(calls[service])
+        _request.reset(token)
+
+class stage(ContextDecorator):
+    """処理段階の所要時間を記録する（with stage('normalize'): / @stage('normalize')）"""
+
+    def __init__(self, name):
+        self.name = name
+        self._started = threading.local()
+
+    def __enter__(self):
+        self._started.value = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        STAGE_SECONDS.labels(current_kind(), self.name).observe(time.perf_counter() - self._started.value)
+        return False
+
+def count_call(service, n=1):
+    """外部呼び出しを数える（実行中のリクエストがあればその回数にも足す）"""
+    OUTBOUND_CALLS_TOTAL.labels(service).inc(n)
+    calls = _request.get()[1]
+    if calls is not None:
+        with _calls_lock:
+            calls[service] += n
+
+def render_metrics():
+    """/metrics の本文とContent-Type"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,214 @@
+# handlers/monthly_handler.py
+"""
+複数日・月次の集計（「月次集計 2026-10」コマンド / tools/monthly_report.py）
+受注集計フォルダ配下の日別の集計結果_YYYYMMDD.xlsxを並列でDLし、
+1ファイルずつ生データシートを流し読みして日ごとの部分集計にまとめ、
+商品別・顧客別・発注先別・日別の合計を1つのxlsxに書き出す
+"""
+import io
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+
+from config import MONTHLY_DOWNLOAD_WORKERS
+from handlers.file_handler import (
+    get_or_create_folder, find_folder_id, find_file_id,
+    list_child_folders, download_file_bytes, download_tag_table, upload_file_to_drive,
+)
+from handlers.ledger_handler import to_text
+from handlers.workbook_session import column_widths, frame_rows
+
+MONTHLY_FOLDER_NAME = '月次集計'
+UNASSIGNED_SUPPLIER = '（発注先未設定）'
+
+# 出力シート: (シート名, 集計キーの列)
+MONTHLY_SHEETS = [
+    ('商品別', ['商品名', 'サイズ', '単位']),
+    ('顧客別', ['顧客', '単位']),
+    ('発注先別', ['発注先', '単位']),
+    ('日別', ['受付日', '単位']),
+]
+
+def parse_period(text):
+    """
+    期間指定を (開始日, 終了日) の'YYYYMMDD'にする
+    '2026-10' / '202610' → その月の1日～末日、'20261001-20261015' / '2026-10-01~2026-10-15' → その範囲
+    """
+    digits = re.sub(r'[^0-9~\-〜～]', '', text.strip())
+    m = re.fullmatch(r'(\d{4})-?(\d{1,2})', digits)
+    if m:
+        start = datetime(int(m.group(1)), int(m.group(2)), 1)
+        end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        return start.strftime('%Y%m%d'), end.strftime('%Y%m%d')
+    dates = re.findall(r'\d{4}-?\d{2}-?\d{2}', digits)
+    if len(dates) == 2:
+        start, end = (datetime.strptime(d.replace('-', ''), '%Y%m%d').strftime('%Y%m%d') for d in dates)
+        if start > end:
+            start, end = end, start
+        return start, end
+    raise ValueError(f"期間を解釈できません: {text}（例: 月次集計 2026-10）")
+
+def build_supplier_map(tag_df):
+    """タグ付け表から {(商品名, サイズ): 発注先}（サイズ''は商品名だけの指定）。同じキーは先頭行を採用"""
+    suppliers = {}
+    if tag_df is None:
+        return suppliers
+    for row in tag_df.fillna("").to_dict('records'):
+        key = (to_text(row.get('商品名')), to_text(row.get('サイズ')))
+        suppliers.setdefault(key, to_text(row.get('発注先')))
+    return suppliers
+
+def _lookup_supplier(suppliers, product_name, size):
+    return suppliers.get((product_name, size)) or suppliers.get((product_name, "")) or UNASSIGNED_SUPPLIER
+
+def _to_quantity(value):
+    qty = pd.to_numeric(value, errors='coerce')
+    return 0.0 if pd.isnull(qty) else float(qty)
+
+def aggregate_rows(day, rows, suppliers):
+    """
+    1日分の生データシートの行（1行目ヘッダ）を流し読みして部分集計にする
+    戻り値: {シート名: {キー: [数量, 行数]}}
+    """
+    partial = {name: {} for name, _ in MONTHLY_SHEETS}
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return partial
+    index = {str(c).strip(): i for i, c in enumerate(header) if c is not None}
+    if '商品名' not in index:
+        return partial
+
+    def value(row, col):
+        i = index.get(col)
+        return row[i] if i is not None and i < len(row) else None
+
+    for row in rows:
+        product_name = to_text(value(row, '商品名'))
+        if not product_name:
+            continue
+        size, unit = to_text(value(row, 'サイズ')), to_text(value(row, '単位'))
+        qty = _to_quantity(value(row, '数量'))
+        keys = {
+            '商品別': (product_name, size, unit),
+            '顧客別': (to_text(value(row, '顧客')), unit),
+            '発注先別': (_lookup_supplier(suppliers, product_name, size), unit),
+            '日別': (day, unit),
+        }
+        for name, key in keys.items():
+            total = partial[name].setdefault(key, [0.0, 0])
+            total[0] += qty
+            total[1] += 1
+    return partial
+
+def merge_partial(aggregate, partial):
+    """部分集計をランニング集計に足し込む"""
+    for name, totals in partial.items():
+        target = aggregate.setdefault(name, {})
+        for key, (qty, count) in totals.items():
+            total = target.setdefault(key, [0.0, 0])
+            total[0] += qty
+            total[1] += count
+
+def find_daily_workbooks(root_id, start, end):
+    """受注集計直下の日付フォルダから期間内のものを探す（フォルダ一覧は1回だけ取得）"""
+    folders = list_child_folders(root_id)
+    return sorted(
+        (name, folder_id) for name, folder_id in folders.items()
+        if re.fullmatch(r'\d{8}', name) and start <= name <= end
+    )
+
+def _aggregate_day(day, date_folder_id, suppliers):
+    """ワーカースレッド側: 1日分をDL→流し読み→部分集計（workbookは関数を抜けたら手放す）"""
+    csv_folder_id = find_folder_id('集計結果', date_folder_id)
+    if not csv_folder_id:
+        return day, None
+    file_id = find_file_id(f'集計結果_{day}.xlsx', csv_folder_id)
+    if not file_id:
+        return day, None
+    wb = load_workbook(io.BytesIO(download_file_bytes(file_id)), read_only=True)
+    try:
+        sheet_name = f'集計結果_{day}'
+        if sheet_name not in wb.sheetnames:
+            sheet_name = wb.sheetnames[0]
+        return day, aggregate_rows(day, wb[sheet_name].iter_rows(values_only=True), suppliers)
+    finally:
+        wb.close()
+
+def aggregate_period(root_id, start, end, suppliers, max_workers=None):
+    """
+    期間内の日別集計結果を並列DLし、届いた順にランニング集計へ足し込む
+    戻り値: (aggregate, 集計できた日のリスト, ファイルがなかった日のリスト)
+    """
+    max_workers = max_workers or MONTHLY_DOWNLOAD_WORKERS
+    days = find_daily_workbooks(root_id, start, end)
+    aggregate = {name: {} for name, _ in MONTHLY_SHEETS}
+    found, missing = [], []
+    if not days:
+        return aggregate, found, missing
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(days)))) as pool:
+        futures = [pool.submit(_aggregate_day, day, folder_id, suppliers) for day, folder_id in days]
+        for future in as_completed(futures):
+            day, partial = future.result()
+            if partial is None:
+                missing.append(day)
+                continue
+            merge_partial(aggregate, partial)
+            found.append(day)
+    return aggregate, sorted(found), sorted(missing)
+
+def aggregate_frames(aggregate):
+    """ランニング集計をシートごとのDataFrameにする（数量が整数ならint）"""
+    frames = {}
+    for name, key_columns in MONTHLY_SHEETS:
+        totals = aggregate.get(name, {})
+        rows = [
+            list(key) + [int(qty) if qty.is_integer() else qty, count]
+            for key, (qty, count) in sorted(totals.items())
+        ]
+        frames[name] = pd.DataFrame(rows, columns=key_columns + ['数量', '行数'])
+    return frames
+
+def write_monthly_workbook(frames, xlsx_path):
+    """集計結果をwrite-onlyで1つのxlsxに書き出す"""
+    wb = Workbook(write_only=True)
+    for name, df in frames.items():
+        ws = wb.create_sheet(name)
+        for letter, width in column_widths(df).items():
+            ws.column_dimensions[letter].width = width
+        for row in frame_rows(df):
+            ws.append(row)
+    wb.save(xlsx_path)
+
+def run_monthly_report(period_text, root_id=None, upload=True, out_dir='/tmp', max_workers=None):
+    """
+    期間を集計して 月次集計_開始日-終了日.xlsx を作る（uploadなら受注集計＞月次集計フォルダへ反映）
+    戻り値: 作成したローカルファイルのパス
+    """
+    started = time.perf_counter()
+    start, end = parse_period(period_text)
+    root_id = root_id or get_or_create_folder('受注集計')
+
+    tag_xlsx_path = os.path.join(out_dir, 'タグ付け表.xlsx')
+    tag_df = pd.read_excel(tag_xlsx_path, dtype=str) if download_tag_table(root_id, tag_xlsx_path) else None
+    if tag_df is None:
+        print("タグ付け表.xlsxが見つからないため、発注先別は未設定として集計します")
+
+    aggregate, found, missing = aggregate_period(root_id, start, end, build_supplier_map(tag_df), max_workers)
+    file_name = f'月次集計_{start}-{end}.xlsx'
+    xlsx_path = os.path.join(out_dir, file_name)
+    write_monthly_workbook(aggregate_frames(aggregate), xlsx_path)
+
+    if upload:
+        folder_id = get_or_create_folder(MONTHLY_FOLDER_NAME, parent_id=root_id)
+        upload_file_to_drive(xlsx_path, file_name, folder_id, file_id=find_file_id(file_name, folder_id))
+    print(
+        f"{file_name}: {len(found)}日分を集計（ファイルなし {len(missing)}日） "
+        f"{time.perf_counter() - started:.2f}秒"
+    )
+    return xlsx_path
@@ -0,0 +1,234 @@
+# handlers/order_sheet_handler.py
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.cell.cell import MergedCell
+
+from config import ORDER_SHEET_RENDER_WORKERS, ORDER_SHEET_UPLOAD_WORKERS, ORDER_SHEET_RENDER_MODE
+from handlers.file_handler import upload_bytes_to_drive
+from handlers.order_sheet_renderer import CompiledOrderTemplate
+
+# 注文書フォーマットの明細行（20行目～34行目）
+ORDER_ROW_START = 20
+ORDER_ROWS_PER_PAGE = 15
+ORDER_HEADER_CELLS = ["B6", "B7", "B8", "P4"]
+ORDER_ROW_COLUMNS = ["B", "F", "H", "K", "L", "M"]
+ORDER_TARGET_CELLS = ORDER_HEADER_CELLS + [
+    f"{col}{ORDER_ROW_START + i}" for i in range(ORDER_ROWS_PER_PAGE) for col in ORDER_ROW_COLUMNS
+]
+
+# 生成に使うフォーマット (ダイジェスト, bytes, コンパイル済み or None)
+# プロセスプールの各プロセスでも、同じフォーマットならコンパイルし直さない。
+# プールが使えずリクエストのスレッドで生成する時もあるので、組ごと1回で差し替える
+_template = None
+_template_lock = threading.Lock()
+
+# 注文書生成のプロセスプール（プロセスごとに1つ、最初の注文書作成で作って使い回す）
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def _reset_after_fork():
+    # 親のプールはforkした子からは使えない（gunicornのpreload）
+    global _render_pool, _render_pool_lock, _template_lock
+    _render_pool = None
+    _render_pool_lock = threading.Lock()
+    _template_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _load_template(template_bytes, render_mode=ORDER_SHEET_RENDER_MODE):
+    """template_bytesの (ダイジェスト, bytes, コンパイル済み or None) を返す（同じフォーマットなら前回の分）"""
+    global _template
+    digest = hashlib.sha1(template_bytes).hexdigest()
+    with _template_lock:
+        if _template is not None and _template[0] == digest:
+            return _template
+        compiled = None
+        if render_mode == 'fast':
+            try:
+                compiled = CompiledOrderTemplate(template_bytes, ORDER_TARGET_CELLS)
+            except Exception as e:
+                print(f"注文書フォーマットのコンパイルに失敗したためopenpyxlで生成します: {e}")
+        _template = (digest, template_bytes, compiled)
+        return _template
+
+def safe_set(ws, cell_addr, value):
+    # 結合セル（左上以外）は書き込めないので触らない
+    cell = ws[cell_addr]
+    if not isinstance(cell, MergedCell):
+        cell.value = value
+
+def format_delivery_date(orig):
+    if isinstance(orig, str) and len(orig) == 8 and orig.isdigit():
+        return datetime.strptime(orig, "%Y%m%d").strftime("%Y/%m/%d")
+    return orig
+
+def split_pages(items, per_page=ORDER_ROWS_PER_PAGE):
+    """明細を1ページ15行ずつに分割（0件でも1ページ）"""
+    return [items[i:i + per_page] for i in range(0, len(items), per_page)] or [[]]
+
+def order_page_values(header, page_rows):
+    """1ページ分の {セル座標: 値}"""
+    values = {
+        "B6": header["発注先"],
+        "B7": header["郵便番号"],
+        "B8": header["住所"],
+        "P4": header["発行日"],
+    }
+    for i, row in enumerate(page_rows):
+        row_idx = ORDER_ROW_START + i
+        values[f"B{row_idx}"] = row["商品名"]
+        if "消費税" in row:
+            values[f"K{row_idx}"] = "※" if str(row.get("消費税", "")).strip() == "10%" else ""
+        values[f"L{row_idx}"] = row["数量"]
+        values[f"M{row_idx}"] = row["単位"]
+        values[f"F{row_idx}"] = row["サイズ"]
+        values[f"H{row_idx}"] = format_delivery_date(row["納品希望日"])
+    return values
+
+def _fill_order_page(ws, header, page_rows):
+    for addr, value in order_page_values(header, page_rows).items():
+        safe_set(ws, addr, value)
+
+def render_order_workbook(template_bytes, header, rows):
+    """
+    注文書フォーマットに1発注先分を書き込み、xlsxのbytesを返す
+    15行を超える分は同じフォーマットのシートをコピーして次ページに続ける
+    """
+    wb = load_workbook(io.BytesIO(template_bytes))
+    ws = wb.active
+    pages = split_pages(rows)
+    # 書き込み前の白紙フォーマットから追加ページを複製する
+    sheets = [ws]
+    for page_no in range(2, len(pages) + 1):
+        ws_page = wb.copy_worksheet(ws)
+        ws_page.title = f"{ws.title}({page_no})"
+        sheets.append(ws_page)
+    for ws_page, page_rows in zip(sheets, pages):
+        _fill_order_page(ws_page, header, page_rows)
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+def _render_job(job, template):
+    dest_name, header, rows = job
+    _, template_bytes, compiled = template
+    # 1ページに収まるものはXML差し替えで生成、複数ページはシート複製が必要なのでopenpyxl
+    if compiled is not None and len(rows) <= ORDER_ROWS_PER_PAGE:
+        return dest_name, compiled.render(order_page_values(header, rows))
+    return dest_name, render_order_workbook(template_bytes, header, rows)
+
+def build_order_jobs(df, today_str, issue_date=None):
+    """
+    注文リストDataFrameを発注先ごとの(ファイル名, ヘッダ, 明細)に変換
+    プロセス間で受け渡すため、明細はpickle可能なdictのリストにする
+    """
+    issue_date = issue_date or pd.Timestamp.today().strftime("%Y/%m/%d")
+    jobs = []
+    count = 1
+    for supplier, g in df.groupby("発注先"):
+        if not supplier or str(supplier).strip() == "":
+            continue
+        first = g.iloc[0]
+        header = {
+            "発注先": first["発注先"],
+            "郵便番号": first["郵便番号"],
+            "住所": first["住所"],
+            "発行日": issue_date,
+        }
+        columns = ["商品名", "数量", "単位", "サイズ", "納品希望日"]
+        if "消費税" in g.columns:
+            columns.append("消費税")
+        rows = g[columns].to_dict("records")
+        jobs.append((f"注文書_{today_str}_{count:03d}.xlsx", header, rows))
+        count += 1
+    return jobs
+
+def _render_chunk(template_bytes, jobs):
+    template = _load_template(template_bytes)
+    return [_render_job(job, template) for job in jobs]
+
+def _pool_size():
+    return ORDER_SHEET_RENDER_WORKERS if ORDER_SHEET_RENDER_WORKERS > 0 else (os.cpu_count() or 1)
+
+def _get_render_pool():
+    """
+    このプロセスのプロセスプール
+    リクエストのスレッドからforkすると、他のスレッドが持っていたロック（logging・ジャーナル等）が
+    子プロセスで取られたままになりうるので、forkserver（なければspawn）で起動する
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _render_pool = ProcessPoolExecutor(
+                max_workers=_pool_size(), mp_context=multiprocessing.get_context(method),
+            )
+        return _render_pool
+
+def _discard_render_pool(pool):
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False)
+
+def _render_all(jobs, template_bytes, max_workers):
+    if max_workers <= 1 or len(jobs) <= 1:
+        return _render_chunk(template_bytes, jobs)
+    # フォーマットはチャンクごとに1回だけ渡す（各プロセスは同じフォーマットならコンパイル済みを使う）
+    chunks = [jobs[i::max_workers] for i in range(max_workers)]
+    pool = _get_render_pool()
+    try:
+        results = list(pool.map(_render_chunk, [template_bytes] * len(chunks), chunks))
+    except BrokenProcessPool as e:
+        # プロセスが落ちたプールは作り直す（今回の分はこのプロセスで生成する）
+        print(f"注文書生成のプロセスプールが停止したため作り直します: {e}")
+        _discard_render_pool(pool)
+        return _render_chunk(template_bytes, jobs)
+    rendered = {dest_name: data for chunk in results for dest_name, data in chunk}
+    return [(dest_name, rendered[dest_name]) for dest_name, _, _ in jobs]
+
+def _upload_one(rendered, folder_id):
+    dest_name, data = rendered
+    upload_bytes_to_drive(data, dest_name, folder_id)
+    return dest_name
+
+def generate_order_sheets(df, template_bytes, order_folder_id, today_str,
+                          render_workers=None, upload_workers=None):
+    """
+    発注先ごとの注文書をプロセスプールで生成し、スレッドプールで並列アップロードする
+    戻り値: アップロードしたファイル名リスト
+    """
+    started = time.perf_counter()
+    jobs = build_order_jobs(df, today_str)
+    if not jobs:
+        print("発注先が設定された注文がありません")
+        return []
+
+    if render_workers is None:
+        render_workers = _pool_size()
+    upload_workers = upload_workers or ORDER_SHEET_UPLOAD_WORKERS
+
+    rendered = _render_all(jobs, template_bytes, min(render_workers, len(jobs)))
+    render_done = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(upload_workers, len(rendered)))) as pool:
+        uploaded = list(pool.map(lambda r: _upload_one(r, order_folder_id), rendered))
+    finished = time.perf_counter()
+
+    multi_page = sum(1 for _, _, rows in jobs if len(rows) > ORDER_ROWS_PER_PAGE)
+    print(
+        f"注文書作成: {len(uploaded)}件（複数ページ {multi_page}件） "
+        f"生成 {render_done - started:.2f}秒 / アップロード {finished - render_done:.2f}秒 / 合計 {finished - started:.2f}秒"
+    )
+    return uploaded
@@ -0,0 +1,209 @@
+# handlers/order_sheet_renderer.py
+"""
+注文書フォーマットをopenpyxlで毎回読み書きせず、シートXMLを事前コンパイルして
+対象セルの値だけを差し替える高速レンダラ
+"""
+import io
+import math
+import numbers
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from openpyxl.utils import column_index_from_string, range_boundaries
+from openpyxl.utils.cell import coordinate_from_string
+
+_ROW_RE = re.compile(r'<row\b[^>]*?(?:/>|>.*?</row>)', re.S)
+_CELL_RE = re.compile(r'<c\b[^>]*?(?:/>|>.*?</c>)', re.S)
+_ATTR_R_RE = re.compile(r'\br="([A-Z]+)?(\d+)"')
+_ATTR_S_RE = re.compile(r'\bs="(\d+)"')
+_SPANS_RE = re.compile(r'\s+spans="[^"]*"')
+_MERGE_RE = re.compile(r'<mergeCell\s+ref="([A-Z0-9:]+)"\s*/>')
+_ILLEGAL_CHARS_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _cell_key(coord):
+    col, row = coordinate_from_string(coord)
+    return row, column_index_from_string(col)
+
+def _merged_hidden_cells(sheet_xml):
+    """結合範囲の左上以外のセル（openpyxlでMergedCellになるセル）の集合"""
+    hidden = set()
+    for ref in _MERGE_RE.findall(sheet_xml):
+        min_col, min_row, max_col, max_row = range_boundaries(ref)
+        for r in range(min_row, max_row + 1):
+            for c in range(min_col, max_col + 1):
+                if (r, c) != (min_row, min_col):
+                    hidden.add((r, c))
+    return hidden
+
+def _active_sheet_path(parts):
+    workbook_xml = parts['xl/workbook.xml'].decode('utf-8')
+    rels_xml = parts['xl/_rels/workbook.xml.rels'].decode('utf-8')
+    m = re.search(r'activeTab="(\d+)"', workbook_xml)
+    active = int(m.group(1)) if m else 0
+    rids = re.findall(r'<sheet\b[^>]*?\br:id="([^"]+)"', workbook_xml)
+    rid = rids[active]
+    for rel in re.findall(r'<Relationship\b[^>]*/>', rels_xml):
+        if f'Id="{rid}"' in rel:
+            target = re.search(r'Target="([^"]+)"', rel).group(1)
+            return target.lstrip('/') if target.startswith('/') else f'xl/{target}'
+    raise ValueError(f"シート {rid} のパスが見つかりません")
+
+def _render_cell(coord, style, value):
+    s_attr = f' s="{style}"' if style is not None else ''
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return f'<c r="{coord}"{s_attr}/>'
+    if isinstance(value, bool):
+        return f'<c r="{coord}"{s_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, numbers.Number):
+        return f'<c r="{coord}"{s_attr}><v>{value}</v></c>'
+    text = escape(_ILLEGAL_CHARS_RE.sub('', str(value)))
+    return f'<c r="{coord}"{s_attr} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+class CompiledOrderTemplate:
+    """
+    注文書フォーマットxlsxを1回だけ解析し、差し替え対象セルの位置をプレースホルダ化したもの
+    render()はシートXMLの文字列結合とzip書き出しだけで1ファイルを生成する
+    valuesにない対象セルはフォーマットのまま残す（openpyxlで書き込むのと同じ）
+    """
+
+    def __init__(self, template_bytes, target_cells):
+        with zipfile.ZipFile(io.BytesIO(template_bytes)) as zf:
+            self._infos = zf.infolist()
+            parts = {info.filename: zf.read(info.filename) for info in self._infos}
+        self._sheet_path = _active_sheet_path(parts)
+        sheet_xml = parts[self._sheet_path].decode('utf-8')
+
+        # safe_setと同じく、結合セル（左上以外）は対象から外す
+        hidden = _merged_hidden_cells(sheet_xml)
+        self.writable = {c for c in target_cells if _cell_key(c) not in hidden}
+        self._segments, self._styles, self._originals = self._compile_sheet(sheet_xml, self.writable)
+
+        # 値を差し替えると数式のキャッシュ値が古くなるので、開いた時に再計算させる
+        workbook_xml = parts['xl/workbook.xml'].decode('utf-8')
+        if 'fullCalcOnLoad' not in workbook_xml:
+            if '<calcPr' in workbook_xml:
+                workbook_xml = workbook_xml.replace('<calcPr', '<calcPr fullCalcOnLoad="1"', 1)
+            else:
+                anchor = '<extLst' if '<extLst' in workbook_xml else '</workbook>'
+                workbook_xml = workbook_xml.replace(anchor, '<calcPr fullCalcOnLoad="1"/>' + anchor, 1)
+        parts['xl/workbook.xml'] = workbook_xml.encode('utf-8')
+        self._parts = parts
+
+    @staticmethod
+    def _compile_sheet(sheet_xml, targets):
+        """
+        sheetData内の対象セルをプレースホルダ（セル座標）に置き換えたセグメント列を作る
+        テンプレートに存在しないセル・行は列順／行順を守って挿入する
+        戻り値: (セグメント列, {座標: スタイル}, {座標: 元のセルXML（なければ''）})
+        """
+        start = sheet_xml.index('<sheetData')
+        end = sheet_xml.index('</sheetData>') if '</sheetData>' in sheet_xml else None
+        if end is None:
+            # <sheetData/> の場合
+            head = sheet_xml[:start]
+            tail = sheet_xml[sheet_xml.index('/>', start) + 2:]
+            body, open_tag = '', '<sheetData>'
+        else:
+            open_end = sheet_xml.index('>', start) + 1
+            head, open_tag = sheet_xml[:start], sheet_xml[start:open_end]
+            body, tail = sheet_xml[open_end:end], sheet_xml[end + len('</sheetData>'):]
+
+        pending = {}
+        for coord in targets:
+            row, col = _cell_key(coord)
+            pending.setdefault(row, []).append((col, coord))
+
+        styles = {}
+        originals = {}
+        segments = [head + open_tag]
+
+        def emit_placeholder(coord, style=None, original=''):
+            styles[coord] = style
+            originals[coord] = original
+            segments.append(('cell', coord))
+
+        def emit_new_row(row_no):
+            segments.append(f'<row r="{row_no}">')
+            for _, coord in sorted(pending.pop(row_no)):
+                emit_placeholder(coord)
+            segments.append('</row>')
+
+        for row_m in _ROW_RE.finditer(body):
+            row_xml = row_m.group(0)
+            row_no = int(re.search(r'\br="(\d+)"', row_xml).group(1))
+            for missing in sorted(r for r in pending if r < row_no):
+                emit_new_row(missing)
+            if row_no not in pending:
+                segments.append(row_xml)
+                continue
+
+            wanted = sorted(pending.pop(row_no))
+            row_open_end = row_xml.index('>') + 1
+            if row_xml.endswith('/>'):
+                row_open, cells_xml = row_xml[:-2] + '>', ''
+            else:
+                row_open, cells_xml = row_xml[:row_open_end], row_xml[row_open_end:-len('</row>')]
+            segments.append(_SPANS_RE.sub('', row_open))
+            pos = 0
+            col = 0
+            for cell_m in _CELL_RE.finditer(cells_xml):
+                cell_xml = cell_m.group(0)
+                cell_open = cell_xml[:cell_xml.index('>')]
+                # r属性は省略できる（省略時は直前のセルの次の列）
+                ref = _ATTR_R_RE.search(cell_open)
+                col = column_index_from_string(ref.group(1)) if ref and ref.group(1) else col + 1
+                while wanted and wanted[0][0] < col:
+                    _, coord = wanted.pop(0)
+                    segments.append(cells_xml[pos:cell_m.start()])
+                    pos = cell_m.start()
+                    emit_placeholder(coord)
+                if wanted and wanted[0][0] == col:
+                    _, coord = wanted.pop(0)
+                    segments.append(cells_xml[pos:cell_m.start()])
+                    pos = cell_m.end()
+                    s_m = _ATTR_S_RE.search(cell_open)
+                    if ref is None:
+                        # 書き戻すセルには座標を付けておく（後ろに挿入したセルとの順序が崩れないように）
+                        cell_xml = f'<c r="{coord}"' + cell_xml[len('<c'):]
+                    emit_placeholder(coord, s_m.group(1) if s_m else None, cell_xml)
+            segments.append(cells_xml[pos:])
+            for _, coord in wanted:
+                emit_placeholder(coord)
+            segments.append('</row>')
+        for missing in sorted(pending):
+            emit_new_row(missing)
+        segments.append('</sheetData>' + tail)
+
+        # 連続する文字列セグメントは結合しておく
+        merged = []
+        for seg in segments:
+            if isinstance(seg, str) and merged and isinstance(merged[-1], str):
+                merged[-1] += seg
+            else:
+                merged.append(seg)
+        return merged, styles, originals
+
+    def render(self, values):
+        """
+        values: {セル座標: 値}（結合セルなど書き込めない座標は無視。valuesにない対象セルはフォーマットのまま）
+        戻り値: xlsxのbytes
+        """
+        out_parts = []
+        for seg in self._segments:
+            if isinstance(seg, str):
+                out_parts.append(seg)
+                continue
+            coord = seg[1]
+            if coord in values:
+                out_parts.append(_render_cell(coord, self._styles[coord], values[coord]))
+            else:
+                out_parts.append(self._originals[coord])
+        sheet_xml = ''.join(out_parts).encode('utf-8')
+
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for info in self._infos:
+                data = sheet_xml if info.filename == self._sheet_path else self._parts[info.filename]
+                zf.writestr(info.filename, data)
+        return buf.getvalue()
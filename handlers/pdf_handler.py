@@ -1,86 +1,117 @@
 # handlers/pdf_handler.py
 import os
-import requests
+import io
+import asyncio
 import base64
 from openai import OpenAI
-from pdf2image import convert_from_path
-from handlers.prompt_templates import IMAGE_ORDER_PROMPT
-from handlers.file_handler import get_or_create_folder, save_pdf_to_drive
-from handlers.csv_handler import append_to_xlsx
-from handlers.utils import get_now, get_operator_name
+from pdf2image import convert_from_bytes
+from handlers.image_handler import image_order_messages
+from handlers.file_handler import get_order_folders, save_pdf_to_drive
+from handlers.csv_handler import prepare_order_rows, append_order_rows
+from handlers.utils import get_now, get_operator_name, get_message_content, clean_order_content
+from handlers.metrics import stage
+from handlers.llm_client import chat_completion, achat_completion
+from handlers.resilience import stage_budget
+from handlers.diagnostics import diag
+from handlers.task_graph import TaskGraph
 
+def pdf_pages_base64(pdf_data):
+    """PDF（bytes）をページごとのJPEG（base64）にする"""
+    pages = []
+    for image in convert_from_bytes(pdf_data):
+        buf = io.BytesIO()
+        image.save(buf, 'JPEG')
+        pages.append(base64.b64encode(buf.getvalue()).decode("utf-8"))
+    return pages
+
+@stage('gpt_extraction')
+@stage_budget('gpt_extraction')
 def analyze_pdf_with_gpt(pdf_path, operator_name, now_str, now_verbose, openai_client, max_retries=3):
     # 1. PDFを画像（JPEG）にページごとに変換
-    images = convert_from_path(pdf_path)
+    with open(pdf_path, 'rb') as f:
+        pages = pdf_pages_base64(f.read())
     results = []
-    for i, image in enumerate(images):
-        img_path = f"/tmp/pdf_page_{i}.jpg"
-        image.save(img_path, 'JPEG')
-        with open(img_path, "rb") as image_file:
-            image_base64 = base64.b64encode(image_file.read()).decode("utf-8")
-        prompt = IMAGE_ORDER_PROMPT.format(
-            now_verbose=now_verbose,
-            operator_name=operator_name,
-            now_str=now_str
-        )
+    for i, image_base64 in enumerate(pages):
+        messages = image_order_messages(image_base64, operator_name, now_str, now_verbose)
         for attempt in range(max_retries):
-            response = openai_client.chat.completions.create(
+            response = chat_completion(
+                openai_client,
+                attempt=attempt + 1,
                 model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "あなたは画像の内容をEXCEL形式に変換するアシスタントです。"},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
-                    ]}
-                ],
+                messages=messages,
                 max_tokens=1000,
                 temperature=0.2
             )
-            content = response.choices[0].message.content.strip()
-            print("GPT content:", content)
-            if "申し訳ありません" in content or "直接抽出することはできません" in content:
-                continue
-            lines = content.splitlines()
-            cleaned_lines = [line for line in lines if not line.strip().startswith("この情報") and line.strip() not in ["...", "…"]]
-            results.append("\n".join(cleaned_lines))
-            break  # 成功したらretryしない
-        os.remove(img_path)
+            content = response.choices[0].message.content
+            diag('pdf_gpt_content', page=i, attempt=attempt + 1, content=content)
+            structured_text = clean_order_content(content)
+            if structured_text is not None:
+                results.append(structured_text)
+                break  # 成功したらretryしない
     if not results:
         print("構造化テキストが空です。GPT応答なしまたはすべて謝罪文")
         return ""
     return "\n".join(results)
 
+async def analyze_pdf_with_gpt_async(pdf_data, operator_name, now_str, now_verbose, openai_client, max_retries=3):
+    """analyze_pdf_with_gptのasync版（PDFはbytes、クライアントはAsyncOpenAI）。ページは同時に解析する"""
+    async def analyze_page(i, image_base64):
+        messages = image_order_messages(image_base64, operator_name, now_str, now_verbose)
+        for attempt in range(max_retries):
+            response = await achat_completion(
+                openai_client,
+                attempt=attempt + 1,
+                model="gpt-4o",
+                messages=messages,
+                max_tokens=1000,
+                temperature=0.2
+            )
+            content = response.choices[0].message.content
+            diag('pdf_gpt_content', page=i, attempt=attempt + 1, content=content)
+            structured_text = clean_order_content(content)
+            if structured_text is not None:
+                return structured_text
+        return None
+
+    with stage('gpt_extraction'), stage_budget('gpt_extraction'):
+        # ページ画像への変換はCPU処理なのでイベントループの外で行う
+        pages = await asyncio.to_thread(pdf_pages_base64, pdf_data)
+        page_texts = await asyncio.gather(*(analyze_page(i, b64) for i, b64 in enumerate(pages)))
+    results = [text for text in page_texts if text is not None]
+    if not results:
+        print("構造化テキストが空です。GPT応答なしまたはすべて謝罪文")
+        return ""
+    return "\n".join(results)
+
+def extract_pdf_order(pdf_data, operator_name, message_id, now_str, now_verbose, openai_client):
+    """PDF→テキスト（GPT解析）。並列で呼ばれても衝突しないよう一時ファイル名はメッセージIDで分ける"""
+    pdf_path = f'/tmp/{message_id}.pdf'
+    with open(pdf_path, 'wb') as f:
+        f.write(pdf_data)
+    try:
+        return analyze_pdf_with_gpt(pdf_path, operator_name, now_str, now_verbose, openai_client)
+    finally:
+        os.remove(pdf_path)
+
 def process_pdf_message(event):
     user_id = event['source']['userId']
     headers = {'Authorization': f'Bearer {os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")}'}
-    operator_name = get_operator_name(user_id, headers)
     now, now_str, now_verbose = get_now()
-
-    # PDF取得
     message_id = event['message']['id']
-    pdf_url = f'https://api-data.line.me/v2/bot/message/{message_id}/content'
-    pdf_data = requests.get(pdf_url, headers=headers).content
     file_name = now.strftime('%Y%m%d_%H%M') + '.pdf'
-
-    # Google Drive保存先取得
-    root_id = get_or_create_folder('受注集計')
-    date_id = get_or_create_folder(now.strftime('%Y%m%d'), parent_id=root_id)
-    pdf_folder_id = get_or_create_folder('PDF保存', parent_id=date_id)
-    csv_folder_id = get_or_create_folder('集計結果', parent_id=date_id)
-
-    # PDF保存
-    save_pdf_to_drive(pdf_data, file_name, pdf_folder_id)  # PDFバイナリ保存
-
-    # PDF→テキスト（GPT解析）
     openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    pdf_path = f'/tmp/{file_name}'
-    with open(pdf_path, 'wb') as f:
-        f.write(pdf_data)
-    structured_text = analyze_pdf_with_gpt(
-        pdf_path, operator_name, now_str, now_verbose, openai_client
-    )
-    os.remove(pdf_path)
 
-    # CSV追記
-    openai_client = OpenAI()
-    append_to_xlsx(structured_text, csv_folder_id, openai_client)
+    # ユーザー名・PDF取得・Drive保存先は同時に始める。
+    # PDF保存（PDFと保存先待ち）とGPT解析（PDFとユーザー名待ち）は並行、集計への追記は解析と保存先を待つ（解析した行はその場で注文のジャーナルに記録する）
+    graph = TaskGraph()
+    graph.add('operator', get_operator_name, user_id, headers)
+    graph.add('pdf', get_message_content, message_id, headers)
+    graph.add('folders', get_order_folders, now.strftime('%Y%m%d'), 'PDF保存')
+    graph.add('save_original', lambda pdf_data, folders: save_pdf_to_drive(pdf_data, file_name, folders[0]),
+              after=['pdf', 'folders'])
+    graph.add('extract', lambda pdf_data, operator_name: prepare_order_rows(extract_pdf_order(
+        pdf_data, operator_name, message_id, now_str, now_verbose, openai_client
+    )), after=['pdf', 'operator'])
+    graph.add('append', lambda prepared, folders: append_order_rows(prepared, folders[1], openai_client),
+              after=['extract', 'folders'])
+    graph.run()
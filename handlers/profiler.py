@@ -0,0 +1,218 @@
+# handlers/profiler.py
+"""
+稼働中のワーカーを止めずに調べるためのオンデマンドプロファイラ（/admin/profile から操作する）
+
+  start_profiling(seconds, events) : 指定秒数、または次のN件のWebhookの間だけプロファイルする
+  stop_profiling()                 : 途中で止めて結果を書き出す
+  profile_request(kind)            : Webhook1件分（app.pyで囲む）。オフの間は何もしない
+  dump_stacks()                    : 全スレッドの今のスタック（止まっている処理の確認用）
+
+オンの間は
+  - 別スレッドでWebhook処理中のスレッドのスタックを一定間隔で採取し、種別（text / image / pdf / コマンド名）ごとに
+    collapsed stacks（flamegraph.pl・speedscopeでそのまま読める「関数;関数;関数 回数」形式）にまとめる
+  - Webhook1件ごとにcProfileも掛け、種別ごとのpstatsにまとめる（with_pstats=False で掛けない）
+結果は PROFILE_OUTPUT_DIR/<開始時刻>_<pid>/ に <種別>.collapsed / <種別>.pstats として書き出す
+gunicornではプロファイルは要求を受けたワーカーだけに掛かる（ワーカーごとにpidの違うディレクトリになる）
+"""
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import traceback
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+from config import PROFILE_OUTPUT_DIR, PROFILE_SAMPLE_INTERVAL_MS, PROFILE_MAX_SECONDS
+from handlers.task_graph import register_context
+
+class ProfileSession:
+    """1回分のプロファイル（採取したスタックとpstatsを種別ごとに持つ）"""
+
+    def __init__(self, seconds, events, interval_ms, with_pstats):
+        self.seconds = seconds
+        self.events = events
+        self.interval = interval_ms / 1000
+        self.with_pstats = with_pstats
+        self.started_at = datetime.now()
+        self.output_dir = os.path.join(
+            PROFILE_OUTPUT_DIR, f"{self.started_at.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+        )
+        self.threads = {}  # スレッドID → 種別（処理中のWebhook）
+        self.stacks = defaultdict(Counter)
+        self.stats = {}
+        self.samples = 0
+        self.finished_events = 0
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.files = []
+
+    def sample_loop(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                targets = list(self.threads.items())
+            collapsed = [
+                (kind, _collapse(frames[ident])) for ident, kind in targets if ident in frames and ident != me
+            ]
+            with self.lock:
+                for kind, stack in collapsed:
+                    self.stacks[kind][stack] += 1
+                self.samples += len(collapsed)
+            if (datetime.now() - self.started_at).total_seconds() >= self.seconds:
+                stop_profiling(self)
+                return
+
+    def add_stats(self, kind, profile):
+        with self.lock:
+            if kind in self.stats:
+                self.stats[kind].add(profile)
+            else:
+                self.stats[kind] = pstats.Stats(profile)
+
+    def write(self):
+        """種別ごとの .collapsed / .pstats を書き出してファイルパスを返す"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        with self.lock:
+            stacks = {kind: Counter(counter) for kind, counter in self.stacks.items()}
+            stats = dict(self.stats)
+        files = []
+        for kind, counter in stacks.items():
+            path = os.path.join(self.output_dir, f'{_safe_name(kind)}.collapsed')
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in counter.most_common():
+                    f.write(f'{stack} {count}\n')
+            files.append(path)
+        for kind, kind_stats in stats.items():
+            path = os.path.join(self.output_dir, f'{_safe_name(kind)}.pstats')
+            kind_stats.dump_stats(path)
+            files.append(path)
+        self.files = files
+        return files
+
+    def info(self):
+        return {
+            'running': not self.stopped.is_set(),
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'seconds': self.seconds,
+            'events': self.events,
+            'finished_events': self.finished_events,
+            'samples': self.samples,
+            'pid': os.getpid(),
+            'output_dir': self.output_dir,
+            'files': self.files,
+        }
+
+def _collapse(frame):
+    """フレームを外側から「ファイル:関数」の;区切りにする"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names)).replace(' ', '_')
+
+def _safe_name(kind):
+    return ''.join('_' if c in '/\\:*?"<>| ' else c for c in kind) or '-'
+
+_session = None
+_last_session = None
+_control_lock = threading.Lock()
+_local = threading.local()
+
+def _restore_kind(kind):
+    # タスクグラフのスレッドも、動いている間は採取対象にする（cProfileは呼び出し元スレッドのみ）
+    _local.kind = kind
+    session = _session
+    if session is None:
+        return
+    ident = threading.get_ident()
+    with session.lock:
+        if kind:
+            session.threads[ident] = kind
+        else:
+            session.threads.pop(ident, None)
+
+register_context(lambda: getattr(_local, 'kind', None), _restore_kind)
+
+def start_profiling(seconds=None, events=None, interval_ms=PROFILE_SAMPLE_INTERVAL_MS, with_pstats=True):
+    """
+    プロファイルを開始する。実行中ならRuntimeError
+    件数指定でも、消し忘れないよう最長PROFILE_MAX_SECONDS秒で止める
+    """
+    global _session
+    with _control_lock:
+        if _session is not None:
+            raise RuntimeError("プロファイルは既に実行中です")
+        seconds = min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        session = ProfileSession(seconds, events, max(1, interval_ms), with_pstats)
+        threading.Thread(target=session.sample_loop, name='profile-sampler', daemon=True).start()
+        _session = session
+    print(f"プロファイル開始: {seconds}秒" + (f" / {events}件" if events else ""))
+    return session.info()
+
+def stop_profiling(session=None):
+    """
+    実行中のプロファイルを止めて結果を書き出す（実行中でなければ前回の結果）
+    sessionを渡した場合は、それが実行中の時だけ止める（時間切れ・件数到達での停止用）
+    """
+    global _session, _last_session
+    with _control_lock:
+        if _session is None or (session is not None and session is not _session):
+            return _last_session.info() if _last_session else None
+        session = _session
+        _session = None
+        session.stopped.set()
+    # 処理中のWebhookがpstatsを足し終わるのを待たず、その時点までで書き出す
+    session.write()
+    _last_session = session
+    print(f"プロファイル終了: サンプル{session.samples}件 / Webhook{session.finished_events}件 → {session.output_dir}")
+    return session.info()
+
+def profiling_status():
+    session = _session or _last_session
+    return session.info() if session else {'running': False}
+
+@contextmanager
+def profile_request(kind):
+    """Webhook1件分。プロファイルがオフなら何もしない"""
+    session = _session
+    if session is None:
+        yield
+        return
+    _local.kind = kind
+    ident = threading.get_ident()
+    with session.lock:
+        session.threads[ident] = kind
+    profile = None
+    if session.with_pstats:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 他のプロファイラが動いている（Python 3.12以降は同時に1つだけ）
+            profile = None
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+            session.add_stats(kind, profile)
+        _local.kind = None
+        with session.lock:
+            session.threads.pop(ident, None)
+            session.finished_events += 1
+            done = session.events and session.finished_events >= session.events
+        if done:
+            stop_profiling(session)
+
+def dump_stacks():
+    """全スレッドの今のスタックを文字列で返す"""
+    names = {t.ident: t.name for t in threading.enumerate()}
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append(f'--- {names.get(ident, ident)} ({ident})')
+        lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,247 @@
+# handlers/resilience.py
+"""
+外部サービス（openai / line / drive）のサーキットブレーカーと、Webhook1件の締め切り
+
+  guard(service)          : 外部呼び出し1回（with guard('openai') as timeout: ...）。timeoutはその呼び出しに使う秒数
+                            遮断中ならCircuitOpenError、締め切りを過ぎていればDeadlineExceededを投げて呼ばない
+  deadline_scope(seconds) : Webhook1件分の締め切り（admissionで到着時から。0なら無し）
+  stage_budget(name)      : 処理段階（gpt_extraction / normalize）に、締め切りまでの時間のうち決まった割合だけを割り当てる
+  remaining()             : 締め切りまでの秒数（締め切りがなければNone）
+
+ブレーカーはサービスごとに1つ（プロセス内で共有）:
+  closed    : 普段。連続でBREAKER_FAILURE_THRESHOLD回失敗したらopenにする（*_SLOW_SECONDSより遅い応答も失敗と数える）
+  open      : BREAKER_OPEN_SECONDSの間は呼ばずにCircuitOpenErrorを投げる
+  half_open : open明けに1件だけ試す（成功ならclosed、失敗ならまたopen）
+
+ブレーカーは既定では無効（BREAKER_ENABLED=0）。締め切りは受付制御（ADMISSION_ENABLED=1）の時だけ設定される。
+遮断中・締め切り切れで処理できなかった注文をスプールに積むには、両方を有効にする
+（受付制御が無効ならFlask版・ASGI版とも503を返してLINEの再送に任せる）
+
+呼べない時（Unavailable）の扱いは呼び出し側で決める:
+担当者名は前回の表示名で代用、注文の抽出・正規化はスプールに積んで後で処理する
+（抽出済みの行はジャーナル（handlers/journal.py）に残り、集計への書き込みは後でまとめて行う）
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from handlers.diagnostics import log
+from handlers.metrics import BREAKER_TRANSITIONS_TOTAL, OUTBOUND_REJECTED_TOTAL
+from handlers.task_graph import register_context
+from config import (
+    BREAKER_ENABLED, BREAKER_FAILURE_THRESHOLD, BREAKER_OPEN_SECONDS,
+    OPENAI_SLOW_SECONDS, OPENAI_TIMEOUT_SECONDS, LINE_SLOW_SECONDS, LINE_HTTP_TIMEOUT,
+    DRIVE_SLOW_SECONDS, DRIVE_HTTP_TIMEOUT,
+    GPT_EXTRACTION_BUDGET_SHARE, NORMALIZE_BUDGET_SHARE,
+)
+
+# サービスごとの (遅いとみなす秒数, 1回の呼び出しのタイムアウト秒数)
+SERVICE_LIMITS = {
+    'openai': (OPENAI_SLOW_SECONDS, OPENAI_TIMEOUT_SECONDS),
+    'line': (LINE_SLOW_SECONDS, LINE_HTTP_TIMEOUT),
+    'drive': (DRIVE_SLOW_SECONDS, DRIVE_HTTP_TIMEOUT),
+}
+
+# 処理段階に割り当てる、締め切り全体に対する割合（残りは原本の保存・集計への書き込みに使う）
+STAGE_SHARES = {
+    'gpt_extraction': GPT_EXTRACTION_BUDGET_SHARE,
+    'normalize': NORMALIZE_BUDGET_SHARE,
+}
+
+class Unavailable(Exception):
+    """外部サービスを今は呼ばない（呼び出し側で代用するか、後で処理する）"""
+    reason = 'unavailable'
+    retry_after = 0
+
+class CircuitOpenError(Unavailable):
+    reason = 'breaker_open'
+
+    def __init__(self, service, retry_after):
+        super().__init__(f"{service}は遮断中です（あと{retry_after:.0f}秒）")
+        self.service = service
+        self.retry_after = retry_after
+
+class DeadlineExceeded(Unavailable):
+    reason = 'deadline_exceeded'
+
+    def __init__(self, service):
+        super().__init__(f"締め切りを過ぎたため{service}を呼びません")
+        self.service = service
+
+class CircuitBreaker:
+    """1サービス分のブレーカー"""
+
+    def __init__(self, name, failure_threshold, slow_seconds, open_seconds):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def before_call(self):
+        """呼んでよければ、half_openの試しの1件かどうかを返す。遮断中ならCircuitOpenError"""
+        with self._lock:
+            if self._state == 'open':
+                waited = time.monotonic() - self._opened_at
+                if waited < self.open_seconds:
+                    raise CircuitOpenError(self.name, self.open_seconds - waited)
+                self._transition('half_open')
+            if self._state == 'half_open':
+                if self._probing:
+                    raise CircuitOpenError(self.name, self.open_seconds)
+                self._probing = True
+                return True
+            return False
+
+    def after_call(self, probe, seconds, failed):
+        failed = failed or (self.slow_seconds > 0 and seconds > self.slow_seconds)
+        with self._lock:
+            if probe:
+                self._probing = False
+                self._failures = 0
+                if failed:
+                    self._open()
+                else:
+                    self._transition('closed')
+            elif self._state == 'closed':
+                if not failed:
+                    self._failures = 0
+                    return
+                self._failures += 1
+                if self._failures >= self.failure_threshold:
+                    self._open()
+            # open中・試しの最中に返ってきた、遮断前からの呼び出しの結果は数えない
+
+    def cancel_probe(self):
+        with self._lock:
+            self._probing = False
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._transition('open')
+
+    def _transition(self, state):
+        if state == self._state:
+            return
+        self._state = state
+        BREAKER_TRANSITIONS_TOTAL.labels(self.name, state).inc()
+        log(logging.WARNING if state == 'open' else logging.INFO, 'breaker_state', service=self.name, state=state)
+
+    def status(self):
+        with self._lock:
+            status = {'state': self._state, 'failures': self._failures}
+            if self._state == 'open':
+                status['retry_after'] = round(max(0.0, self.open_seconds - (time.monotonic() - self._opened_at)), 1)
+            return status
+
+def _build_breakers():
+    return {
+        service: CircuitBreaker(service, BREAKER_FAILURE_THRESHOLD, slow, BREAKER_OPEN_SECONDS)
+        for service, (slow, _) in SERVICE_LIMITS.items()
+    }
+
+_breakers = _build_breakers()
+
+# (締め切りのtime.monotonic(), Webhook全体の秒数)。タスクグラフのスレッドにも引き継ぐ
+_deadline = ContextVar('webhook_deadline', default=None)
+register_context(_deadline.get, _deadline.set)
+
+@contextmanager
+def deadline_scope(seconds):
+    """Webhook1件分の締め切り（secondsが0以下なら締め切りなし）"""
+    if not seconds or seconds <= 0:
+        yield
+        return
+    token = _deadline.set((time.monotonic() + seconds, seconds))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+@contextmanager
+def stage_budget(name):
+    """処理段階の締め切りを、Webhook全体のSTAGE_SHARES[name]の割合までに縮める（段階を出れば元の締め切り）"""
+    current = _deadline.get()
+    share = STAGE_SHARES.get(name)
+    if current is None or not share:
+        yield
+        return
+    deadline, total = current
+    token = _deadline.set((min(deadline, time.monotonic() + share * total), total))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining():
+    current = _deadline.get()
+    return None if current is None else current[0] - time.monotonic()
+
+def _is_service_failure(e):
+    """サービス側の失敗か（4xxのうち408・429以外は呼び出し側の問題なので数えない）"""
+    if isinstance(e, Unavailable):
+        return False
+    status = (
+        getattr(e, 'status_code', None)
+        or getattr(getattr(e, 'response', None), 'status_code', None)
+        or getattr(getattr(e, 'resp', None), 'status', None)
+    )
+    if status is None:
+        # 接続エラー・タイムアウト
+        return True
+    status = int(status)
+    return status >= 500 or status in (408, 429)
+
+@contextmanager
+def guard(service):
+    """外部呼び出し1回。締め切りまでの残りと各サービスのタイムアウトの短い方をyieldする"""
+    timeout = SERVICE_LIMITS[service][1]
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            OUTBOUND_REJECTED_TOTAL.labels(service, DeadlineExceeded.reason).inc()
+            raise DeadlineExceeded(service)
+        timeout = min(timeout, left)
+    if not BREAKER_ENABLED:
+        yield timeout
+        return
+    breaker = _breakers[service]
+    try:
+        probe = breaker.before_call()
+    except CircuitOpenError:
+        OUTBOUND_REJECTED_TOTAL.labels(service, CircuitOpenError.reason).inc()
+        raise
+    started = time.monotonic()
+    try:
+        yield timeout
+    except Exception as e:
+        breaker.after_call(probe, time.monotonic() - started, _is_service_failure(e))
+        raise
+    except BaseException:
+        # asyncioのキャンセル等は結果がわからないので数えない（試しの1件なら次の呼び出しで試し直す）
+        if probe:
+            breaker.cancel_probe()
+        raise
+    breaker.after_call(probe, time.monotonic() - started, False)
+
+def is_open(service):
+    """遮断中か（open明けで試せる状態ならFalse）"""
+    status = _breakers[service].status()
+    return status['state'] == 'open' and status.get('retry_after', 0) > 0
+
+def breaker_status():
+    return {service: breaker.status() for service, breaker in _breakers.items()}
+
+def _reset_after_fork():
+    # ブレーカーの状態とロックはプロセスごと（gunicornのpreload）
+    global _breakers
+    _breakers = _build_breakers()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
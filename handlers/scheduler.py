@@ -0,0 +1,178 @@
+# handlers/scheduler.py
+"""
+翌日分の準備（プロセス内のスケジューラ）
+
+日付が変わって最初のメッセージが、受注集計＞{日付}＞Line画像保存・PDF保存・集計結果 のフォルダ作成と
+空の集計結果xlsxの作成を待たされないように、毎日PREWARM_TIME（日本時間）以降に翌日分を用意しておく
+
+  prepare_day(day) : フォルダと集計結果_{day}.xlsx（台帳モードでは台帳の日）を作る
+                     gunicornの各ワーカーのうち1つだけが行い、SCHEDULER_STATE_DIRに準備済みを記録する
+                     集計結果xlsxは翌日以降の日だけ作る（当日分は届いた注文で作る）
+                     作成は日付最初の注文とロック（file_handler.workbook_create_lock）で排他するので、
+                     準備が日付をまたいで遅れても同名のxlsxを二重に作らない
+  warm_day(day)    : このプロセスのフォルダIDのキャッシュ（file_handler）と重いハンドラの読み込み
+  ensure_scheduler(): 準備のスレッドを起動する（最初のWebhook・gunicornのpost_fork・ASGIのstartupで呼ぶ）
+
+ポーリングごとに当日分（フォルダのみ）と、PREWARM_TIMEを過ぎていれば翌日分を準備する。
+失敗（Driveの遮断中など）は次のポーリングでやり直す
+既定では無効。SCHEDULER_ENABLED=1とSCHEDULER_STATE_DIR（永続ディスク上のディレクトリ）の指定で有効にする
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from handlers.diagnostics import log
+from config import (
+    SCHEDULER_ENABLED, PREWARM_TIME, SCHEDULER_POLL_SECONDS, SCHEDULER_STATE_DIR, ORDER_LEDGER_ENABLED,
+)
+
+JST = pytz.timezone('Asia/Tokyo')
+MARKER_PREFIX = 'prewarmed-'
+# 準備済みの記録を残す日数
+MARKER_KEEP_DAYS = 7
+
+_warmed = set()
+_last_error = None
+_scheduler_started = False
+_scheduler_lock = threading.Lock()
+
+def _reset_after_fork():
+    # キャッシュの温めとスレッドはプロセスごと（gunicornのpreload）
+    global _last_error, _scheduler_started, _scheduler_lock
+    _warmed.clear()
+    _last_error = None
+    _scheduler_started = False
+    _scheduler_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def due_days(now=None):
+    """準備する日（当日と、PREWARM_TIMEを過ぎていれば翌日）"""
+    now = now or datetime.now(JST)
+    days = [now.strftime('%Y%m%d')]
+    hour, minute = (int(v) for v in PREWARM_TIME.split(':'))
+    if (now.hour, now.minute) >= (hour, minute):
+        days.append((now + timedelta(days=1)).strftime('%Y%m%d'))
+    return days
+
+def _marker_path(day):
+    return os.path.join(SCHEDULER_STATE_DIR, f'{MARKER_PREFIX}{day}.json')
+
+def _read_marker(day):
+    try:
+        with open(_marker_path(day), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _remove_old_markers(today):
+    oldest = (datetime.strptime(today, '%Y%m%d') - timedelta(days=MARKER_KEEP_DAYS)).strftime('%Y%m%d')
+    for name in os.listdir(SCHEDULER_STATE_DIR):
+        if name.startswith(MARKER_PREFIX) and name[len(MARKER_PREFIX):-len('.json')] < oldest:
+            os.remove(os.path.join(SCHEDULER_STATE_DIR, name))
+
+def prepare_day(day, today=None):
+    """
+    dayのフォルダと集計結果xlsxを用意して準備済みの記録を返す（他のプロセスが準備済みならその記録）
+    記録: {'day', 'folders', 'workbook'（作成したか）, 'carried'（前日データを入れたか）, 'seconds'}
+    """
+    from handlers.file_handler import get_order_folders
+    from handlers.csv_handler import ensure_ledger_day, seed_day_workbook
+    today = today or datetime.now(JST).strftime('%Y%m%d')
+    seed_workbook = day > today
+    os.makedirs(SCHEDULER_STATE_DIR, exist_ok=True)
+    with open(os.path.join(SCHEDULER_STATE_DIR, 'prewarm.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        marker = _read_marker(day)
+        if marker is not None and (marker['workbook_checked'] or not seed_workbook):
+            return marker
+        started = time.perf_counter()
+        image_folder_id, csv_folder_id = get_order_folders(day, 'Line画像保存')
+        pdf_folder_id, _ = get_order_folders(day, 'PDF保存')
+        seeded = {'created': False, 'carried': False}
+        if seed_workbook:
+            if ORDER_LEDGER_ENABLED:
+                ensure_ledger_day(day, csv_folder_id)
+            else:
+                seeded = seed_day_workbook(day, csv_folder_id)
+        marker = {
+            'day': day,
+            'folders': {'Line画像保存': image_folder_id, 'PDF保存': pdf_folder_id, '集計結果': csv_folder_id},
+            'workbook_checked': seed_workbook,
+            'workbook': seeded['created'],
+            'carried': seeded['carried'],
+            'seconds': round(time.perf_counter() - started, 3),
+        }
+        path = _marker_path(day)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(marker, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        _remove_old_markers(today)
+    log(logging.INFO, 'prewarm_prepared', day=day, workbook=marker['workbook'], carried=marker['carried'],
+        seconds=marker['seconds'])
+    return marker
+
+def warm_day(day):
+    """このプロセスのフォルダIDのキャッシュを埋め、重いハンドラを読み込んでおく"""
+    from handlers.file_handler import get_order_folders
+    from handlers.webhook_handler import preload_handlers
+    get_order_folders(day, 'Line画像保存')
+    get_order_folders(day, 'PDF保存')
+    preload_handlers()
+    _warmed.add(day)
+
+def run_once(now=None):
+    """準備が済んでいない日を準備する。準備した日の一覧を返す"""
+    global _last_error
+    now = now or datetime.now(JST)
+    today = now.strftime('%Y%m%d')
+    done = []
+    for day in due_days(now):
+        if day in _warmed:
+            continue
+        try:
+            prepare_day(day, today)
+            warm_day(day)
+        except Exception as e:
+            # Unavailable（Driveの遮断中）も含め、次のポーリングでやり直す
+            _last_error = f'{day}: {e}'
+            log(logging.WARNING, 'prewarm_error', day=day, error=str(e))
+            continue
+        done.append(day)
+    # 過ぎた日の分は忘れる
+    _warmed.intersection_update(due_days(now))
+    return done
+
+def ensure_scheduler():
+    global _scheduler_started
+    if _scheduler_started or not SCHEDULER_ENABLED:
+        return
+    with _scheduler_lock:
+        if _scheduler_started:
+            return
+        threading.Thread(target=_schedule_loop, name='prewarm-scheduler', daemon=True).start()
+        _scheduler_started = True
+
+def _schedule_loop():
+    while True:
+        try:
+            run_once()
+        except Exception as e:
+            log(logging.ERROR, 'prewarm_loop_error', error=str(e))
+        time.sleep(SCHEDULER_POLL_SECONDS)
+
+def scheduler_status():
+    return {
+        'enabled': SCHEDULER_ENABLED,
+        'running': _scheduler_started,
+        'prewarm_time': PREWARM_TIME,
+        'warmed': sorted(_warmed),
+        'prepared': {day: _read_marker(day) for day in due_days()} if SCHEDULER_STATE_DIR else {},
+        'last_error': _last_error,
+    }
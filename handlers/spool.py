@@ -0,0 +1,124 @@
+# handlers/spool.py
+"""
+Webhookのスプール（SQLite、既定は受注台帳と同じDBファイル）
+混雑で今すぐ処理できないWebhookを本文ごと積んでおき、空いた時にadmissionのスプール処理スレッドが取り出して処理する
+LINEにはすぐ200を返すので、タイムアウトからの再送や取りこぼしにならない
+
+  enqueue(data, kind, work_class, reason) : 積む（同じwebhookEventIdは1回だけ）
+  claim(work_class)                       : 処理待ちを1件取り出す（gunicornの複数ワーカーから取り合っても1件は1回だけ）
+  complete(spool_id) / fail(spool_id, error) : 処理結果。失敗はSPOOL_MAX_ATTEMPTS回まで間隔を空けて再試行する
+  defer(spool_id, error, delay)           : 外部サービスの遮断中で処理できなかった（試行回数に数えずdelay秒後に戻す）
+  recover_stale()                         : 取り出したまま止まったもの（ワーカーの異常終了）を処理待ちに戻す
+"""
+import json
+import time
+
+from handlers.ledger_handler import get_connection, ensure_schema
+from config import SPOOL_PATH, SPOOL_MAX_ATTEMPTS, SPOOL_CLAIM_TIMEOUT_SECONDS
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT UNIQUE,
+    kind TEXT,
+    work_class TEXT,
+    reason TEXT,
+    body TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    claimed_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_webhook_spool_state ON webhook_spool(state, work_class, next_at);
+"""
+
+def _connection():
+    conn = get_connection(SPOOL_PATH)
+    ensure_schema(conn, SPOOL_PATH, _SCHEMA)
+    return conn
+
+def enqueue(data, kind, work_class, reason, event_id=None, delay=0):
+    """Webhook本文を積む（delay秒後から取り出せる）。同じevent_id（LINEの再送）が既にあれば積まずにFalse"""
+    conn = _connection()
+    now = time.time()
+    cur = conn.execute(
+        "INSERT OR IGNORE INTO webhook_spool (event_id, kind, work_class, reason, body, received_at, next_at)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (event_id, kind, work_class, reason, json.dumps(data, ensure_ascii=False), now, now + delay),
+    )
+    conn.commit()
+    return cur.rowcount == 1
+
+def claim(work_class):
+    """処理待ちのうち最も古い1件を取り出して (id, kind, 本文, 試行回数) を返す（なければNone）"""
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT id, kind, body, attempts FROM webhook_spool"
+            " WHERE state = 'queued' AND work_class = ? AND next_at <= ? ORDER BY id LIMIT 1",
+            (work_class, time.time()),
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE webhook_spool SET state = 'running', claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (time.time(), row[0]),
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if row is None:
+        return None
+    spool_id, kind, body, attempts = row
+    return spool_id, kind, json.loads(body), attempts + 1
+
+def complete(spool_id):
+    conn = _connection()
+    conn.execute("DELETE FROM webhook_spool WHERE id = ?", (spool_id,))
+    conn.commit()
+
+def fail(spool_id, error):
+    """失敗を記録する。試行回数が上限に達したら'failed'で止める（tools等で確認して手で再投入する）"""
+    conn = _connection()
+    attempts = conn.execute("SELECT attempts FROM webhook_spool WHERE id = ?", (spool_id,)).fetchone()
+    if attempts is None:
+        return
+    if attempts[0] >= SPOOL_MAX_ATTEMPTS:
+        conn.execute(
+            "UPDATE webhook_spool SET state = 'failed', last_error = ? WHERE id = ?", (str(error), spool_id),
+        )
+    else:
+        # 30秒・60秒・120秒…と間隔を空ける
+        conn.execute(
+            "UPDATE webhook_spool SET state = 'queued', last_error = ?, next_at = ? WHERE id = ?",
+            (str(error), time.time() + 30 * 2 ** (attempts[0] - 1), spool_id),
+        )
+    conn.commit()
+
+def defer(spool_id, error, delay):
+    conn = _connection()
+    conn.execute(
+        "UPDATE webhook_spool SET state = 'queued', attempts = attempts - 1, last_error = ?, next_at = ? WHERE id = ?",
+        (str(error), time.time() + delay, spool_id),
+    )
+    conn.commit()
+
+def recover_stale():
+    """SPOOL_CLAIM_TIMEOUT_SECONDSを過ぎても処理中のものを処理待ちに戻し、戻した件数を返す"""
+    conn = _connection()
+    cur = conn.execute(
+        "UPDATE webhook_spool SET state = 'queued', last_error = 'claim timeout'"
+        " WHERE state = 'running' AND claimed_at < ?",
+        (time.time() - SPOOL_CLAIM_TIMEOUT_SECONDS,),
+    )
+    conn.commit()
+    return cur.rowcount
+
+def depth():
+    """{(work_class, state): 件数}"""
+    conn = _connection()
+    rows = conn.execute("SELECT work_class, state, COUNT(*) FROM webhook_spool GROUP BY work_class, state").fetchall()
+    return {(work_class, state): count for work_class, state, count in rows}
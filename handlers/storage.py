@@ -0,0 +1,302 @@
+# handlers/storage.py
+"""
+ファイル保存先の抽象化（フォルダ解決・一覧・DL・アップロード・上書き）
+
+  DriveStorage : Google Drive（共有ドライブ）。本番用
+  LocalStorage : ローカルディレクトリ。1呼び出しごとに遅延を入れられるので、
+                 Driveなしでパイプライン全体のベンチマーク・プロファイルができる
+
+STORAGE_BACKEND=local / LOCAL_STORAGE_DIR / LOCAL_STORAGE_LATENCY_MS で切り替える。
+ハンドラは file_handler の関数を経由して get_storage() の実装を使う。
+"""
+import io
+import json
+import os
+import threading
+import time
+
+from handlers.metrics import count_call
+from handlers.resilience import guard
+from config import (
+    SERVICE_ACCOUNT_FILE, SCOPES, SHARED_DRIVE_ID, DRIVE_API_ENDPOINT, DRIVE_HTTP_TIMEOUT,
+    STORAGE_BACKEND, LOCAL_STORAGE_DIR, LOCAL_STORAGE_LATENCY_MS,
+)
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+
+def _quote(value):
+    """Driveの検索クエリに埋め込む文字列のエスケープ"""
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+_discovery_document = None
+_discovery_lock = threading.Lock()
+
+def drive_discovery_document():
+    """
+    Drive v3のディスカバリ文書（google-api-python-client同梱の静的な文書をプロセスで1回だけ解析する）
+    ネットワークから取得しないので起動・スレッドごとのservice作成が速い
+    """
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            from googleapiclient.discovery_cache import get_static_doc
+            document = json.loads(get_static_doc('drive', 'v3'))
+            if DRIVE_API_ENDPOINT:
+                # api_endpointの指定ではアップロードURLがhttps固定のため、ディスカバリ文書のrootUrlごと差し替える
+                document['rootUrl'] = DRIVE_API_ENDPOINT.rstrip('/') + '/'
+                document['baseUrl'] = document['rootUrl'] + document['servicePath']
+            _discovery_document = document
+        return _discovery_document
+
+def _media(data, mimetype):
+    from googleapiclient.http import MediaIoBaseUpload
+    return MediaIoBaseUpload(io.BytesIO(data), mimetype=mimetype)
+
+class DriveStorage:
+    """
+    Google Driveの実装（認証情報は最初の呼び出しで読み込む）
+    httplib2はスレッドセーフではないため、serviceはスレッドごとに作る
+    APIの呼び出しはすべてDriveのブレーカー（handlers/resilience.py）を通し、1回ごとにDRIVE_HTTP_TIMEOUT秒で打ち切る
+    """
+
+    def __init__(self, drive_id=SHARED_DRIVE_ID):
+        self.drive_id = drive_id
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_credentials(self):
+        with self._lock:
+            if self._credentials is None:
+                if DRIVE_API_ENDPOINT:
+                    # スタブのDrive（tools/stub_services.py）へ認証なしで接続する
+                    from google.auth.credentials import AnonymousCredentials
+                    self._credentials = AnonymousCredentials()
+                else:
+                    from google.oauth2 import service_account
+                    self._credentials = service_account.Credentials.from_service_account_file(
+                        SERVICE_ACCOUNT_FILE, scopes=SCOPES
+                    )
+            return self._credentials
+
+    @property
+    def service(self):
+        """呼び出しスレッド専用のdrive_service"""
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+            from googleapiclient.discovery import build_from_document
+            # httplib2の既定はタイムアウトなし（Driveが応答しないとスレッドが止まったままになる）
+            http = AuthorizedHttp(self._get_credentials(), http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+            service = build_from_document(drive_discovery_document(), http=http)
+            self._local.service = service
+        return service
+
+    def _execute(self, request):
+        with guard('drive'):
+            count_call('drive')
+            return request.execute()
+
+    def _query(self, query, fields='files(id, name, parents)', page_size=1000, order_by=None):
+        """検索クエリの結果をページングして全件返す"""
+        files = []
+        page_token = None
+        while True:
+            res = self._execute(self.service.files().list(
+                q=query,
+                fields=f'nextPageToken, {fields}',
+                pageSize=page_size,
+                pageToken=page_token,
+                orderBy=order_by,
+                driveId=self.drive_id,
+                corpora='drive',
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True
+            ))
+            files.extend(res.get('files', []))
+            page_token = res.get('nextPageToken')
+            if not page_token:
+                return files
+
+    def _parent_clause(self, parent_id):
+        # 共有ドライブ直下を指定する場合（rootではなく、ドライブIDとcorporaをdriveで指定）
+        return f"'{parent_id or 'root'}' in parents"
+
+    def find_folder(self, name, parent_id):
+        """親フォルダ直下の同名フォルダIDを返す（なければNone）。以前の競合で同名が複数あれば最も古いもの"""
+        files = self._query(
+            f"name = '{_quote(name)}' and mimeType = '{FOLDER_MIMETYPE}' and trashed = false"
+            f" and {self._parent_clause(parent_id)}",
+            order_by='createdTime',
+        )
+        return files[0]['id'] if files else None
+
+    def create_folder(self, name, parent_id):
+        file_metadata = {'name': name, 'mimeType': FOLDER_MIMETYPE}
+        if parent_id:
+            file_metadata['parents'] = [parent_id]
+        folder = self._execute(self.service.files().create(body=file_metadata, fields='id', supportsAllDrives=True))
+        return folder['id']
+
+    def list_folders(self, parent_id):
+        """親フォルダ直下のフォルダを {フォルダ名: ID} で返す"""
+        folders = {}
+        for f in self._query(f"mimeType = '{FOLDER_MIMETYPE}' and trashed = false and {self._parent_clause(parent_id)}"):
+            folders.setdefault(f['name'], f['id'])
+        return folders
+
+    def list_files(self, folder_id=None, name=None):
+        """
+        フォルダ直下のファイル（フォルダ以外）を [{'id', 'name', 'parents'}] で返す
+        folder_idがNoneならドライブ全体、nameを指定すれば同名のものだけ
+        """
+        clauses = [f"mimeType != '{FOLDER_MIMETYPE}'", 'trashed = false']
+        if name is not None:
+            clauses.insert(0, f"name = '{_quote(name)}'")
+        if folder_id is not None:
+            clauses.append(f"'{folder_id}' in parents")
+        return self._query(' and '.join(clauses))
+
+    def download(self, file_id):
+        from googleapiclient.http import MediaIoBaseDownload
+        request_dl = self.service.files().get_media(fileId=file_id, supportsAllDrives=True)
+        fh = io.BytesIO()
+        downloader = MediaIoBaseDownload(fh, request_dl)
+        with guard('drive'):
+            count_call('drive')
+            done = False
+            while not done:
+                status, done = downloader.next_chunk()
+        return fh.getvalue()
+
+    def upload(self, data, name, folder_id, mimetype):
+        """新規アップロードしてファイルIDを返す"""
+        media = _media(data, mimetype)
+        created = self._execute(self.service.files().create(
+            body={'name': name, 'parents': [folder_id]},
+            media_body=media,
+            fields='id',
+            supportsAllDrives=True
+        ))
+        return created['id']
+
+    def update(self, file_id, data, mimetype):
+        """既存ファイルの中身を上書きする"""
+        media = _media(data, mimetype)
+        self._execute(self.service.files().update(fileId=file_id, media_body=media, supportsAllDrives=True))
+        return file_id
+
+class LocalStorage:
+    """
+    ローカルディレクトリの実装。IDはルートからの相対パス（ルートは''）
+    latency_msを指定すると1呼び出しごとにその時間だけ待つ（Driveの往復時間の模擬）
+    """
+
+    def __init__(self, root_dir, latency_ms=0):
+        self.root_dir = os.path.abspath(root_dir)
+        self.latency = latency_ms / 1000
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _wait(self):
+        count_call('local')
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _path(self, file_id):
+        path = os.path.normpath(os.path.join(self.root_dir, file_id or ''))
+        if os.path.commonpath([path, self.root_dir]) != self.root_dir:
+            raise ValueError(f"ストレージ外のパスです: {file_id}")
+        return path
+
+    def _id(self, path):
+        rel = os.path.relpath(path, self.root_dir)
+        return '' if rel == '.' else rel.replace(os.sep, '/')
+
+    def find_folder(self, name, parent_id):
+        self._wait()
+        path = os.path.join(self._path(parent_id), name)
+        return self._id(path) if os.path.isdir(path) else None
+
+    def create_folder(self, name, parent_id):
+        self._wait()
+        path = os.path.join(self._path(parent_id), name)
+        os.makedirs(path, exist_ok=True)
+        return self._id(path)
+
+    def list_folders(self, parent_id):
+        self._wait()
+        parent = self._path(parent_id)
+        if not os.path.isdir(parent):
+            return {}
+        return {
+            entry.name: self._id(entry.path)
+            for entry in sorted(os.scandir(parent), key=lambda e: e.name) if entry.is_dir()
+        }
+
+    def list_files(self, folder_id=None, name=None):
+        self._wait()
+        if folder_id is None:
+            walked = ((dirpath, filenames) for dirpath, _, filenames in os.walk(self.root_dir))
+        else:
+            folder = self._path(folder_id)
+            walked = [(folder, [e.name for e in os.scandir(folder) if e.is_file()])] if os.path.isdir(folder) else []
+        files = []
+        for dirpath, filenames in walked:
+            for filename in sorted(filenames):
+                if name is not None and filename != name:
+                    continue
+                files.append({'id': self._id(os.path.join(dirpath, filename)), 'name': filename, 'parents': [self._id(dirpath)]})
+        return files
+
+    def download(self, file_id):
+        self._wait()
+        with open(self._path(file_id), 'rb') as f:
+            return f.read()
+
+    def upload(self, data, name, folder_id, mimetype=None):
+        self._wait()
+        folder = self._path(folder_id)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, name)
+        self._write(path, data)
+        return self._id(path)
+
+    def update(self, file_id, data, mimetype=None):
+        self._wait()
+        self._write(self._path(file_id), data)
+        return file_id
+
+    def _write(self, path, data):
+        # 書きかけのファイルを読まれないよう一時ファイルから置き換える
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    """設定（STORAGE_BACKEND）に応じた保存先を返す（プロセスで1つ）"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if STORAGE_BACKEND == 'local':
+                    _storage = LocalStorage(LOCAL_STORAGE_DIR, LOCAL_STORAGE_LATENCY_MS)
+                else:
+                    _storage = DriveStorage()
+    return _storage
+
+def _reset_after_fork():
+    # 親プロセスで作ったDriveのservice（httplib2の接続）は子プロセスでは使わない。解析済みのディスカバリ文書は共有のまま
+    if isinstance(_storage, DriveStorage):
+        _storage._local = threading.local()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def set_storage(storage):
+    """保存先を差し替える（ベンチマーク・オフライン実行用）"""
+    global _storage
+    _storage = storage
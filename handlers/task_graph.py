@@ -0,0 +1,110 @@
+# handlers/task_graph.py
+"""
+依存関係のある処理を、依存のないものから並列に実行する小さなタスクグラフ
+
+    graph = TaskGraph()
+    graph.add('profile', get_operator_name, user_id, headers)
+    graph.add('content', download, url)
+    graph.add('gpt', lambda content, operator: ..., after=['content', 'profile'])
+    results = graph.run()   # {'profile': ..., 'content': ..., 'gpt': ...}
+
+- after= のタスクの結果が、その順で関数の先頭の引数になる（続けてadd時の引数）
+- 依存先は先にaddしておく（循環は作れない）
+- 例外を投げたタスクに（間接的にでも）依存するタスクは始めない。依存しないタスクは最後まで動かし、
+  すべて終わってから最初の例外を投げる（Driveの障害中もGPT解析とジャーナルへの記録は済ませる）
+- タスクは共有のスレッドプール（TASK_GRAPH_WORKERS）で動く。呼び出し元スレッドの
+  リクエスト単位の状態（計測の種別・LLM使用量のイベント・診断トレース等）は register_context で引き継ぐ
+"""
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from config import TASK_GRAPH_WORKERS
+
+_context_hooks = []
+
+def register_context(capture, restore):
+    """
+    タスクへ引き継ぐスレッドごとの状態を登録する
+    capture() で呼び出し元の状態を取り出し、タスクのスレッドで restore(状態) する（終了後は元に戻す）
+    """
+    _context_hooks.append((capture, restore))
+
+def _bind(fn):
+    captured = [(restore, capture()) for capture, restore in _context_hooks]
+
+    def run(*args):
+        previous = [(restore, capture()) for capture, restore in _context_hooks]
+        for restore, value in captured:
+            restore(value)
+        try:
+            return fn(*args)
+        finally:
+            for restore, value in previous:
+                restore(value)
+    return run
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=TASK_GRAPH_WORKERS, thread_name_prefix='task-graph')
+    return _executor
+
+def _reset_after_fork():
+    # スレッドはforkした子プロセスに引き継がれないので、プールは子プロセスで作り直す（gunicornのpreload）
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+class TaskGraph:
+    def __init__(self):
+        self._tasks = {}
+
+    def add(self, name, fn, *args, after=()):
+        if name in self._tasks:
+            raise ValueError(f"タスク名が重複しています: {name}")
+        missing = [dep for dep in after if dep not in self._tasks]
+        if missing:
+            raise ValueError(f"{name}の依存先が未登録です: {missing}")
+        self._tasks[name] = (fn, tuple(after), args)
+        return name
+
+    def run(self):
+        """全タスクを実行して {タスク名: 結果} を返す"""
+        executor = _get_executor()
+        results = {}
+        pending = dict(self._tasks)
+        running = {}
+        failed = set()
+        error = None
+        while pending or running:
+            for name, (fn, after, args) in list(pending.items()):
+                if any(dep in failed for dep in after):
+                    # 失敗したタスクの結果を待つものは実行しない（さらにその先も）
+                    del pending[name]
+                    failed.add(name)
+                elif all(dep in results for dep in after):
+                    del pending[name]
+                    dep_results = [results[dep] for dep in after]
+                    running[executor.submit(_bind(fn), *dep_results, *args)] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    failed.add(name)
+                    if error is None:
+                        error = e
+        if error is not None:
+            raise error
+        return results
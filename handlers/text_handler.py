@@ -1,62 +1,85 @@
 # handlers/text_handler.py
 
 import os
-from handlers.file_handler import get_or_create_folder, save_text_to_drive
-from handlers.csv_handler import append_to_xlsx
-from handlers.utils import get_now, get_operator_name
+from handlers.file_handler import get_order_folders, save_text_to_drive
+from handlers.csv_handler import prepare_order_rows, append_order_rows
+from handlers.utils import get_now, get_operator_name, clean_order_content
 from .prompt_templates import TEXT_ORDER_PROMPT
 from openai import OpenAI
+from handlers.metrics import stage
+from handlers.llm_client import chat_completion, achat_completion
+from handlers.resilience import stage_budget
+from handlers.task_graph import TaskGraph
 
-def analyze_text_with_gpt(text, operator_name, now_str, now_verbose, openai_client, max_retries=3):
+def text_order_messages(text, operator_name, now_str, now_verbose):
+    """テキスト注文をEXCEL形式に変換させるメッセージ"""
     prompt = TEXT_ORDER_PROMPT.format(
         now_verbose=now_verbose,
         operator_name=operator_name,
         now_str=now_str,
         text=text
     )
+    return [
+        {"role": "system", "content": "あなたはテキスト注文をEXCEL形式に変換するアシスタントです。"},
+        {"role": "user", "content": prompt}
+    ]
+
+@stage('gpt_extraction')
+@stage_budget('gpt_extraction')
+def analyze_text_with_gpt(text, operator_name, now_str, now_verbose, openai_client, max_retries=3):
+    messages = text_order_messages(text, operator_name, now_str, now_verbose)
     for attempt in range(max_retries):
-        response = openai_client.chat.completions.create(
+        response = chat_completion(
+            openai_client,
+            attempt=attempt + 1,
             model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたはテキスト注文をEXCEL形式に変換するアシスタントです。"},
-                {"role": "user", "content": prompt}
-            ],
+            messages=messages,
             max_tokens=1000,
             temperature=0.2
         )
-        content = response.choices[0].message.content.strip()
-        if "申し訳ありません" in content or "直接抽出することはできません" in content:
-            continue
-        lines = content.splitlines()
-        cleaned_lines = [line for line in lines if not line.strip().startswith("この情報") and line.strip() not in ["...", "…"]]
-        return "\n".join(cleaned_lines)
+        structured_text = clean_order_content(response.choices[0].message.content)
+        if structured_text is not None:
+            return structured_text
+    print("構造化テキストが空です。GPT応答なしまたはすべて謝罪文")
+    return ""
+
+async def analyze_text_with_gpt_async(text, operator_name, now_str, now_verbose, openai_client, max_retries=3):
+    """analyze_text_with_gptのasync版（クライアントはAsyncOpenAI）"""
+    messages = text_order_messages(text, operator_name, now_str, now_verbose)
+    with stage('gpt_extraction'), stage_budget('gpt_extraction'):
+        for attempt in range(max_retries):
+            response = await achat_completion(
+                openai_client,
+                attempt=attempt + 1,
+                model="gpt-4o",
+                messages=messages,
+                max_tokens=1000,
+                temperature=0.2
+            )
+            structured_text = clean_order_content(response.choices[0].message.content)
+            if structured_text is not None:
+                return structured_text
     print("構造化テキストが空です。GPT応答なしまたはすべて謝罪文")
     return ""
 
 def process_text_message(event):
     user_id = event['source']['userId']
     headers = {'Authorization': f'Bearer {os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")}'}
-    operator_name = get_operator_name(user_id, headers)
     now, now_str, now_verbose = get_now()
 
     text = event['message']['text']
     file_name = now.strftime('%Y%m%d_%H%M') + '.txt'
-
-    # Google Drive保存先取得
-    root_id = get_or_create_folder('受注集計')
-    date_id = get_or_create_folder(now.strftime('%Y%m%d'), parent_id=root_id)
-    image_folder_id = get_or_create_folder('Line画像保存', parent_id=date_id)
-    csv_folder_id = get_or_create_folder('集計結果', parent_id=date_id)
-
-    # テキストをDrive保存
-    save_text_to_drive(text, file_name, image_folder_id)
-
-    # GPTで構造化
     openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    structured_text = analyze_text_with_gpt(
-        text, operator_name, now_str, now_verbose, openai_client
-    )
 
-    # CSV追記
-    openai_client = OpenAI()
-    append_to_xlsx(structured_text, csv_folder_id, openai_client)
+    # ユーザー名とDrive保存先は同時に取得。テキストのDrive保存（保存先待ち）とGPT構造化（ユーザー名待ち）は並行、
+    # 集計への追記は構造化と保存先を待つ（構造化した行はその場で注文のジャーナルに記録する）
+    graph = TaskGraph()
+    graph.add('operator', get_operator_name, user_id, headers)
+    graph.add('folders', get_order_folders, now.strftime('%Y%m%d'), 'Line画像保存')
+    graph.add('save_original', lambda folders: save_text_to_drive(text, file_name, folders[0]), after=['folders'])
+    graph.add('extract', lambda operator_name: prepare_order_rows(analyze_text_with_gpt(
+        text, operator_name, now_str, now_verbose, openai_client
+    )), after=['operator'])
+    graph.add('append', lambda prepared, folders: append_order_rows(prepared, folders[1], openai_client),
+              after=['extract', 'folders'])
+    graph.run()
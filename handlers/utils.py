@@ -1,9 +1,17 @@
+import hmac
 import pytz
 from datetime import datetime
 import requests
+from config import LINE_API_BASE, LINE_DATA_API_BASE, ADMIN_TOKEN
+from handlers.metrics import stage, count_call
+from handlers.llm_client import set_operator
+from handlers.resilience import guard, Unavailable
 
 JST = pytz.timezone('Asia/Tokyo')
 
+# LINEのユーザID → 前回取得できた表示名（LINEが遮断中・失敗時に使う）
+operator_name_cache = {}
+
 def get_now():
     """
     日本時間の今の時刻(datetime), YYYYMMDDHH, YYYY年MM月DD日 HH時 を返す
@@ -13,15 +21,55 @@ def get_now():
     now_verbose = now.strftime("%Y年%m月%d日 %H時")
     return now, now_str, now_verbose
 
+@stage('operator_name')
 def get_operator_name(user_id, headers):
     """
-    LINEのユーザIDから表示名を取得
+    LINEのユーザIDから表示名を取得（LINEが遮断中・失敗した時は前回の表示名、なければ'不明'）
     """
-    profile_res = requests.get('https://api.line.me/v2/bot/profile/' + user_id, headers=headers)
-    return profile_res.json().get('displayName', '不明')
+    try:
+        with guard('line') as timeout:
+            count_call('line')
+            profile_res = requests.get(f'{LINE_API_BASE}/v2/bot/profile/' + user_id, headers=headers, timeout=timeout)
+            if profile_res.status_code >= 500:
+                profile_res.raise_for_status()
+        operator_name = profile_res.json().get('displayName', '不明')
+        operator_name_cache[user_id] = operator_name
+    except (Unavailable, requests.RequestException) as e:
+        operator_name = operator_name_cache.get(user_id, '不明')
+        print(f"LINEの表示名を取得できません（{operator_name}で続けます）: {e}")
+    # 以降のLLM呼び出しの使用量をこの担当者に付ける
+    set_operator(operator_name)
+    return operator_name
+
+@stage('line_content')
+def get_message_content(message_id, headers):
+    """
+    LINEのメッセージの添付（画像・PDF）をbytesで取得
+    """
+    with guard('line') as timeout:
+        count_call('line')
+        res = requests.get(f'{LINE_DATA_API_BASE}/v2/bot/message/{message_id}/content', headers=headers, timeout=timeout)
+        if res.status_code >= 500:
+            res.raise_for_status()
+    return res.content
 
 def clean_lines(lines):
     """
     GPT応答の不要な行を除去
     """
     return [line for line in lines if not line.strip().startswith("この情報") and line.strip() not in ["...", "…"]]
+
+def clean_order_content(content):
+    """
+    GPT応答から構造化テキストを取り出す（謝罪文・抽出できない旨の応答ならNone＝リトライ）
+    """
+    content = content.strip()
+    if "申し訳ありません" in content or "直接抽出することはできません" in content:
+        return None
+    return "\n".join(clean_lines(content.splitlines()))
+
+def is_admin_token(token):
+    """
+    管理用トークン（ADMIN_TOKEN）と一致するか（未設定なら常にFalse）
+    """
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.strip().encode(), ADMIN_TOKEN.encode())
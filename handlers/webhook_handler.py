@@ -1,30 +1,243 @@
-from handlers.image_handler import process_image_message
-from handlers.text_handler import process_text_message
-from handlers.pdf_handler import process_pdf_message
-from handlers.csv_handler import (
-    xlsx_with_summary_update,  # サマリ生成
-    normalize_df,
-    create_order_list_sheet,
-    create_order_sheets,       # ← 注文書自動作成
-    autofit_columns,
-)
-from handlers.file_handler import get_or_create_folder, drive_service
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
-from config import CSV_FORMAT_PATH, SHARED_DRIVE_ID, ORDER_SUMMARY_FOLDER_ID
-
+import importlib
 import os
-import pytz
-import pandas as pd
+import unicodedata
 from datetime import datetime, timedelta
-from openpyxl import load_workbook
-from openai import OpenAI
+
+import pytz
 import requests
-from handlers.csv_handler import migrate_prev_day_sheets_to_today
-from openpyxl.utils import get_column_letter
-import unicodedata
+
+from handlers.metrics import stage, count_call
+from handlers.admission import admit
+from handlers.journal import order_scope
+from handlers.file_handler import get_or_create_folder, upload_file_to_drive, download_tag_table
+from handlers.storage import drive_discovery_document
+from handlers.resilience import guard, Unavailable
+from config import ORDER_LEDGER_ENABLED, LINE_DATA_API_BASE, STORAGE_BACKEND
+
+# pandas・openpyxl・OpenAI・pdf2imageを使う処理は、起動を速くするため最初に使うコマンド・メッセージで読み込む
+# （LAZY_IMPORTS=0 なら起動時に preload_handlers() でまとめて読み込む）
+HEAVY_MODULES = (
+    'handlers.text_handler', 'handlers.image_handler', 'handlers.pdf_handler',
+    'handlers.csv_handler', 'handlers.workbook_session', 'handlers.monthly_handler', 'handlers.ledger_handler',
+    'googleapiclient.discovery', 'googleapiclient.http',
+)
+
+def preload_handlers():
+    """重いハンドラをまとめて読み込む（gunicornのpreload等、起動時に読み込んでおきたい場合）"""
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+    if STORAGE_BACKEND == 'drive':
+        # ディスカバリ文書の解析結果もpreloadなら全ワーカーで共有される
+        drive_discovery_document()
+
+MONTHLY_COMMAND = '月次集計'
+
+LEDGER_COMMANDS = {
+    '集計サマリ作成', 'ピッキングリスト作成', '発注リスト作成', '注文書作成',
+    '受注残と発注残の作成', '受注残と発注残の前日データ移行', '集計結果出力',
+}
+
+def handle_ledger_command(user_text, today, root_id, date_id, csv_folder_id):
+    """
+    受注台帳モードのコマンド処理
+    集計・ピッキング・残の算出は台帳へのクエリで行い、集計結果xlsxはその結果を描き出すだけ
+    """
+    import pandas as pd
+    from handlers import ledger_handler
+    from handlers.csv_handler import create_order_sheets, export_ledger_workbook
+    try:
+        if user_text == '発注リスト作成':
+            tag_xlsx_path = f"/tmp/タグ付け表.xlsx"
+            if not download_tag_table(root_id, tag_xlsx_path):
+                print("タグ付け表.xlsxが見つかりません")
+                return 'OK', 200
+            count = ledger_handler.load_tags(pd.read_excel(tag_xlsx_path, dtype=str).fillna(""))
+            print(f"タグ付け表を受注台帳に反映しました: {count}件")
+
+        if user_text == '注文書作成':
+            ok = create_order_sheets(date_id, csv_folder_id, today)
+            print("注文書自動作成完了！" if ok else "注文書作成に失敗")
+            return 'OK', 200
+
+        export_ledger_workbook(today, csv_folder_id)
+        print(f"{user_text}（受注台帳）完了！")
+    except Exception as e:
+        print(f"{user_text}（受注台帳）エラー: {e}")
+    return 'OK', 200
+
+# 集計結果xlsxを読み書きするコマンド（WorkbookSessionで1回だけDL・解析する）
+SESSION_COMMANDS = {
+    '集計サマリ作成', 'ピッキングリスト作成', '発注リスト作成', '受注残と発注残の作成', '受注残と発注残の前日データ移行',
+}
+
+def open_summary_session(today, csv_folder_id):
+    """当日の集計結果xlsxのセッションを開く（なければ空ファイルを作成してから開く）"""
+    import pandas as pd
+    from handlers.workbook_session import WorkbookSession
+    filename = f'集計結果_{today}.xlsx'
+    session = WorkbookSession.open(filename, csv_folder_id)
+    if session is None:
+        print("集計ファイルが見つかりません")
+        # --- 新規作成ロジックここから ---
+        file_path = f"/tmp/{filename}"
+        df_empty = pd.DataFrame(columns=["顧客", "発注者", "商品名", "サイズ", "数量", "単位", "納品希望日", "納品場所", "時間", "社内担当者", "備考"])
+        df_empty.to_excel(file_path, index=False)
+        upload_file_to_drive(file_path, filename, csv_folder_id)
+        print("空の集計ファイルを新規作成しアップロードしました")
+        session = WorkbookSession.open(filename, csv_folder_id)
+        if session is None:
+            print("空ファイル作成後も取得できません")
+    return session
+
+def handle_session_command(user_text, today, root_id, csv_folder_id):
+    import pandas as pd
+    from openai import OpenAI
+    from handlers.csv_handler import (
+        update_summary_in_session,  # サマリ生成
+        create_order_list_sheet,
+        create_remains_sheets,
+        carried_picking,
+        migrate_prev_day_sheets_to_today,
+    )
+    try:
+        session = open_summary_session(today, csv_folder_id)
+    except Exception as e:
+        print(f"DriveファイルDLエラー: {e}")
+        return 'OK', 200
+    if session is None:
+        return 'OK', 200
+    main_sheet_name = f"集計結果_{today}"
+
+    # =====================
+    # サマリ生成
+    # =====================
+    if user_text == '集計サマリ作成':
+        try:
+            update_summary_in_session(session, main_sheet_name, OpenAI())
+            session.save()
+            print(f"サマリ生成後にDriveへ再アップロード完了: {session.file_name}")
+        except Exception as e:
+            print(f"サマリ生成またはDriveアップロードエラー: {e}")
+        return 'OK', 200
+
+    # =====================
+    # ピッキングリスト作成
+    # =====================
+    if user_text == 'ピッキングリスト作成':
+        try:
+            if not session.has_sheet(main_sheet_name):
+                # なければ1枚目 fallback（旧方式）なども可
+                print(f"{main_sheet_name} シートがありません。既存シートを利用します")
+                main_sheet_name = session.sheetnames[0]
+            main_df = session.sheet(main_sheet_name)
+
+            with stage('build_sheets'):
+                # 本日納品希望分だけ
+                pick_df = main_df[main_df['納品希望日'] == today]
+
+                # --- 前日以前に受け付けた本日納品分（繰り越しストアから）も追加 ---
+                prev_pick_df = carried_picking(today)
+                if not prev_pick_df.empty:
+                    pick_df = pd.concat([pick_df, prev_pick_df], ignore_index=True)
+
+                session.set_sheet('ピッキングリスト', pick_df.reindex(columns=main_df.columns))
+            session.save()
+            print("ピッキングリスト作成＆Drive再アップロード完了！")
+        except Exception as e:
+            print(f"ピッキングリスト作成またはDriveアップロードエラー: {e}")
+        return 'OK', 200
+
+    # =====================
+    # 発注リスト作成
+    # =====================
+    if user_text == '発注リスト作成':
+        try:
+            tag_xlsx_path = f"/tmp/タグ付け表.xlsx"
+            if not download_tag_table(root_id, tag_xlsx_path):
+                print("タグ付け表.xlsxが見つかりません")
+                return 'OK', 200
+
+            # シート作成
+            ok = create_order_list_sheet(session, tag_xlsx_path)
+            if not ok:
+                print("注文リストシート作成に失敗")
+                return 'OK', 200
+
+            # Drive再アップロード
+            session.save()
+            print("注文リスト作成＆Drive再アップロード完了！")
+        except Exception as e:
+            print(f"注文リスト作成またはDriveアップロードエラー: {e}")
+        return 'OK', 200
+
+    # =====================
+    # 受注残＋発注残シート同時作成
+    # =====================
+    if user_text == '受注残と発注残の作成':
+        try:
+            JST = pytz.timezone('Asia/Tokyo')
+            tomorrow = (datetime.now(JST) + timedelta(days=1)).strftime('%Y%m%d')
+            ok = create_remains_sheets(session, main_sheet_name, today, tomorrow)
+            if not ok:
+                print("発注残作成に失敗")
+            else:
+                print("注文残シート作成成功")
+
+            # Drive再アップロード
+            session.save()
+            print("受注残・発注残シート作成＆Drive再アップロード完了！")
+        except Exception as e:
+            print(f"受注残・発注残作成またはDriveアップロードエラー: {e}")
+        return 'OK', 200
+
+    # =====================
+    # 発注残・注文残の前日データ移行（繰り越しストアから書き出すだけで、前日ファイルはDLしない）
+    # =====================
+    if user_text == '受注残と発注残の前日データ移行':
+        try:
+            migrate_prev_day_sheets_to_today(session, today)
+            session.save()
+            print("前日データ移行シートを作成・アップロード完了")
+        except Exception as e:
+            print(f"前日データ移行エラー: {e}")
+        return 'OK', 200
+
+    return 'OK', 200
+
+def event_kind(data):
+    """計測用のイベント種別（text / image / pdf / file / コマンド名）"""
+    events = (data or {}).get('events') or []
+    if not events:
+        return 'empty'
+    message = events[0].get('message', {})
+    message_type = message.get('type')
+    if message_type == 'text':
+        user_text = message.get('text', '').strip()
+        if user_text.startswith(MONTHLY_COMMAND):
+            return MONTHLY_COMMAND
+        if user_text in LEDGER_COMMANDS or user_text in SESSION_COMMANDS:
+            return user_text
+        return 'text'
+    if message_type == 'file' and message.get('fileName', '').lower().endswith('.pdf'):
+        return 'pdf'
+    return message_type or 'other'
+
+def event_source(data):
+    """LLM使用量の記録用のイベントID（webhookEventId、なければメッセージID）とLINEユーザID"""
+    events = (data or {}).get('events') or []
+    if not events:
+        return None, None
+    event = events[0]
+    event_id = event.get('webhookEventId') or event.get('message', {}).get('id')
+    return event_id, event.get('source', {}).get('userId')
 
 def handle_webhook(request):
+    # 注文・コマンド別の処理枠を取ってから振り分ける（混雑時はスプールに積んで後で処理する）
     data = request.get_json()
+    return admit(event_kind(data), data, handle_webhook_data)
+
+def handle_webhook_data(data):
+    """Webhook本文（dict）を処理する（Flask版・ASGI版で共通）"""
     events = data.get('events', [])
     if not events:
         return 'OK', 200
@@ -33,197 +246,56 @@ def handle_webhook(request):
     message_type = event.get('message', {}).get('type')
 
     if message_type == 'text':
+        if event_kind(data) == 'text':
+            # --- 通常テキスト（注文等）は既存ハンドラへ。コマンド用のDriveフォルダ取得は待たない（Drive障害中もジャーナルに残す） ---
+            from handlers.text_handler import process_text_message
+            with order_scope(event):
+                process_text_message(event)
+            return 'OK', 200
+
         user_text = event['message'].get('text', '').strip()
         JST = pytz.timezone('Asia/Tokyo')
         today = datetime.now(JST).strftime('%Y%m%d')
 
         # Driveの「受注集計＞{today}＞集計結果」までのIDを取得
         try:
-            root_id = get_or_create_folder('受注集計')
-            date_id = get_or_create_folder(today, parent_id=root_id)
-            csv_folder_id = get_or_create_folder('集計結果', parent_id=date_id)
+            with stage('drive_folders'):
+                root_id = get_or_create_folder('受注集計')
+                date_id = get_or_create_folder(today, parent_id=root_id)
+                csv_folder_id = get_or_create_folder('集計結果', parent_id=date_id)
+        except Unavailable:
+            # Driveの遮断中のコマンドはスプールに積んで後でやり直す（admission）
+            raise
         except Exception as e:
             print(f"DriveフォルダID取得エラー: {e}")
             return 'OK', 200
 
-        filename = f'集計結果_{today}.xlsx'
-        file_path = f"/tmp/{filename}"
-
-        # Drive内でファイルを検索
-        query = f"name = '{filename}' and '{csv_folder_id}' in parents and trashed = false"
-        response = drive_service.files().list(
-            q=query,
-            fields='files(id)',
-            driveId=SHARED_DRIVE_ID,
-            corpora='drive',
-            includeItemsFromAllDrives=True,
-            supportsAllDrives=True
-        ).execute()
-        files = response.get('files', [])
-        if not files:
-            print("集計ファイルが見つかりません")
-            # --- 新規作成ロジックここから ---
-            df_empty = pd.DataFrame(columns=["顧客", "発注者", "商品名", "サイズ", "数量", "単位", "納品希望日", "納品場所", "時間", "社内担当者", "備考"])
-            df_empty.to_excel(file_path, index=False)
-            media = MediaFileUpload(file_path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-            file_metadata = {'name': filename, 'parents': [csv_folder_id]}
-            drive_service.files().create(
-                body=file_metadata, media_body=media, fields='id', supportsAllDrives=True
-            ).execute()
-            print("空の集計ファイルを新規作成しアップロードしました")
-            response = drive_service.files().list(
-                q=query,
-                fields='files(id)',
-                driveId=SHARED_DRIVE_ID,
-                corpora='drive',
-                includeItemsFromAllDrives=True,
-                supportsAllDrives=True
-            ).execute()
-            files = response.get('files', [])
-            if not files:
-                print("空ファイル作成後も取得できません")
-                return 'OK', 200
-
-        file_id = files[0]['id']
-        # ファイルを一時保存
-        try:
-            request_dl = drive_service.files().get_media(fileId=file_id)
-            with open(file_path, 'wb') as fh:
-                downloader = MediaIoBaseDownload(fh, request_dl)
-                done = False
-                while not done:
-                    status, done = downloader.next_chunk()
-        except Exception as e:
-            print(f"DriveファイルDLエラー: {e}")
-            return 'OK', 200
-
         # =====================
-        # サマリ生成
+        # 月次集計（例: 「月次集計 2026-10」）
         # =====================
-        if user_text == '集計サマリ作成':
+        if user_text.startswith(MONTHLY_COMMAND):
+            from handlers.monthly_handler import run_monthly_report
             try:
-                openai_client = OpenAI()
-                today = datetime.now(JST).strftime('%Y%m%d')
-                sheet_name = f'集計結果_{today}'
-                df = pd.read_excel(file_path, sheet_name=sheet_name)
-                df_norm = normalize_df(df, openai_client)
-                xlsx_with_summary_update(df_norm, file_path, openai_client)
-
-                # 再アップロード
-                media = MediaFileUpload(file_path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                drive_service.files().update(fileId=file_id, media_body=media, supportsAllDrives=True).execute()
-                print(f"サマリ生成後にDriveへ再アップロード完了: {filename}")
-
+                run_monthly_report(user_text[len(MONTHLY_COMMAND):], root_id=root_id)
+                print("月次集計完了！")
             except Exception as e:
-                print(f"サマリ生成またはDriveアップロードエラー: {e}")
-
+                print(f"月次集計エラー: {e}")
             return 'OK', 200
 
-        # =====================
-        # ピッキングリスト作成
-        # =====================
-        if user_text == 'ピッキングリスト作成':
-            try:
-                df = pd.read_excel(file_path, sheet_name=None)
-                main_sheet_name = f"集計結果_{today}"
-                if main_sheet_name not in df:
-                    # なければ1枚目 fallback（旧方式）なども可
-                    print(f"{main_sheet_name} シートがありません。既存シートを利用します")
-                    main_sheet_name = list(df.keys())[0]
-                main_df = df[main_sheet_name]
-
-                # 本日納品希望分だけ
-                pick_df = main_df[main_df['納品希望日'].astype(str) == today]
-
-                # --- 受注残(前日データ)も存在すれば追加 ---
-                if '受注残(前日データ)' in df:
-                    prev_juchu_df = df['受注残(前日データ)']
-                    # カラム名が0行目になっていれば修正（Excel/Pandas由来でズレることあり）
-                    if not isinstance(prev_juchu_df.columns[0], str):
-                        prev_juchu_df.columns = prev_juchu_df.iloc[0]
-                        prev_juchu_df = prev_juchu_df[1:]
-                    prev_pick_df = prev_juchu_df[prev_juchu_df['納品希望日'].astype(str) == today]
-                    # 本体とマージ
-                    pick_df = pd.concat([pick_df, prev_pick_df], ignore_index=True)
-
-                wb = load_workbook(file_path)
-                # すでに存在すれば削除
-                if 'ピッキングリスト' in wb.sheetnames:
-                    ws = wb['ピッキングリスト']
-                    wb.remove(ws)
-                ws = wb.create_sheet('ピッキングリスト')
-                ws.append(list(main_df.columns))  # 1行目
-                for row in pick_df.itertuples(index=False, name=None):
-                    ws.append(row)
-                for ws in wb.worksheets:
-                    autofit_columns(ws)
-                wb.save(file_path)
-
-                # 再アップロード
-                media = MediaFileUpload(file_path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                drive_service.files().update(fileId=file_id, media_body=media, supportsAllDrives=True).execute()
-                print("ピッキングリスト作成＆Drive再アップロード完了！")
-            except Exception as e:
-                print(f"ピッキングリスト作成またはDriveアップロードエラー: {e}")
-            return 'OK', 200
-
-        # =====================
-        # 発注リスト作成
-        # =====================
-        if user_text == '発注リスト作成':
-            try:
-                tag_xlsx_path = f"/tmp/タグ付け表.xlsx"
-                # 「親フォルダ直下の全ファイル」一括取得
-                files = drive_service.files().list(
-                    q=f"'{root_id}' in parents and trashed = false",
-                    fields="files(id, name)",
-                    driveId=SHARED_DRIVE_ID,
-                    corpora='drive',
-                    includeItemsFromAllDrives=True,
-                    supportsAllDrives=True
-                ).execute().get('files', [])
-                
-                # Python側で正規化比較
-                target_name = unicodedata.normalize('NFC', 'タグ付け表.xlsx')
-                tag_file_id = None
-                for f in files:
-                    f_name = unicodedata.normalize('NFC', f['name'])
-                    if f_name == target_name:
-                        tag_file_id = f['id']
-                        break
-
-                if not tag_file_id:
-                    print("タグ付け表.xlsxが見つかりません")
-                    return 'OK', 200
-
-                tag_dl = drive_service.files().get_media(fileId=tag_file_id)
-                with open(tag_xlsx_path, 'wb') as ftag:
-                    downloader = MediaIoBaseDownload(ftag, tag_dl)
-                    done = False
-                    while not done:
-                        status, done = downloader.next_chunk()
-
-                # シート作成
-                ok = create_order_list_sheet(file_path, tag_xlsx_path)
-                if not ok:
-                    print("注文リストシート作成に失敗")
-                    return 'OK', 200
-
-                # Drive再アップロード
-                media = MediaFileUpload(file_path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                drive_service.files().update(fileId=file_id, media_body=media, supportsAllDrives=True).execute()
-                print("注文リスト作成＆Drive再アップロード完了！")
+        # 受注台帳モードでは集計xlsxをDLせず台帳から処理する
+        if ORDER_LEDGER_ENABLED and user_text in LEDGER_COMMANDS:
+            return handle_ledger_command(user_text, today, root_id, date_id, csv_folder_id)
 
-            except Exception as e:
-                print(f"注文リスト作成またはDriveアップロードエラー: {e}")
-            return 'OK', 200
+        if user_text in SESSION_COMMANDS:
+            return handle_session_command(user_text, today, root_id, csv_folder_id)
 
         # =====================
         # 発注書作成（←ここでcsv_handlerからインポートした関数を使用）
         # =====================
         if user_text == '注文書作成':
+            from handlers.csv_handler import create_order_sheets  # ← 注文書自動作成
             try:
-                ok = create_order_sheets(date_id, csv_folder_id, today, drive_service)
+                ok = create_order_sheets(date_id, csv_folder_id, today)
                 if not ok:
                     print("注文書作成に失敗")
                     return 'OK', 200
@@ -232,116 +304,10 @@ def handle_webhook(request):
                 print(f"注文書作成エラー: {e}")
             return 'OK', 200
 
-        # =====================
-        # 受注残＋発注残シート同時作成
-        # =====================
-        if user_text == '受注残と発注残の作成':
-            try:
-                wb = load_workbook(file_path)
-                JST = pytz.timezone('Asia/Tokyo')
-                tomorrow = (datetime.now(JST) + timedelta(days=1)).strftime('%Y%m%d')
-
-                # --- 受注残シート ---
-                main_sheet_name = f"集計結果_{today}"
-                main_df = pd.DataFrame(wb[main_sheet_name].values)
-                main_df.columns = main_df.iloc[0]
-                main_df = main_df[1:]
-                main_df = main_df.loc[:, main_df.columns.notna() & (main_df.columns != "None")]
-                main_df.columns = main_df.columns.map(lambda x: str(x).strip())
-                main_df = main_df.loc[:, ~main_df.columns.duplicated()]
-                remaining_df = main_df[main_df['納品希望日'].astype(str) >= tomorrow]
-
-                # 受注残(前日データ)からの追加
-                if '受注残(前日データ)' in wb.sheetnames:
-                    prev_df = pd.DataFrame(wb['受注残(前日データ)'].values)
-                    prev_df.columns = prev_df.iloc[0]
-                    prev_df = prev_df[1:]
-                    prev_df = prev_df.loc[:, prev_df.columns.notna() & (prev_df.columns != "None")]
-                    prev_df.columns = prev_df.columns.map(lambda x: str(x).strip())
-                    prev_df = prev_df.loc[:, ~prev_df.columns.duplicated()]
-                    # カラム揃え
-                    prev_df = prev_df.reindex(columns=remaining_df.columns, fill_value="")
-                    prev_add_df = prev_df[prev_df['納品希望日'].astype(str) >= tomorrow]
-                    # 合体
-                    remaining_df = pd.concat([remaining_df, prev_add_df], ignore_index=True)
-                    remaining_df = remaining_df.drop_duplicates()
-
-                # 受注残シート作成
-                if '受注残' in wb.sheetnames:
-                    del wb['受注残']
-                ws_juchu = wb.create_sheet('受注残')
-                ws_juchu.append(list(remaining_df.columns))
-                for row in remaining_df.itertuples(index=False, name=None):
-                    if all([cell is None or str(cell).strip() == "" for cell in row]):
-                        continue
-                    ws_juchu.append(row)
-
-                # --- 注文残シート ---
-                # まず既存ロジックで作成
-                from handlers.csv_handler import create_order_remains_sheet_from_wb
-                ok = create_order_remains_sheet_from_wb(wb)
-                if not ok:
-                    print("発注残作成に失敗")
-                else:
-                    print("注文残シート作成成功")
-
-                # 注文残(前日データ)からの追加
-                if '注文残(前日データ)' in wb.sheetnames and '注文残' in wb.sheetnames:
-                    order_zan_ws = wb['注文残']
-                    # Pandasで加工
-                    order_zan_df = pd.DataFrame(order_zan_ws.values)
-                    order_zan_df.columns = order_zan_df.iloc[0]
-                    order_zan_df = order_zan_df[1:]
-                    prev_df = pd.DataFrame(wb['注文残(前日データ)'].values)
-                    prev_df.columns = prev_df.iloc[0]
-                    prev_df = prev_df[1:]
-                    prev_df = prev_df.loc[:, prev_df.columns.notna() & (prev_df.columns != "None")]
-                    prev_df.columns = prev_df.columns.map(lambda x: str(x).strip())
-                    prev_df = prev_df.loc[:, ~prev_df.columns.duplicated()]
-                    prev_df = prev_df.reindex(columns=order_zan_df.columns, fill_value="")
-                    prev_add_df = prev_df[prev_df['納品希望日'].astype(str) >= tomorrow]
-                    # 合体
-                    order_zan_df = pd.concat([order_zan_df, prev_add_df], ignore_index=True)
-                    order_zan_df = order_zan_df.drop_duplicates()
-                    # シートを一度消して作り直し
-                    del wb['注文残']
-                    ws_oj = wb.create_sheet('注文残')
-                    ws_oj.append(list(order_zan_df.columns))
-                    for row in order_zan_df.itertuples(index=False, name=None):
-                        ws_oj.append(row)
-
-                # 列幅自動調整
-                for ws in wb.worksheets:
-                    autofit_columns(ws)
-                wb.save(file_path)
-
-                # Drive再アップロード
-                media = MediaFileUpload(file_path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                drive_service.files().update(fileId=file_id, media_body=media, supportsAllDrives=True).execute()
-                print("受注残・発注残シート作成＆Drive再アップロード完了！")
-            except Exception as e:
-                print(f"受注残・発注残作成またはDriveアップロードエラー: {e}")
-            return 'OK', 200
-
-        # =====================
-        # 発注残・注文残の前日データ移行
-        # =====================
-        if user_text == '受注残と発注残の前日データ移行':
-            try:
-                ok = migrate_prev_day_sheets_to_today(csv_folder_id, today, drive_service)
-                if not ok:
-                    print("前日データ移行に失敗")
-                    return 'OK', 200
-                print("前日データ移行完了！")
-            except Exception as e:
-                print(f"前日データ移行エラー: {e}")
-            return 'OK', 200
-
-        # --- 通常テキスト（注文等）は既存ハンドラへ ---
-        process_text_message(event)
-
     elif message_type == 'image':
-        process_image_message(event)
+        from handlers.image_handler import process_image_message
+        with order_scope(event):
+            process_image_message(event)
 
     elif message_type == 'file':
         file_name = event['message'].get('fileName', '').lower()
@@ -353,20 +319,21 @@ def handle_webhook(request):
             temp_path = f"/tmp/{file_name}"
             CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
             headers = {"Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"}
-            url = f"https://api-data.line.me/v2/bot/message/{file_id}/content"
-            r = requests.get(url, headers=headers, stream=True)
-            with open(temp_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
+            url = f"{LINE_DATA_API_BASE}/v2/bot/message/{file_id}/content"
+            with guard('line') as timeout:
+                count_call('line')
+                r = requests.get(url, headers=headers, stream=True, timeout=timeout)
+                with open(temp_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=1024):
+                        if chunk:
+                            f.write(chunk)
             try:
                 root_id = get_or_create_folder('受注集計')
-                file_metadata = {'name': file_name, 'parents': [root_id]}
-                media = MediaFileUpload(temp_path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                drive_service.files().create(
-                    body=file_metadata, media_body=media, fields='id', supportsAllDrives=True
-                ).execute()
+                upload_file_to_drive(temp_path, file_name, root_id)
                 print("タグ付け表.xlsxをGoogleドライブにアップロードしました")
+            except Unavailable:
+                # Driveの遮断中はスプールに積んで後でやり直す（admission）
+                raise
             except Exception as e:
                 print(f"タグ付け表.xlsxのDrive保存エラー: {e}")
             return 'OK', 200
@@ -376,27 +343,29 @@ def handle_webhook(request):
             temp_path = f"/tmp/{file_name}"
             CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
             headers = {"Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"}
-            url = f"https://api-data.line.me/v2/bot/message/{file_id}/content"
-            r = requests.get(url, headers=headers, stream=True)
-            with open(temp_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
+            url = f"{LINE_DATA_API_BASE}/v2/bot/message/{file_id}/content"
+            with guard('line') as timeout:
+                count_call('line')
+                r = requests.get(url, headers=headers, stream=True, timeout=timeout)
+                with open(temp_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=1024):
+                        if chunk:
+                            f.write(chunk)
             try:
                 root_id = get_or_create_folder('受注集計')
-                file_metadata = {'name': file_name, 'parents': [root_id]}
-                media = MediaFileUpload(temp_path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                drive_service.files().create(
-                    body=file_metadata, media_body=media, fields='id', supportsAllDrives=True
-                ).execute()
+                upload_file_to_drive(temp_path, file_name, root_id)
                 print("注文書フォーマット.xlsxをGoogleドライブにアップロードしました")
+            except Unavailable:
+                raise
             except Exception as e:
                 print(f"注文書フォーマット.xlsxのDrive保存エラー: {e}")
             return 'OK', 200
 
         # それ以外（PDF等）は既存処理
         elif file_name.endswith('.pdf'):
-            process_pdf_message(event)
+            from handlers.pdf_handler import process_pdf_message
+            with order_scope(event):
+                process_pdf_message(event)
         # 他のファイル型は必要に応じてハンドラ追加
 
     return 'OK', 200
@@ -0,0 +1,298 @@
+# handlers/workbook_session.py
+import io
+import re
+import zipfile
+from xml.sax.saxutils import unescape
+
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.utils import get_column_letter
+
+from config import XLSX_STREAMING_THRESHOLD_BYTES
+from handlers.file_handler import find_file_id, download_file_bytes, upload_file_to_drive
+from handlers.ledger_handler import to_text
+from handlers.metrics import stage
+
+# 表示幅2で数える全角文字（CJK・かな・全角英数記号・ハングルなど）
+_WIDE_CHARS = (
+    r'[\u1100-\u115f\u2e80-\u303e\u3041-\u33ff\u3400-\u4dbf\u4e00-\u9fff'
+    r'\ua000-\ua4cf\uac00-\ud7a3\uf900-\ufaff\ufe30-\ufe4f\uff00-\uff60\uffe0-\uffe6]'
+)
+
+def display_widths(values):
+    """Seriesの各値の表示幅（全角は2、半角は1）をベクトル演算で求める"""
+    text = values.where(values.notna(), "").astype(str)
+    return text.str.len() + text.str.count(_WIDE_CHARS)
+
+def column_widths(df):
+    """DataFrameをA列から書き込んだ時の列幅 {列記号: 幅}"""
+    widths = {}
+    for idx, col in enumerate(df.columns, start=1):
+        width = display_widths(pd.Series([col]))[0]
+        if len(df):
+            width = max(width, int(display_widths(df.iloc[:, idx - 1]).max()))
+        widths[get_column_letter(idx)] = width + 2  # 余白も考慮
+    return widths
+
+def autofit_columns(ws, df=None, grow_only=False):
+    """
+    列幅を表示幅に合わせる
+    df: シートに書き込んだDataFrame（1行目ヘッダ・A列から）。省略時はシートのセルから計算
+    grow_only: 既存の列幅より広い場合だけ更新する（追記時用）
+    """
+    if df is None:
+        rows = list(ws.values)
+        if not rows:
+            return
+        df = pd.DataFrame(rows[1:], columns=["" if c is None else c for c in rows[0]])
+    for letter, adjusted_width in column_widths(df).items():
+        dim = ws.column_dimensions[letter]
+        if grow_only and dim.width and dim.width >= adjusted_width:
+            continue
+        dim.width = adjusted_width
+
+def frame_from_rows(rows):
+    """
+    シートの行（1行目ヘッダ）をDataFrameにする
+    ヘッダの空列・"None"列・重複列を落とし、列名の前後空白を除き、空行を除く
+    納品希望日は'YYYYMMDD'の文字列に揃える
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+    keep = []
+    seen = set()
+    for i, col in enumerate(header):
+        if col is None or str(col).strip() in ("", "None"):
+            continue
+        name = str(col).strip()
+        if name in seen:
+            continue
+        seen.add(name)
+        keep.append((i, name))
+    data = [
+        [r[i] if i < len(r) else None for i, _ in keep]
+        for r in rows
+        if any(v is not None and str(v).strip() != "" for v in r)
+    ]
+    df = pd.DataFrame(data, columns=[name for _, name in keep])
+    if '納品希望日' in df.columns:
+        df['納品希望日'] = df['納品希望日'].map(to_text)
+    return df
+
+def to_sheet_values(df):
+    # DataFrame上は日付を文字列で持つので、xlsxでは従来どおり数値に戻す
+    df = df.copy()
+    if '納品希望日' in df.columns:
+        df['納品希望日'] = df['納品希望日'].map(
+            lambda v: int(v) if isinstance(v, str) and len(v) == 8 and v.isdigit() else v
+        )
+    return df
+
+def frame_rows(df):
+    """DataFrameをヘッダ行＋データ行の並びにする（write-onlyシートへのappend用）"""
+    yield list(df.columns)
+    yield from to_sheet_values(df).itertuples(index=False, name=None)
+
+def _sheet_paths(zf):
+    """{シート名: zip内のシートXMLパス}"""
+    workbook_xml = zf.read('xl/workbook.xml').decode('utf-8')
+    rels_xml = zf.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+    targets = {}
+    for rel in re.findall(r'<Relationship\b[^>]*/>', rels_xml):
+        rid = re.search(r'\bId="([^"]+)"', rel).group(1)
+        target = re.search(r'\bTarget="([^"]+)"', rel).group(1)
+        targets[rid] = target.lstrip('/') if target.startswith('/') else f'xl/{target}'
+    paths = {}
+    for sheet in re.findall(r'<sheet\b[^>]*/>', workbook_xml):
+        name = re.search(r'\bname="([^"]+)"', sheet).group(1)
+        rid = re.search(r'\br:id="([^"]+)"', sheet).group(1)
+        paths[unescape(name)] = targets.get(rid)
+    return paths
+
+def inspect_workbook(data):
+    """
+    xlsxのzipを直接見て、シートごとのXMLサイズ（非圧縮）と列幅を返す（openpyxlで全体を読まない）
+    戻り値: {シート名: {'size': バイト数, 'widths': {列記号: 幅}}}
+    """
+    result = {}
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        names = set(zf.namelist())
+        for name, path in _sheet_paths(zf).items():
+            if path not in names:
+                continue
+            # 列幅は<sheetData>より前の<cols>にしかないので先頭だけ読む
+            with zf.open(path) as fh:
+                head = fh.read(64 * 1024).decode('utf-8', errors='ignore').split('<sheetData', 1)[0]
+            widths = {}
+            for col in re.findall(r'<col\b[^>]*/>', head):
+                width = re.search(r'\bwidth="([\d.]+)"', col)
+                min_col = int(re.search(r'\bmin="(\d+)"', col).group(1))
+                max_col = int(re.search(r'\bmax="(\d+)"', col).group(1))
+                if width and max_col - min_col < 100:
+                    for c in range(min_col, max_col + 1):
+                        widths[get_column_letter(c)] = float(width.group(1))
+            result[name] = {'size': zf.getinfo(path).file_size, 'widths': widths}
+    return result
+
+def is_large_workbook(data, threshold=None):
+    """いずれかのシートのXMLがしきい値以上ならTrue（ストリーミングで読み書きする）"""
+    if not data:
+        return False
+    threshold = XLSX_STREAMING_THRESHOLD_BYTES if threshold is None else threshold
+    return any(info['size'] >= threshold for info in inspect_workbook(data).values())
+
+def write_workbook_streaming(out_path, source_data, sheets):
+    """
+    write-onlyモードでxlsxを書き出す（行はその場でファイルへ流し、メモリに溜めない）
+    source_data: 元のxlsxのbytes（なければNone）。sheetsにないシートは元の値・列幅・表示状態を引き継ぐ
+    sheets: {シート名: {'rows': 置き換える行, 'append': 末尾に足す行, 'widths': {列記号: 幅}, 'hidden': bool}}
+    'rows'がなければ元の行を流し込み、'widths'は既存の列幅より広い列だけ広げる
+    ※セル書式・結合セルは引き継がないので、書式付きのシートがあるブックには使わない
+    """
+    src = load_workbook(io.BytesIO(source_data), read_only=True) if source_data else None
+    src_info = inspect_workbook(source_data) if source_data else {}
+    names = list(src.sheetnames) if src else []
+    names += [n for n in sheets if n not in names]
+
+    wb = Workbook(write_only=True)
+    for name in names:
+        spec = sheets.get(name, {})
+        ws = wb.create_sheet(name)
+        widths = {} if 'rows' in spec else dict(src_info.get(name, {}).get('widths', {}))
+        for letter, width in spec.get('widths', {}).items():
+            widths[letter] = max(width, widths.get(letter, 0))
+        for letter, width in widths.items():
+            ws.column_dimensions[letter].width = width
+        hidden = spec.get('hidden')
+        if hidden is None and src is not None and name in src.sheetnames:
+            hidden = src[name].sheet_state == 'hidden'
+        if hidden:
+            ws.sheet_state = 'hidden'
+
+        if 'rows' in spec:
+            rows = spec['rows']
+        elif src is not None and name in src.sheetnames:
+            rows = src[name].iter_rows(values_only=True)
+        else:
+            rows = []
+        for row in rows:
+            ws.append(row)
+        for row in spec.get('append', []):
+            ws.append(row)
+    wb.save(out_path)
+    if src is not None:
+        src.close()
+
+class WorkbookSession:
+    """
+    1リクエストにつき集計結果xlsxを1回だけDLし、シートをDataFrameとして遅延読み込みする
+    読み込みはread-onlyモードの流し読みで、set_sheet()/set_rows()で書き換えたシートだけを書き戻す
+    列幅調整も書き換えたシートだけに行う
+    大きなブック（XLSX_STREAMING_THRESHOLD_BYTES以上のシートがある）はwrite-onlyモードで書き出す
+    """
+
+    def __init__(self, data, file_name, folder_id, file_id=None):
+        self.file_name = file_name
+        self.folder_id = folder_id
+        self.file_id = file_id
+        self._data = data
+        self._reader = None
+        self._frames = {}
+        self._rows = {}
+        self.dirty = set()
+
+    @classmethod
+    @stage('workbook_download')
+    def open(cls, file_name, folder_id):
+        """Driveからファイルを1回だけDLしてセッションを作る（なければNone）"""
+        file_id = find_file_id(file_name, folder_id)
+        if not file_id:
+            return None
+        return cls(download_file_bytes(file_id), file_name, folder_id, file_id=file_id)
+
+    @property
+    def reader(self):
+        """read-onlyモードのworkbook（シートの行を流し読みするだけ）"""
+        if self._reader is None:
+            self._reader = load_workbook(io.BytesIO(self._data), read_only=True)
+        return self._reader
+
+    @property
+    def sheetnames(self):
+        return self.reader.sheetnames
+
+    def has_sheet(self, name):
+        return name in self._frames or name in self._rows or name in self.reader.sheetnames
+
+    def sheet(self, name):
+        """シートをDataFrameで返す（初回だけ流し読みして変換しキャッシュ）。なければKeyError"""
+        if name not in self._frames:
+            if name not in self.reader.sheetnames:
+                raise KeyError(name)
+            self._frames[name] = frame_from_rows(self.reader[name].iter_rows(values_only=True))
+        return self._frames[name]
+
+    def set_sheet(self, name, df):
+        """シートの内容を置き換える（保存時に書き戻す）"""
+        self._frames[name] = df
+        self.dirty.add(name)
+
+    def set_rows(self, name, rows, hidden=False):
+        """DataFrameにならない構成のシート（集計キャッシュなど）を行のリストで置き換える"""
+        self._rows[name] = (list(rows), hidden)
+        self.dirty.add(name)
+
+    def _save_object_model(self, file_path):
+        wb = load_workbook(io.BytesIO(self._data))
+        for name in [n for n in list(self._frames) + list(self._rows) if n in self.dirty]:
+            index = None
+            if name in wb.sheetnames:
+                index = wb.sheetnames.index(name)
+                del wb[name]
+            ws = wb.create_sheet(name, index)
+            if name in self._rows:
+                rows, hidden = self._rows[name]
+                if hidden:
+                    ws.sheet_state = 'hidden'
+                for row in rows:
+                    ws.append(row)
+                continue
+            df = self._frames[name]
+            for row in frame_rows(df):
+                ws.append(row)
+            autofit_columns(ws, df)
+        wb.save(file_path)
+
+    def _save_streaming(self, file_path):
+        sheets = {}
+        for name in self.dirty:
+            if name in self._rows:
+                rows, hidden = self._rows[name]
+                sheets[name] = {'rows': rows, 'hidden': hidden}
+            else:
+                df = self._frames[name]
+                sheets[name] = {'rows': frame_rows(df), 'widths': column_widths(df)}
+        write_workbook_streaming(file_path, self._data, sheets)
+
+    def save(self):
+        """変更したシートだけを書き戻してDriveへ反映する（変更がなければ何もしない）"""
+        if not self.dirty:
+            return False
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        file_path = f"/tmp/{self.file_name}"
+        with stage('workbook_rewrite'):
+            if is_large_workbook(self._data):
+                self._save_streaming(file_path)
+            else:
+                self._save_object_model(file_path)
+        with stage('workbook_upload'):
+            self.file_id = upload_file_to_drive(file_path, self.file_name, self.folder_id, file_id=self.file_id)
+        with open(file_path, 'rb') as f:
+            self._data = f.read()
+        self.dirty.clear()
+        self._rows.clear()
+        return True
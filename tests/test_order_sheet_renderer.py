@@ -0,0 +1,67 @@
+# tests/test_order_sheet_renderer.py
+"""注文書の高速レンダラ（XML差し替え）とopenpyxlでの生成が同じセルになるか"""
+import io
+import os
+import re
+import sys
+import zipfile
+
+from openpyxl import load_workbook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from handlers.order_sheet_handler import (  # noqa: E402
+    ORDER_TARGET_CELLS, order_page_values, render_order_workbook,
+)
+from handlers.order_sheet_renderer import CompiledOrderTemplate  # noqa: E402
+
+HEADER = {'発注先': '青果センター', '郵便番号': '100-0001', '住所': '東京都千代田区', '発行日': '2026/10/19'}
+ROWS = [
+    {'商品名': 'トマト', '数量': 3, '単位': '箱', 'サイズ': 'L', '納品希望日': '20261020'},
+    {'商品名': 'キャベツ', '数量': 1.5, '単位': 'ケース', 'サイズ': '', '納品希望日': '20261021'},
+]
+
+def _template_bytes():
+    with open(os.path.join(ROOT, '注文書フォーマット.xlsx'), 'rb') as f:
+        return f.read()
+
+def _cell_values(data):
+    ws = load_workbook(io.BytesIO(data)).active
+    values = {}
+    for row in ws.iter_rows():
+        for cell in row:
+            value = cell.value
+            if value is None or value == '':
+                continue
+            values[cell.coordinate] = getattr(value, 'text', value)
+    return values
+
+def _render_both(template_bytes, rows):
+    fast = CompiledOrderTemplate(template_bytes, ORDER_TARGET_CELLS).render(order_page_values(HEADER, rows))
+    slow = render_order_workbook(template_bytes, HEADER, rows)
+    return _cell_values(fast), _cell_values(slow)
+
+def test_fast_path_matches_openpyxl():
+    template_bytes = _template_bytes()
+    fast, slow = _render_both(template_bytes, ROWS)
+    assert fast == slow
+    # 明細のない行のフォーマット（軽減税率の※）は残る
+    assert fast.get('K21') == _cell_values(template_bytes).get('K21')
+
+def test_fast_path_matches_openpyxl_with_tax_column():
+    rows = [dict(row, 消費税='10%') for row in ROWS]
+    fast, slow = _render_both(_template_bytes(), rows)
+    assert fast == slow
+
+def test_cells_without_r_attribute():
+    # r属性を省略したセル（直前のセルの次の列）があってもコンパイルできる
+    buf = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(_template_bytes())) as src, zipfile.ZipFile(buf, 'w') as dst:
+        for info in src.infolist():
+            data = src.read(info.filename)
+            if info.filename == 'xl/worksheets/sheet1.xml':
+                data = re.sub(rb'<c r="L21"', b'<c', data)
+            dst.writestr(info, data)
+    fast, slow = _render_both(buf.getvalue(), ROWS[:1])
+    assert fast == slow
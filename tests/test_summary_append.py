@@ -0,0 +1,76 @@
+# tests/test_summary_append.py
+"""集計結果xlsxへの追記で、手で並べ替え・追加・削除された生データの列に合わせて書くか"""
+import os
+import sys
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook, load_workbook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from handlers import csv_handler  # noqa: E402
+from handlers.csv_handler import SUMMARY_COLUMNS, append_normalized_rows, load_summary_aggregate  # noqa: E402
+
+def _order(name, qty):
+    row = {c: '' for c in SUMMARY_COLUMNS}
+    row.update(商品名=name, 数量=qty, 単位='箱', 納品希望日='20261020')
+    return row
+
+def _make_workbook(path, header):
+    # 既存の1行を書いた後、見出しを手で変えたブック
+    append_normalized_rows(pd.DataFrame([_order('トマト', 3)], columns=SUMMARY_COLUMNS), str(path))
+    wb = load_workbook(path)
+    ws = wb[path.stem]
+    rows = [dict(zip(SUMMARY_COLUMNS, r)) for r in ws.iter_rows(min_row=2, values_only=True)]
+    del wb[path.stem]
+    ws = wb.create_sheet(path.stem, 0)
+    ws.append(header)
+    for row in rows:
+        ws.append([row.get(c) for c in header])
+    wb.save(path)
+
+def _raw_records(path):
+    ws = load_workbook(path)[path.stem]
+    values = list(ws.iter_rows(values_only=True))
+    return [dict(zip(values[0], r)) for r in values[1:]]
+
+@pytest.fixture(params=['object_model', 'streaming'])
+def mode(request, monkeypatch):
+    if request.param == 'streaming':
+        monkeypatch.setattr(csv_handler, 'is_large_workbook', lambda data: True)
+    return request.param
+
+@pytest.mark.parametrize('header', [
+    list(reversed(SUMMARY_COLUMNS)),
+    SUMMARY_COLUMNS[:5] + ['メモ'] + SUMMARY_COLUMNS[5:],
+    [c for c in SUMMARY_COLUMNS if c != '備考'],
+])
+def test_append_follows_raw_header(tmp_path, mode, header, capsys):
+    path = tmp_path / '集計結果_20261020.xlsx'
+    _make_workbook(path, header)
+    append_normalized_rows(pd.DataFrame([_order('キャベツ', 2)], columns=SUMMARY_COLUMNS), str(path))
+
+    records = _raw_records(path)
+    # 見出しにない列（手で消された備考）は見出しの末尾に足される
+    assert set(SUMMARY_COLUMNS) <= set(records[0])
+    assert [(r['商品名'], r['数量'], r['単位']) for r in records] == [('トマト', 3, '箱'), ('キャベツ', 2, '箱')]
+    aggregate, rows, _ = load_summary_aggregate(load_workbook(path))
+    assert rows == 2
+    assert sorted(entry['商品名'] for entry in aggregate.values()) == ['キャベツ', 'トマト']
+
+    # 続けて追記しても集計キャッシュは作り直さずに合う
+    capsys.readouterr()
+    append_normalized_rows(pd.DataFrame([_order('トマト', 1)], columns=SUMMARY_COLUMNS), str(path))
+    assert '再構築' not in capsys.readouterr().out
+    wb = load_workbook(path)
+    aggregate, rows, _ = load_summary_aggregate(wb)
+    assert rows == 3
+    assert sum(entry['数量'] for entry in aggregate.values()) == 6
+
+def test_new_sheet_gets_summary_header(tmp_path, mode):
+    path = tmp_path / '集計結果_20261021.xlsx'
+    Workbook().save(path)
+    append_normalized_rows(pd.DataFrame([_order('トマト', 3)], columns=SUMMARY_COLUMNS), str(path))
+    assert list(next(load_workbook(path)[path.stem].iter_rows(values_only=True))) == SUMMARY_COLUMNS
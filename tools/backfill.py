@@ -0,0 +1,276 @@
+# tools/backfill.py
+"""
+保存済みの注文画像・PDFを一括で再抽出するバッチ（プロンプトや正規化ルールを変えた時用）
+
+入力: ローカルディレクトリ（--dir）または Driveの受注集計＞日付＞Line画像保存 / PDF保存（--drive 期間）
+  - 受付日・時刻はファイル名の「YYYYMMDD_HHMM」から取る（なければ親フォルダ名の日付）
+抽出: analyze_image_with_gpt / analyze_pdf_with_gpt を並列数を絞ったスレッドプールで実行
+  - 1件終わるごとにチェックポイント（JSON）へ保存し、再実行時は済んだファイルを飛ばす
+書き込み: 全件の抽出後に受付日ごとにまとめて1回だけ書く（ファイルごとにappend_to_xlsxを呼ばない）
+  - --output local（既定）: --out-dir に 集計結果_YYYYMMDD.xlsx を新しく作る（Driveは変更しない）
+  - --output drive: Driveの当日の集計結果xlsx（台帳モードでは台帳）へ書く
+    すでに注文がある日は飛ばす（元のLINEのメッセージ分と二重になるため）。
+    --replace を付けると、その日の生データを再抽出の結果で置き換えて集計結果サマリ・集計キャッシュを作り直す
+
+使い方:
+  python tools/backfill.py --drive 2026-10 --workers 4 --checkpoint /tmp/backfill_202610.json
+  python tools/backfill.py --drive 2026-10 --output drive --replace
+  python tools/backfill.py --dir ./archive/20261015 --output local --out-dir ./reextract
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+from openai import OpenAI  # noqa: E402
+
+from handlers.image_handler import analyze_image_with_gpt  # noqa: E402
+from handlers.pdf_handler import analyze_pdf_with_gpt  # noqa: E402
+from handlers.csv_handler import (  # noqa: E402
+    parse_structured_text, append_orders, replace_orders, day_has_orders, xlsx_with_summary_append,
+)
+from handlers.file_handler import (  # noqa: E402
+    get_or_create_folder, find_folder_id,
+    list_child_folders, list_folder_files, download_file_bytes,
+)
+from handlers.monthly_handler import parse_period  # noqa: E402
+from handlers.llm_client import usage_scope, set_operator  # noqa: E402
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+PDF_EXTENSIONS = {'.pdf'}
+ARCHIVE_FOLDERS = ['Line画像保存', 'PDF保存']
+
+def file_kind(name):
+    ext = os.path.splitext(name)[1].lower()
+    if ext in IMAGE_EXTENSIONS:
+        return 'image'
+    if ext in PDF_EXTENSIONS:
+        return 'pdf'
+    return None
+
+def received_at(name, fallback_day):
+    """ファイル名の YYYYMMDD_HHMM から受付日と時刻（YYYYMMDDHH）を得る"""
+    m = re.search(r'(\d{8})_(\d{2})(\d{2})', name)
+    if m:
+        return m.group(1), m.group(1) + m.group(2)
+    return fallback_day, fallback_day + '00'
+
+def local_items(root):
+    """ローカルディレクトリ以下の画像・PDF（日付は親ディレクトリ名のYYYYMMDDを既定にする）"""
+    items = []
+    for dirpath, _, filenames in os.walk(root):
+        folder_day = next((p for p in reversed(dirpath.split(os.sep)) if re.fullmatch(r'\d{8}', p)), None)
+        for name in sorted(filenames):
+            kind = file_kind(name)
+            if kind is None:
+                continue
+            path = os.path.abspath(os.path.join(dirpath, name))
+            fallback = folder_day or datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y%m%d')
+            day, now_str = received_at(name, fallback)
+            items.append({'key': f'local:{path}', 'name': name, 'kind': kind, 'path': path, 'day': day, 'time': now_str})
+    return items
+
+def drive_items(period_text):
+    """受注集計＞日付＞Line画像保存 / PDF保存 から期間内のファイルを集める"""
+    start, end = parse_period(period_text)
+    root_id = get_or_create_folder('受注集計')
+    items = []
+    for day, date_id in sorted(list_child_folders(root_id).items()):
+        if not (re.fullmatch(r'\d{8}', day) and start <= day <= end):
+            continue
+        for folder_name in ARCHIVE_FOLDERS:
+            folder_id = find_folder_id(folder_name, date_id)
+            if not folder_id:
+                continue
+            for f in list_folder_files(folder_id):
+                kind = file_kind(f['name'])
+                if kind is None:
+                    continue
+                file_day, now_str = received_at(f['name'], day)
+                items.append({'key': f"drive:{f['id']}", 'name': f['name'], 'kind': kind,
+                              'file_id': f['id'], 'day': file_day, 'time': now_str})
+    return items
+
+class Checkpoint:
+    """抽出結果と書き込み済みの日をJSONに保存する（1件ごとに一時ファイル経由で置き換え）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {'files': {}, 'written_days': []}
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.state = json.load(f)
+
+    def done(self, key):
+        return self.state['files'].get(key, {}).get('status') == 'done'
+
+    def record(self, key, entry):
+        with self.lock:
+            self.state['files'][key] = entry
+            self._save()
+
+    def mark_written(self, day):
+        with self.lock:
+            self.state['written_days'].append(day)
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+def extract_item(item, operator_name, openai_client):
+    """1ファイル分: 取得→GPT抽出。戻り値は構造化テキスト"""
+    if 'path' in item:
+        with open(item['path'], 'rb') as f:
+            data = f.read()
+    else:
+        data = download_file_bytes(item['file_id'])
+    received = datetime.strptime(item['time'], '%Y%m%d%H')
+    now_verbose = received.strftime('%Y年%m月%d日 %H時')
+    fd, tmp_path = tempfile.mkstemp(prefix='backfill_', suffix=os.path.splitext(item['name'])[1].lower(), dir='/tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        analyze = analyze_image_with_gpt if item['kind'] == 'image' else analyze_pdf_with_gpt
+        return analyze(tmp_path, operator_name, item['time'], now_verbose, openai_client)
+    finally:
+        os.remove(tmp_path)
+
+def run_extraction(items, checkpoint, workers, operator_name, openai_client):
+    pending = [item for item in items if not checkpoint.done(item['key'])]
+    print(f"対象 {len(items)}件（チェックポイント済み {len(items) - len(pending)}件、今回 {len(pending)}件）")
+    stats = {'done': 0, 'error': 0, 'latency': 0.0}
+    started = time.perf_counter()
+
+    def work(item):
+        t0 = time.perf_counter()
+        # LLM使用量はファイルごとに backfill:<キー> として記録する
+        with usage_scope(f"backfill:{item['key']}"):
+            set_operator(operator_name)
+            text = extract_item(item, operator_name, openai_client)
+        return text, time.perf_counter() - t0
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(work, item): item for item in pending}
+        for future in as_completed(futures):
+            item = futures[future]
+            entry = {'day': item['day'], 'time': item['time'], 'name': item['name']}
+            try:
+                text, latency = future.result()
+                entry.update(status='done', text=text)
+                stats['done'] += 1
+                stats['latency'] += latency
+            except Exception as e:
+                entry.update(status='error', error=str(e))
+                stats['error'] += 1
+                print(f"抽出エラー: {item['name']}: {e}")
+            checkpoint.record(item['key'], entry)
+            finished = stats['done'] + stats['error']
+            if finished % 10 == 0 or finished == len(pending):
+                elapsed = time.perf_counter() - started
+                print(f"  {finished}/{len(pending)}件 {finished / elapsed * 60 if elapsed else 0:.1f}件/分")
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+def frames_by_day(checkpoint, keys):
+    """
+    チェックポイントの抽出結果を受付日ごとの注文DataFrameにまとめる
+    抽出に失敗したファイルがある日は書かない（再実行で抽出し直してからまとめて書く）
+    """
+    by_day = {}
+    incomplete = set()
+    for key in keys:
+        entry = checkpoint.state['files'].get(key, {})
+        if entry.get('status') != 'done':
+            incomplete.add(entry.get('day'))
+            continue
+        if not entry.get('text', '').strip():
+            continue
+        df = parse_structured_text(entry['text'], entry['day'], entry['time'])
+        if df is not None:
+            by_day.setdefault(entry['day'], []).append(df)
+    for day in sorted(d for d in incomplete if d):
+        print(f"{day}: 抽出エラーのファイルがあるため書き込みを保留します（再実行してください）")
+    return {day: pd.concat(frames, ignore_index=True) for day, frames in sorted(by_day.items()) if day not in incomplete}
+
+def write_results(frames, checkpoint, output, out_dir, openai_client, replace=False):
+    """
+    受付日ごとに1回だけ書く（書き込み済みの日はチェックポイントを見て飛ばす）
+    Driveでは、注文がある日はreplaceの時だけ置き換える（なければ飛ばす）
+    """
+    rows = 0
+    for day, df in frames.items():
+        if day in checkpoint.state['written_days']:
+            print(f"{day}: 書き込み済みのためスキップ")
+            continue
+        if output == 'drive':
+            root_id = get_or_create_folder('受注集計')
+            date_id = get_or_create_folder(day, parent_id=root_id)
+            csv_folder_id = get_or_create_folder('集計結果', parent_id=date_id)
+            if replace:
+                replace_orders(df, csv_folder_id, openai_client, day)
+            elif day_has_orders(day, csv_folder_id):
+                print(f"{day}: 集計結果にすでに注文があるためスキップ（置き換えるには --replace）")
+                continue
+            else:
+                append_orders(df, csv_folder_id, openai_client, day)
+        else:
+            path = os.path.join(out_dir, f'集計結果_{day}.xlsx')
+            if os.path.exists(path):
+                os.remove(path)
+            xlsx_with_summary_append(df, path, openai_client)
+        checkpoint.mark_written(day)
+        rows += len(df)
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help='画像・PDFを置いたローカルディレクトリ')
+    source.add_argument('--drive', metavar='PERIOD', help="Driveの期間（'2026-10' / '20261001-20261015'）")
+    parser.add_argument('--output', choices=['local', 'drive'], default='local', help='書き込み先（既定: local）')
+    parser.add_argument('--out-dir', default='/tmp/backfill', help='--output local の出力先')
+    parser.add_argument('--replace', action='store_true', help='--output drive で、注文がある日を再抽出の結果で置き換える')
+    parser.add_argument('--workers', type=int, default=4, help='並列抽出数（OpenAIのレート制限に合わせて調整）')
+    parser.add_argument('--checkpoint', default='/tmp/backfill_checkpoint.json', help='チェックポイントJSON')
+    parser.add_argument('--operator', default='一括再抽出', help='プロンプトに渡す担当者名')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    items = local_items(args.dir) if args.dir else drive_items(args.drive)
+    checkpoint = Checkpoint(args.checkpoint)
+    openai_client = OpenAI()
+
+    stats = run_extraction(items, checkpoint, args.workers, args.operator, openai_client)
+
+    write_started = time.perf_counter()
+    os.makedirs(args.out_dir, exist_ok=True)
+    frames = frames_by_day(checkpoint, [item['key'] for item in items])
+    rows = write_results(frames, checkpoint, args.output, args.out_dir, openai_client, args.replace)
+    write_seconds = time.perf_counter() - write_started
+
+    total = time.perf_counter() - started
+    extracted = stats['done'] + stats['error']
+    print("---- 再抽出結果 ----")
+    print(f"抽出: {stats['done']}件成功 / {stats['error']}件エラー  {stats['seconds']:.1f}秒"
+          f"（{extracted / stats['seconds'] * 60 if stats['seconds'] else 0:.1f}件/分、"
+          f"1件平均 {stats['latency'] / stats['done'] if stats['done'] else 0:.1f}秒）")
+    print(f"書き込み: {len(frames)}日分 {rows}行  {write_seconds:.1f}秒（出力先: {args.output}）")
+    print(f"合計: {total:.1f}秒")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# tools/journal.py
+"""
+注文のジャーナル（handlers/journal.py、JOURNAL_DIR）の確認と復旧
+
+  status    : 状態ごとの件数・書き込み待ちの受付日（--list で1件ずつ）
+  replay    : 書き込み待ち（extracted）の行を受付日ごとにまとめて集計に書き込む（Drive・OpenAIの復旧後）
+  reprocess : 抽出前で止まった（received）注文を、受信したイベントからもう一度処理する（OpenAIの障害中に受けた注文など）
+  discard   : 指定した注文を処理しないことにする
+  compact   : 済んだセグメントを消す
+
+使い方:
+  python tools/journal.py status --list
+  python tools/journal.py replay --day 20261019
+  python tools/journal.py reprocess --older-than 600
+  python tools/journal.py discard 6f1c... --reason 重複
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers import journal  # noqa: E402
+
+def print_status(show_list):
+    info = journal.status()
+    print(f"セグメント: {info['segments']}  状態: {info['states'] or 'なし'}")
+    for day, count in sorted(info['pending_days'].items()):
+        print(f"  書き込み待ち {day}: {count}件")
+    if not show_list:
+        return
+    for entry_id, entry in sorted(journal.load_entries().items(), key=lambda kv: kv[1]['received_at']):
+        if entry['state'] == 'flushed':
+            continue
+        received = datetime.fromtimestamp(entry['received_at']).strftime('%Y-%m-%d %H:%M:%S')
+        rows = len(entry['rows'] or [])
+        print(f"{entry['state']:<10} {received} {entry['kind'] or '-':<6} {entry_id}  行{rows}  {entry['error'] or ''}")
+
+def reprocess(older_than):
+    from handlers.webhook_handler import handle_webhook_data, event_kind, event_source
+    from handlers.metrics import request_span
+    from handlers.llm_client import usage_scope
+    now = time.time()
+    targets = [
+        (entry_id, entry) for entry_id, entry in journal.load_entries().items()
+        if entry['state'] == 'received' and entry['event'] and now - entry['received_at'] >= older_than
+    ]
+    for entry_id, entry in targets:
+        data = {'events': [entry['event']]}
+        kind = event_kind(data)
+        try:
+            with request_span(kind), usage_scope(*event_source(data)):
+                handle_webhook_data(data)
+            print(f"再処理しました: {entry_id}（{kind}）")
+        except Exception as e:
+            print(f"再処理に失敗しました: {entry_id}（{kind}）: {e}")
+    print(f"対象 {len(targets)}件")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    status = sub.add_parser('status')
+    status.add_argument('--list', action='store_true', help='済んでいない注文を1件ずつ表示')
+    replay = sub.add_parser('replay')
+    replay.add_argument('--day', action='append', help='この受付日（YYYYMMDD）だけ（複数指定可）')
+    replay.add_argument('--min-age', type=float, default=0, help='記録からこの秒数以上たった行だけ（既定: 0）')
+    reprocess_parser = sub.add_parser('reprocess')
+    reprocess_parser.add_argument('--older-than', type=float, default=600, help='受信からこの秒数以上たったものだけ（既定: 600）')
+    discard = sub.add_parser('discard')
+    discard.add_argument('ids', nargs='+')
+    discard.add_argument('--reason', default='discarded')
+    sub.add_parser('compact')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        print_status(args.list)
+    elif args.command == 'replay':
+        results = journal.replay_pending(min_age=args.min_age, days=args.day)
+        if results is None:
+            sys.exit("他のプロセスが書き込み中です。しばらくしてから実行してください")
+        print(results or "書き込み待ちはありません")
+    elif args.command == 'reprocess':
+        reprocess(args.older_than)
+    elif args.command == 'discard':
+        journal.discard(args.ids, args.reason)
+        print(f"{len(args.ids)}件を処理しないことにしました")
+    elif args.command == 'compact':
+        print(f"{journal.compact()}セグメントを削除しました")
+
+if __name__ == '__main__':
+    main()
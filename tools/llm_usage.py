@@ -0,0 +1,69 @@
+# tools/llm_usage.py
+"""
+LLM呼び出しの使用量（handlers/llm_client.pyが記録したllm_usageテーブル）の集計CLI
+
+集計軸（--by、カンマ区切りで複数可）:
+  day / event_id / operator / user_id / caller / call_path / kind / model
+
+使い方:
+  python tools/llm_usage.py                         # 日別
+  python tools/llm_usage.py --by operator 2026-10   # 担当者別（期間指定）
+  python tools/llm_usage.py --by call_path --period 20261019
+  python tools/llm_usage.py --by event_id --top 20 --csv /tmp/llm_by_event.csv
+  python tools/llm_usage.py --raw --event 6f1c...   # 1件分の明細
+"""
+import argparse
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+
+from handlers.llm_client import load_usage, usage_summary  # noqa: E402
+from handlers.monthly_handler import parse_period  # noqa: E402
+
+def period_range(text):
+    """'20261019' → その1日、それ以外はparse_period（月・範囲）"""
+    if not text:
+        return None, None
+    if re.fullmatch(r'\d{8}', text.strip()):
+        return text.strip(), text.strip()
+    return parse_period(text)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('period', nargs='?', help="期間（'20261019' / '2026-10' / '20261001-20261015'。省略時は全期間）")
+    parser.add_argument('--period', dest='period_opt', help='期間（位置引数と同じ）')
+    parser.add_argument('--by', default='day', help='集計軸（既定: day）')
+    parser.add_argument('--top', type=int, help='料金の多い順に上位N件だけ表示')
+    parser.add_argument('--raw', action='store_true', help='集計せずに明細を表示')
+    parser.add_argument('--event', help='明細をこのイベントIDに絞る（--rawと併用）')
+    parser.add_argument('--csv', help='結果をCSVにも書き出す')
+    args = parser.parse_args()
+
+    since, until = period_range(args.period_opt or args.period)
+    if args.raw:
+        result = load_usage(since, until)
+        if args.event:
+            result = result[result['event_id'] == args.event]
+    else:
+        result = usage_summary(args.by, since, until)
+    if args.top:
+        result = result.head(args.top)
+
+    if result.empty:
+        print("該当する記録がありません")
+        return
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print(result.to_string(index=False, float_format=lambda v: f'{v:,.4f}'))
+    if not args.raw:
+        print(f"\n合計: {int(result['calls'].sum())}回, 入力 {int(result['prompt_tokens'].sum()):,} / "
+              f"出力 {int(result['completion_tokens'].sum()):,} トークン, 概算 ${result['cost_usd'].sum():,.4f}")
+    if args.csv:
+        result.to_csv(args.csv, index=False, encoding='utf-8-sig')
+        print(f"CSVに書き出しました: {args.csv}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+# tools/monthly_report.py
+"""
+月次・複数日集計のCLI（LINEの「月次集計 2026-10」と同じ処理）
+
+使い方:
+  python tools/monthly_report.py 2026-10
+  python tools/monthly_report.py 20261001-20261015 --out-dir ./reports --no-upload
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers.monthly_handler import run_monthly_report  # noqa: E402
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('period', help="期間（'2026-10' / '202610' / '20261001-20261015'）")
+    parser.add_argument('--out-dir', default='/tmp', help='集計xlsxを書き出すディレクトリ')
+    parser.add_argument('--no-upload', action='store_true', help='Driveの月次集計フォルダへアップロードしない')
+    parser.add_argument('--workers', type=int, help='並列DL数（省略時はMONTHLY_DOWNLOAD_WORKERS）')
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    path = run_monthly_report(args.period, upload=not args.no_upload, out_dir=args.out_dir, max_workers=args.workers)
+    print(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# tools/prewarm.py
+"""
+翌日分の準備（handlers/scheduler.py）を手で行う・確認する
+
+  （引数なし）   : 翌日分のフォルダと集計結果xlsxを準備する（スケジューラと同じ。準備済みなら記録を表示するだけ）
+  --day YYYYMMDD : 指定した日の分を準備する（当日・過去の日はフォルダだけ）
+  --status       : 準備済みの記録を表示する
+
+準備済みの記録を置くSCHEDULER_STATE_DIRの指定が必要（スケジューラと同じディレクトリ）
+
+使い方:
+  SCHEDULER_STATE_DIR=/var/lib/line-webhook/prewarm python tools/prewarm.py
+  python tools/prewarm.py --day 20261020
+  python tools/prewarm.py --status
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers import scheduler  # noqa: E402
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--day', help='準備する日（YYYYMMDD、既定: 翌日）')
+    parser.add_argument('--status', action='store_true', help='準備済みの記録を表示する')
+    args = parser.parse_args()
+    if not scheduler.SCHEDULER_STATE_DIR:
+        parser.error('SCHEDULER_STATE_DIRを指定してください')
+
+    now = datetime.now(scheduler.JST)
+    day = args.day or (now + timedelta(days=1)).strftime('%Y%m%d')
+    if args.status:
+        print(json.dumps(scheduler.scheduler_status()['prepared'], ensure_ascii=False, indent=2))
+        return
+    marker = scheduler.prepare_day(day, now.strftime('%Y%m%d'))
+    scheduler.warm_day(day)
+    print(json.dumps(marker, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# tools/replay_webhook.py
+"""
+Webhookのリプレイ・負荷試験（LINE / OpenAI / Drive はスタブに向けて実行する）
+
+イベント:
+  --events FILE   : 1行1件のJSONL（WEBHOOK_CAPTURE_PATHで記録した本文、または単独のイベント）
+  --synthesize N  : テキスト注文・画像・PDF・コマンドを混ぜた合成イベントをN件作る
+送信先:
+  --target URL    : 起動済みのアプリ（スタブへの向け先はアプリ側の環境変数で設定しておく）
+  省略時          : スタブサーバーとアプリ（app.py、--asgiならasgi_app.pyをuvicornで）をこのプロセスから起動して送る
+負荷:
+  --concurrency 同時送信数、--rate 1秒あたりの送信数（0は上限なし）、--repeat 繰り返し回数
+  --latency / --error-rate でスタブの遅延とエラー率を指定する（tools/stub_services.py と同じ書式）
+
+使い方:
+  python tools/replay_webhook.py --synthesize 50 --concurrency 4 --latency openai=800,drive=80,line=30
+  python tools/replay_webhook.py --synthesize 50 --concurrency 32 --latency openai=800,drive=80,line=30 --asgi
+  WEBHOOK_CAPTURE_PATH=/tmp/webhook_capture.jsonl python app.py   # 本番相当の受信を記録しておき
+  python tools/replay_webhook.py --events /tmp/webhook_capture.jsonl --rate 2 --repeat 3
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+from tools.stub_services import start_stub_server, stub_environment, parse_service_values  # noqa: E402
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_ORDERS = [
+    "トマト L 3kg 明日納品 本店",
+    "キャベツ 2玉、玉ねぎ 10kg お願いします",
+    "きゅうり 5本 明後日 倉庫へ",
+    "レタス 4個 午前中着で",
+]
+SAMPLE_COMMANDS = ['集計サマリ作成', 'ピッキングリスト作成', '受注残と発注残の作成']
+
+def load_events(path):
+    """JSONLを読み、1行ずつWebhook本文（{'events': [...]}）にそろえる"""
+    bodies = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            bodies.append(data if 'events' in data else {'destination': 'replay', 'events': [data]})
+    return bodies
+
+def synthesize_events(count, seed=None):
+    """テキスト注文6割・画像2割・PDF1割・コマンド1割の合成イベント"""
+    rng = random.Random(seed)
+    bodies = []
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.6:
+            message = {'type': 'text', 'id': f'text{i}', 'text': rng.choice(SAMPLE_ORDERS)}
+        elif roll < 0.8:
+            message = {'type': 'image', 'id': f'img{i}'}
+        elif roll < 0.9:
+            message = {'type': 'file', 'id': f'pdf{i}', 'fileId': f'pdf{i}', 'fileName': f'注文書_{i}.pdf'}
+        else:
+            message = {'type': 'text', 'id': f'cmd{i}', 'text': rng.choice(SAMPLE_COMMANDS)}
+        bodies.append({'destination': 'replay', 'events': [{
+            'type': 'message',
+            'timestamp': int(time.time() * 1000),
+            'source': {'type': 'user', 'userId': f'Ureplay{i % 5}'},
+            'replyToken': f'replay{i}',
+            'message': message,
+        }]})
+    return bodies
+
+def event_label(body):
+    """集計用のイベント種別（text / image / file / コマンド名）"""
+    events = body.get('events') or [{}]
+    message = events[0].get('message', {})
+    if message.get('type') == 'text' and message.get('text', '').strip() in SAMPLE_COMMANDS:
+        return message['text'].strip()
+    return message.get('type', 'unknown')
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_app(stub_port, extra_env=None, asgi=False):
+    """スタブに向けたアプリを別プロセスで起動し、(process, url) を返す"""
+    port = _free_port()
+    env = dict(os.environ, **stub_environment(stub_port), **(extra_env or {}))
+    if asgi:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--host', '127.0.0.1', '--port', str(port),
+                   '--log-level', 'warning']
+    else:
+        code = f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"
+        command = [sys.executable, '-c', code]
+    process = subprocess.Popen(
+        command, cwd=ROOT_DIR, env=env,
+        stdout=subprocess.DEVNULL if not os.environ.get('REPLAY_APP_LOG') else None,
+        stderr=subprocess.STDOUT,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("アプリの起動に失敗しました（REPLAY_APP_LOG=1 でログを表示）")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return process, f'http://127.0.0.1:{port}/webhook'
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("アプリの起動待ちがタイムアウトしました")
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+def replay(bodies, target, concurrency=1, rate=0, timeout=120):
+    """
+    本文を順に送り、(種別, ステータス, 秒) のリストを返す
+    rateは送信開始の間隔で守る（同時送信数はconcurrencyで頭打ち）
+    """
+    results = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(body):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        t0 = time.perf_counter()
+        try:
+            status = session.post(target, json=body, timeout=timeout).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        with lock:
+            results.append((event_label(body), status, time.perf_counter() - t0))
+
+    interval = 1 / rate if rate else 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for i, body in enumerate(bodies):
+            if interval:
+                wait = started + i * interval - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            pool.submit(send, body)
+    return results, time.perf_counter() - started
+
+def print_report(results, elapsed, stub_stats=None):
+    latencies = [seconds for _, _, seconds in results]
+    print("---- リプレイ結果 ----")
+    print(f"送信 {len(results)}件  {elapsed:.1f}秒  スループット {len(results) / elapsed if elapsed else 0:.2f}件/秒")
+    print(
+        f"応答時間 p50 {percentile(latencies, 50):.3f}秒 / p95 {percentile(latencies, 95):.3f}秒 / "
+        f"p99 {percentile(latencies, 99):.3f}秒 / 最大 {max(latencies, default=0):.3f}秒"
+    )
+    print("ステータス: " + ", ".join(f"{k}={v}" for k, v in sorted(Counter(str(s) for _, s, _ in results).items())))
+    by_label = {}
+    for label, _, seconds in results:
+        by_label.setdefault(label, []).append(seconds)
+    for label, values in sorted(by_label.items()):
+        print(f"  {label}: {len(values)}件 p50 {percentile(values, 50):.3f}秒 / p95 {percentile(values, 95):.3f}秒")
+    if stub_stats:
+        print(f"スタブ呼び出し: {stub_stats['calls']}  注入エラー: {stub_stats['errors']}  Driveファイル数: {stub_stats['drive_files']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--events', help='Webhook本文のJSONL（WEBHOOK_CAPTURE_PATHの記録など）')
+    source.add_argument('--synthesize', type=int, metavar='N', help='合成イベントをN件作って送る')
+    parser.add_argument('--target', help='送信先URL（省略時はスタブとアプリをこのプロセスから起動）')
+    parser.add_argument('--concurrency', type=int, default=1, help='同時送信数（既定: 1）')
+    parser.add_argument('--rate', type=float, default=0, help='1秒あたりの送信数（0は上限なし）')
+    parser.add_argument('--repeat', type=int, default=1, help='イベント列を繰り返す回数')
+    parser.add_argument('--latency', default='', help="スタブの遅延ミリ秒（例: openai=800,drive=80,line=30）")
+    parser.add_argument('--error-rate', default='', help="スタブのエラー率（例: openai=0.02）")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=120, help='1リクエストのタイムアウト秒')
+    parser.add_argument('--asgi', action='store_true', help='アプリをASGI版（asgi_app.py、uvicorn）で起動する')
+    args = parser.parse_args()
+
+    bodies = load_events(args.events) if args.events else synthesize_events(args.synthesize, args.seed)
+    bodies = bodies * max(1, args.repeat)
+
+    server = process = state = None
+    target = args.target
+    if not target:
+        server, state = start_stub_server(0, parse_service_values(args.latency),
+                                          parse_service_values(args.error_rate), args.seed)
+        process, target = start_app(server.server_address[1], asgi=args.asgi)
+        print(f"スタブ: http://127.0.0.1:{server.server_address[1]}  アプリ: {target}")
+    try:
+        results, elapsed = replay(bodies, target, args.concurrency, args.rate, args.timeout)
+        print_report(results, elapsed, state.stats() if state else None)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        if server is not None:
+            server.shutdown()
+
+if __name__ == '__main__':
+    main()
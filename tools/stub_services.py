@@ -0,0 +1,331 @@
+# tools/stub_services.py
+"""
+リプレイ・負荷試験用のスタブサーバー（LINE / OpenAI / Google Drive を1プロセスで代替）
+
+  LINE   : GET  /v2/bot/profile/{userId}, GET /v2/bot/message/{id}/content
+  OpenAI : POST /v1/chat/completions（注文抽出はCSV行、正規化は入力をそのまま返す）
+  Drive  : files.list / create / update / get_media（メモリ上のファイル。アプリで使う検索条件のみ対応）
+  統計   : GET  /__stats（サービスごとの呼び出し数・注入したエラー数）
+
+サービスごとに遅延（ミリ秒）とエラー率を指定できる。アプリ側は次の環境変数で向け先を切り替える
+  LINE_API_BASE / LINE_DATA_API_BASE = http://127.0.0.1:{port}
+  OPENAI_BASE_URL                    = http://127.0.0.1:{port}/v1
+  DRIVE_API_ENDPOINT                 = http://127.0.0.1:{port}/
+
+使い方:
+  python tools/stub_services.py --port 18080 --latency openai=800,drive=80,line=30 --error-rate openai=0.02
+"""
+import argparse
+import email
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+SERVICES = ('line', 'openai', 'drive')
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+
+# 最小のJPEG（1x1）とPDF（白紙1ページ）
+STUB_JPEG = bytes.fromhex(
+    'ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f'
+    '141d1a1f1e1d1a1c1c20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100'
+    'ffc4001f0000010501010101010100000000000000000102030405060708090a0bffda0008010100003f00d2cf20ffd9'
+)
+STUB_PDF = (
+    b'%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n'
+    b'2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n'
+    b'3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 72 72]>>endobj\n'
+    b'trailer<</Root 1 0 R>>\n%%EOF\n'
+)
+
+def parse_service_values(text, cast=float):
+    """'openai=800,drive=80' → {'openai': 800.0, 'drive': 80.0}（'all=10'は全サービス）"""
+    values = {}
+    for part in (text or '').split(','):
+        if '=' not in part:
+            continue
+        name, value = part.split('=', 1)
+        name = name.strip()
+        targets = SERVICES if name == 'all' else (name,)
+        for target in targets:
+            values[target] = cast(value)
+    return values
+
+class DriveStore:
+    """メモリ上のDrive（ID・名前・親・mimeType・中身）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self._ids = itertools.count(1)
+
+    def create(self, metadata, content=None):
+        with self.lock:
+            file_id = f'stub{next(self._ids):06d}'
+            self.files[file_id] = {
+                'id': file_id,
+                'name': metadata.get('name', ''),
+                'parents': list(metadata.get('parents', [])),
+                'mimeType': metadata.get('mimeType', 'application/octet-stream'),
+                'trashed': False,
+                'content': content or b'',
+            }
+            return self.files[file_id]
+
+    def update(self, file_id, content):
+        with self.lock:
+            entry = self.files.get(file_id)
+            if entry is not None:
+                entry['content'] = content
+            return entry
+
+    def query(self, q):
+        """アプリで使う条件（name = / 'id' in parents / mimeType = / != / trashed = false を and で結合）だけを解釈する"""
+        conditions = []
+        for clause in re.split(r'\s+and\s+', q.strip()) if q else []:
+            m = re.fullmatch(r"name\s*=\s*'(.*)'", clause)
+            if m:
+                conditions.append(lambda f, v=m.group(1).replace("\\'", "'"): f['name'] == v)
+                continue
+            m = re.fullmatch(r"'([^']*)'\s+in\s+parents", clause)
+            if m:
+                conditions.append(lambda f, v=m.group(1): v in f['parents'])
+                continue
+            m = re.fullmatch(r"mimeType\s*(=|!=)\s*'([^']*)'", clause)
+            if m:
+                if m.group(1) == '=':
+                    conditions.append(lambda f, v=m.group(2): f['mimeType'] == v)
+                else:
+                    conditions.append(lambda f, v=m.group(2): f['mimeType'] != v)
+                continue
+            if re.fullmatch(r"trashed\s*=\s*false", clause):
+                conditions.append(lambda f: not f['trashed'])
+        with self.lock:
+            return [f for f in self.files.values() if all(c(f) for c in conditions)]
+
+class StubState:
+    def __init__(self, latency_ms=None, error_rate=None, seed=None):
+        self.latency_ms = latency_ms or {}
+        self.error_rate = error_rate or {}
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.lock = threading.Lock()
+        self.drive = DriveStore()
+
+    def enter(self, service):
+        """遅延を入れ、エラーを注入するならTrueを返す"""
+        with self.lock:
+            self.calls[service] += 1
+            fail = self.random.random() < self.error_rate.get(service, 0)
+            if fail:
+                self.errors[service] += 1
+        delay = self.latency_ms.get(service, 0) / 1000
+        if delay:
+            time.sleep(delay)
+        return fail
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'errors': dict(self.errors),
+                'drive_files': len(self.drive.files),
+            }
+
+def stub_completion(body):
+    """注文抽出プロンプトにはCSV行、正規化プロンプトには入力（単位は単位だけ）を返す"""
+    messages = body.get('messages', [])
+    system = next((m.get('content', '') for m in messages if m.get('role') == 'system'), '')
+    user = next((m.get('content', '') for m in messages if m.get('role') == 'user'), '')
+    if isinstance(user, list):
+        user = next((part.get('text', '') for part in user if part.get('type') == 'text'), '')
+    if 'EXCEL形式' in system:
+        now_str = (re.search(r'「(\d{10})」', user) or re.search(r'(\d{10})', user))
+        now_str = now_str.group(1) if now_str else time.strftime('%Y%m%d%H')
+        delivery = now_str[:8]
+        content = "\n".join([
+            f"スタブ食堂,担当,トマト,L,3,kg,{delivery},本店,{now_str},,",
+            f"スタブ食堂,担当,キャベツ,,2,玉,{delivery},本店,{now_str},,",
+        ])
+    elif user.startswith('商品名:'):
+        m = re.search(r'単位:\s*(.*)', user)
+        content = m.group(1).strip() if m else ''
+    else:
+        content = user.strip()
+    return {
+        'id': 'chatcmpl-stub',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'gpt-4o'),
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': len(str(messages)) // 4, 'completion_tokens': len(content) // 2,
+                  'total_tokens': len(str(messages)) // 4 + len(content) // 2},
+    }
+
+def _split_multipart(content_type, data):
+    """multipart/relatedのアップロード本文を（メタデータ, 中身）に分ける"""
+    message = email.message_from_bytes(
+        b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + data
+    )
+    parts = [p for p in message.walk() if not p.is_multipart()]
+    metadata = json.loads(parts[0].get_payload(decode=True) or b'{}') if parts else {}
+    content = parts[1].get_payload(decode=True) if len(parts) > 1 else b''
+    return metadata, content
+
+def make_handler(state):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body=b'', content_type='application/json'):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def _fail(self, service):
+            if service == 'openai':
+                self._send(500, {'error': {'message': 'stub injected error', 'type': 'server_error'}})
+            else:
+                self._send(503, {'error': {'code': 503, 'message': 'stub injected error'}})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if url.path == '/__stats':
+                return self._send(200, state.stats())
+            if url.path.startswith('/v2/bot/'):
+                if state.enter('line'):
+                    return self._fail('line')
+                if url.path.startswith('/v2/bot/profile/'):
+                    return self._send(200, {'displayName': 'スタブ担当', 'userId': url.path.rsplit('/', 1)[-1]})
+                m = re.fullmatch(r'/v2/bot/message/([^/]+)/content', url.path)
+                if m:
+                    is_pdf = m.group(1).startswith('pdf')
+                    return self._send(200, STUB_PDF if is_pdf else STUB_JPEG,
+                                      'application/pdf' if is_pdf else 'image/jpeg')
+                return self._send(404, {'message': 'not found'})
+            if url.path.startswith('/drive/v3/files'):
+                if state.enter('drive'):
+                    return self._fail('drive')
+                m = re.fullmatch(r'/drive/v3/files/([^/]+)', url.path)
+                if m:
+                    entry = state.drive.files.get(m.group(1))
+                    if entry is None:
+                        return self._send(404, {'error': {'code': 404, 'message': 'File not found'}})
+                    if params.get('alt') == ['media']:
+                        return self._send(200, entry['content'], entry['mimeType'])
+                    return self._send(200, {k: entry[k] for k in ('id', 'name', 'parents', 'mimeType')})
+                files = state.drive.query(params.get('q', [''])[0])
+                return self._send(200, {'files': [
+                    {'id': f['id'], 'name': f['name'], 'parents': f['parents'], 'mimeType': f['mimeType']}
+                    for f in files
+                ]})
+            self._send(404, {'message': 'not found'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            data = self._read_body()
+            if url.path.endswith('/chat/completions'):
+                if state.enter('openai'):
+                    return self._fail('openai')
+                return self._send(200, stub_completion(json.loads(data or b'{}')))
+            if url.path in ('/drive/v3/files', '/upload/drive/v3/files'):
+                if state.enter('drive'):
+                    return self._fail('drive')
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('multipart/'):
+                    metadata, content = _split_multipart(content_type, data)
+                elif url.path.startswith('/upload/'):
+                    metadata, content = {}, data
+                else:
+                    metadata, content = json.loads(data or b'{}'), b''
+                entry = state.drive.create(metadata, content)
+                return self._send(200, {'id': entry['id'], 'name': entry['name']})
+            self._send(404, {'message': 'not found'})
+
+        def do_PATCH(self):
+            url = urlparse(self.path)
+            data = self._read_body()
+            m = re.fullmatch(r'(?:/upload)?/drive/v3/files/([^/]+)', url.path)
+            if not m:
+                return self._send(404, {'message': 'not found'})
+            if state.enter('drive'):
+                return self._fail('drive')
+            content_type = self.headers.get('Content-Type', '')
+            content = _split_multipart(content_type, data)[1] if content_type.startswith('multipart/') else data
+            entry = state.drive.update(m.group(1), content)
+            if entry is None:
+                return self._send(404, {'error': {'code': 404, 'message': 'File not found'}})
+            self._send(200, {'id': entry['id'], 'name': entry['name']})
+
+    return StubHandler
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 呼び出し側のタイムアウトで切られた接続は無視する
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+def start_stub_server(port=0, latency_ms=None, error_rate=None, seed=None):
+    """スタブサーバーを別スレッドで起動し、(server, state) を返す（port=0なら空きポート）"""
+    state = StubState(latency_ms, error_rate, seed)
+    server = StubServer(('127.0.0.1', port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+def stub_environment(port):
+    """アプリをスタブへ向けるための環境変数"""
+    base = f'http://127.0.0.1:{port}'
+    return {
+        'LINE_API_BASE': base,
+        'LINE_DATA_API_BASE': base,
+        'OPENAI_BASE_URL': f'{base}/v1',
+        'OPENAI_API_KEY': 'stub',
+        'LINE_CHANNEL_ACCESS_TOKEN': 'stub',
+        'DRIVE_API_ENDPOINT': f'{base}/',
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', default='', help="サービスごとの遅延ミリ秒（例: openai=800,drive=80,line=30）")
+    parser.add_argument('--error-rate', default='', help="サービスごとのエラー率（例: openai=0.02）")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    server, _ = start_stub_server(args.port, parse_service_values(args.latency),
+                                  parse_service_values(args.error_rate), args.seed)
+    print(f"スタブサーバー起動: http://127.0.0.1:{server.server_address[1]}")
+    for key, value in stub_environment(server.server_address[1]).items():
+        print(f"  {key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()